@@ -0,0 +1,177 @@
+"""Build-time evaluation of conda env activation scripts.
+
+Packages configure the env via etc/conda/activate.d scripts, eg. thread
+counts for MKL and OpenMP or data dirs for GDAL and PROJ. The scripts are
+sourced at build time in a linked view of the env, and the resulting
+variable changes recorded as a declarative delta applied by the bootstrap
+at launch, without spawning a shell.
+
+Scripts are evaluated once with each changed variable unset, and once set to
+a sentinel, so that the delta reproduces both cases, eg. prepending to
+LD_LIBRARY_PATH only if it is set. Env paths are recorded with the prefix
+placeholder, and the current value of updated variables with the
+current_placeholder.
+"""
+
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set
+
+from coex_bootstrap.activate import current_placeholder
+from coex_bootstrap.install import prefix_placeholder
+
+logger = logging.getLogger(__name__)
+
+ACTIVATE_DIR = "etc/conda/activate.d"
+
+# Variables of the evaluating shell, rather than the activation
+IGNORED_VARS = {"_", "PWD", "OLDPWD", "SHLVL", "CONDA_PREFIX"}
+
+ACTIVATE_TIMEOUT = 60
+
+# Sources the activate.d scripts in order, dumping env before and after
+ACTIVATE_SCRIPT = """\
+env -0 > "$1"
+for script in "$CONDA_PREFIX"/etc/conda/activate.d/*.sh; do
+    if [ -f "$script" ]; then
+        . "$script"
+    fi
+done
+env -0 > "$2"
+"""
+
+
+def activate_scripts(package_dirs: Iterable[Path]) -> List[Path]:
+    """activate.d shell scripts of the extracted packages."""
+    return sorted(
+        (p for d in package_dirs for p in (Path(d) / ACTIVATE_DIR).glob("*.sh")),
+        key=lambda p: p.name,
+    )
+
+
+def link_env(package_dirs: Iterable[Path], prefix: Path) -> None:
+    """Merge extracted packages into a view of the env at prefix, via symlinks."""
+    for package_dir in package_dirs:
+        for dirpath, dirnames, filenames in os.walk(str(package_dir)):
+            rel = os.path.relpath(dirpath, str(package_dir))
+            if rel == "info" or rel.startswith("info" + os.sep):
+                continue
+            os.makedirs(str(prefix / rel), exist_ok=True)
+            for name in filenames + [
+                d for d in dirnames if os.path.islink(os.path.join(dirpath, d))
+            ]:
+                target = prefix / rel / name
+                if not os.path.lexists(str(target)):
+                    os.symlink(os.path.join(dirpath, name), str(target))
+
+
+def _read_env(path: Path) -> Dict[str, str]:
+    return dict(
+        entry.split("=", 1)
+        for entry in path.read_bytes().decode("utf-8", "replace").split("\0")
+        if "=" in entry
+    )
+
+
+def _source(prefix: Path, env: Dict[str, str]) -> Dict[str, Dict[str, str]]:
+    """Source activate.d scripts of env at prefix, returning before and after env.
+
+    Raises:
+        subprocess.SubprocessError: Scripts failed or timed out.
+
+    """
+    shell = shutil.which("bash") or "sh"
+    subprocess.run(
+        [shell, "-c", ACTIVATE_SCRIPT, shell]
+        + [str(prefix.parent / "before"), str(prefix.parent / "after")],
+        env=env,
+        cwd=str(prefix),
+        check=True,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        timeout=ACTIVATE_TIMEOUT,
+    )
+    return {
+        "before": _read_env(prefix.parent / "before"),
+        "after": _read_env(prefix.parent / "after"),
+    }
+
+
+def _delta_value(
+    value: Optional[str], current: Optional[str], prefixes: Set[str]
+) -> Optional[str]:
+    """Activated value, with the current value and prefix as placeholders."""
+    if value is None:
+        return None
+    if current:
+        value = value.replace(current, current_placeholder)
+    for prefix in prefixes:
+        value = value.replace(prefix, prefix_placeholder)
+    return value
+
+
+def activation(package_dirs: List[Path], work_dir: Path) -> List[dict]:
+    """Evaluate activate.d scripts of extracted packages into an env delta.
+
+    Args:
+        package_dirs: Extracted packages of the env.
+        work_dir: Scratch directory.
+
+    Returns:
+        Activation delta, [{"name", "value", "update"}], as applied by
+        coex_bootstrap.activate.activate_vars. Empty if the packages have no
+        activate.d scripts, or the scripts fail.
+
+    """
+    scripts = activate_scripts(package_dirs)
+    if not scripts:
+        return []
+    logger.info("activation scripts=%s", [s.name for s in scripts])
+
+    with tempfile.TemporaryDirectory(prefix=".tmp_", dir=str(work_dir)) as tmp:
+        prefix = Path(tmp) / "env"
+        link_env(package_dirs, prefix)
+        prefixes = {str(prefix), os.path.realpath(str(prefix))}
+
+        env = dict(os.environ)
+        env["CONDA_PREFIX"] = str(prefix)
+        env["PATH"] = f"{prefix}/bin:{env.get('PATH', '')}"
+
+        try:
+            changed = _source(prefix, env)
+            names = sorted(
+                name
+                for name in set(changed["before"]) | set(changed["after"])
+                if changed["before"].get(name) != changed["after"].get(name)
+                and name not in IGNORED_VARS
+            )
+
+            # Evaluate with changed variables set, and unset, PATH is always set
+            set_env = dict(env, **{n: f"@COEX_{n}@" for n in names if n != "PATH"})
+            updated = _source(prefix, set_env)
+            unset_env = {k: v for k, v in env.items() if k not in names or k == "PATH"}
+            unset = _source(prefix, unset_env)
+        except (OSError, subprocess.SubprocessError) as ex:
+            logger.warning("skipping activate.d scripts, evaluation failed: %s", ex)
+            return []
+
+    delta = []
+    for name in names:
+        update = _delta_value(
+            updated["after"].get(name), updated["before"].get(name), prefixes
+        )
+        value = (
+            update
+            if name == "PATH"
+            else _delta_value(unset["after"].get(name), None, prefixes)
+        )
+        if value is None and update == current_placeholder:
+            continue
+        delta.append(dict(name=name, value=value, update=update))
+
+    logger.info("activation delta=%s", delta)
+    return delta
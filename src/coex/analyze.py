@@ -0,0 +1,449 @@
+"""Analysis of .coex archive contents and predicted startup cost."""
+
+import contextlib
+import json
+import logging
+import os
+import subprocess
+import tarfile
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+from typing import List, Optional
+
+import attr
+
+from coex.cache import format_size
+from coex_bootstrap import split_threads
+from coex_bootstrap.binaries import COEXBootstrapBinaries
+from coex_bootstrap.config import COEXBootstrapConfig
+from coex_bootstrap.install import (
+    prefix_placeholder,
+    read_coex_prefix,
+    read_has_prefix,
+    read_paths_json,
+    update_prefix,
+    update_prefixes,
+)
+from coex_bootstrap.unpack import ZipPkgHandle
+
+logger = logging.getLogger(__name__)
+
+INFO_FILES = ("has_prefix", "paths.json", "coex_prefix.json", "index.json")
+
+
+@attr.s(auto_attribs=True)
+class MemberStats:
+    """Contents of a package, or source, archive member."""
+
+    name: str
+    compressed_size: int
+    uncompressed_size: int
+    file_count: int
+    # Files, and total bytes, rewritten by prefix updates
+    prefix_files: int = 0
+    prefix_bytes: int = 0
+    noarch: Optional[str] = None
+    # Build-time relocation prefix, prefix updates are skipped at this prefix
+    fixed_prefix: Optional[str] = None
+    # Recorded compression parameters
+    compression: Optional[dict] = None
+    # Independently decompressible chunks, extracted concurrently
+    chunks: int = 1
+
+    @property
+    def ratio(self) -> float:
+        """Compression ratio."""
+        return self.uncompressed_size / max(self.compressed_size, 1)
+
+
+@attr.s(auto_attribs=True)
+class Calibration:
+    """Local extraction and relocation throughput."""
+
+    extract_bytes_per_s: float
+    extract_s_per_file: float
+    relocate_bytes_per_s: float
+    relocate_s_per_file: float
+
+    def extract_s(self, member: MemberStats, threads: Optional[int] = None) -> float:
+        """Predicted extraction time of member, its chunks on threads."""
+        return (
+            member.uncompressed_size / self.extract_bytes_per_s
+            + member.file_count * self.extract_s_per_file
+        ) / min(member.chunks, threads or os.cpu_count() or 1)
+
+    def relocate_s(self, member: MemberStats) -> float:
+        """Predicted prefix update time of member, at a non-fixed prefix."""
+        return (
+            member.prefix_bytes / self.relocate_bytes_per_s
+            + member.prefix_files * self.relocate_s_per_file
+        )
+
+
+def member_stats(
+    archive: Path,
+    name: str,
+    binaries: COEXBootstrapBinaries,
+    member: Optional[dict] = None,
+) -> MemberStats:
+    """Read member stats, streaming the member's tar contents.
+
+    Args:
+        archive: coex archive.
+        name: .tar.zst member name.
+        binaries: Local coex bootstrap binaries.
+        member: Member metadata from the bootstrap config.
+
+    Returns:
+        MemberStats of the member.
+
+    """
+    # Chunked members are read with their chunks, as a single package
+    chunks = [(name, member)] + [
+        (chunk["name"], chunk) for chunk in (member or {}).get("chunks", [])
+    ]
+    with zipfile.ZipFile(str(archive)) as zf:
+        compressed_size = sum(zf.getinfo(n).file_size for n, _ in chunks)
+
+    sizes = {}
+    with contextlib.ExitStack() as cstack:
+        info_dir = cstack.enter_context(tempfile.TemporaryDirectory())
+
+        for chunk_name, chunk_member in chunks:
+            # Decompress as the bootstrap does, via unzip and zstd
+            extract = subprocess.Popen(
+                [binaries.unzip, "-p", str(archive), chunk_name],
+                stdout=subprocess.PIPE,
+            )
+            decompress = subprocess.Popen(
+                ZipPkgHandle(str(archive), chunk_name, chunk_member).decompress_cmd(
+                    binaries
+                ),
+                stdin=extract.stdout,
+                stdout=subprocess.PIPE,
+            )
+            assert extract.stdout and decompress.stdout
+            extract.stdout.close()
+
+            with tarfile.open(fileobj=decompress.stdout, mode="r|") as tar:
+                for tarinfo in tar:
+                    if tarinfo.isdir():
+                        continue
+                    path = os.path.normpath(tarinfo.name)
+                    sizes[path] = tarinfo.size
+
+                    # Package info is in info/<dist>/, or info/ in earlier layouts
+                    parts = path.split("/")
+                    info_name = parts[-1]
+                    if (
+                        tarinfo.isfile()
+                        and parts[0] == "info"
+                        and len(parts) <= 3
+                        and info_name in INFO_FILES
+                    ):
+                        with open(os.path.join(info_dir, info_name), "wb") as out:
+                            out.write(tar.extractfile(tarinfo).read())  # type: ignore
+
+            for proc in (decompress, extract):
+                if proc.wait():
+                    raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+        info = {
+            f: os.path.join(info_dir, f)
+            for f in INFO_FILES
+            if os.path.exists(os.path.join(info_dir, f))
+        }
+
+        fixed_prefix = None
+        if "coex_prefix.json" in info:
+            with open(info["coex_prefix.json"]) as coex_prefix:
+                fixed_prefix = json.load(coex_prefix)["prefix"]
+            # Files rewritten if installed at a prefix other than the fixed prefix
+            prefix_files = read_coex_prefix(info["coex_prefix.json"], "")
+        elif "paths.json" in info:
+            prefix_files = read_paths_json(info["paths.json"])
+        elif "has_prefix" in info:
+            prefix_files = read_has_prefix(info["has_prefix"])
+        else:
+            prefix_files = {}
+
+        noarch = None
+        if "index.json" in info:
+            with open(info["index.json"]) as index:
+                noarch = json.load(index).get("noarch")
+
+    return MemberStats(
+        name=name,
+        compressed_size=compressed_size,
+        uncompressed_size=sum(sizes.values()),
+        file_count=len(sizes),
+        prefix_files=len(prefix_files),
+        prefix_bytes=sum(sizes.get(f, 0) for f in prefix_files),
+        noarch=noarch,
+        fixed_prefix=fixed_prefix,
+        compression=(member or {}).get("compression"),
+        chunks=len(chunks),
+    )
+
+
+def archive_stats(archive: Path, binaries: COEXBootstrapBinaries) -> List[MemberStats]:
+    """Stats of all package and source members of archive."""
+    config = COEXBootstrapConfig.read_archive(str(archive))
+    with zipfile.ZipFile(str(archive)) as zf:
+        names = [
+            i.filename
+            for i in zf.infolist()
+            if i.filename.startswith(("pkgs/", "srcs/")) and not i.is_dir()
+        ]
+
+    return [
+        member_stats(archive, name, binaries, config.members.get(name))
+        for name in names
+    ]
+
+
+def _sample_data(size: int) -> bytes:
+    """Partially compressible sample data, similar to typical package files."""
+    block = os.urandom(1 << 12) + prefix_placeholder.encode("utf-8") * 128
+    return (block * (size // len(block) + 1))[:size]
+
+
+def _timed_extract(
+    work_dir: Path, files: dict, binaries: COEXBootstrapBinaries
+) -> float:
+    """Time bootstrap extraction of a package containing files."""
+    src_dir = work_dir / "src"
+    src_dir.mkdir()
+    for name, data in files.items():
+        (src_dir / name).write_bytes(data)
+
+    archive = work_dir / "sample.coex"
+    subprocess.check_call(
+        [binaries.tar, "--use-compress-program", binaries.zstd]
+        + ["-f", str(work_dir / "sample.tar.zst"), "-C", str(src_dir), "-c"]
+        + sorted(files)
+    )
+    with zipfile.ZipFile(str(archive), "w") as zf:
+        zf.write(str(work_dir / "sample.tar.zst"), "pkgs/sample.tar.zst")
+
+    prefix_dir = work_dir / "prefix"
+    prefix_dir.mkdir()
+    start = time.perf_counter()
+    ZipPkgHandle(str(archive), "pkgs/sample.tar.zst").extract(binaries, str(prefix_dir))
+    return time.perf_counter() - start
+
+
+def _timed_relocate(prefix_dir: Path, files: List[str]) -> float:
+    """Time bootstrap prefix updates of files."""
+    start = time.perf_counter()
+    if len(files) == 1:
+        update_prefix(
+            str(prefix_dir / files[0]), "/tmp/coex", prefix_placeholder, "text"
+        )
+    else:
+        update_prefixes(
+            str(prefix_dir), {f: (prefix_placeholder, "text") for f in files}
+        )
+    return time.perf_counter() - start
+
+
+def calibrate(
+    work_dir: Path,
+    binaries: COEXBootstrapBinaries,
+    sample_size: int = 1 << 25,
+    sample_files: int = 1000,
+) -> Calibration:
+    """Calibrate throughput of the local bootstrap extract and install code.
+
+    Times extraction, and prefix updates, of a single large file and of many
+    small files to derive per-byte and per-file costs.
+
+    Args:
+        work_dir: Scratch directory.
+        binaries: Local coex bootstrap binaries.
+        sample_size: Size of large sample file.
+        sample_files: Number of small sample files.
+
+    Returns:
+        Calibrated throughput.
+
+    """
+    small_size = 1 << 12
+    large_dir = Path(tempfile.mkdtemp(dir=str(work_dir)))
+    small_dir = Path(tempfile.mkdtemp(dir=str(work_dir)))
+
+    large_extract = _timed_extract(
+        large_dir, {"large": _sample_data(sample_size)}, binaries
+    )
+    small_files = {f"small_{i}": _sample_data(small_size) for i in range(sample_files)}
+    small_extract = _timed_extract(small_dir, small_files, binaries)
+
+    large_relocate = _timed_relocate(large_dir / "prefix", ["large"])
+    small_relocate = _timed_relocate(small_dir / "prefix", sorted(small_files))
+
+    extract_bytes_per_s = sample_size / large_extract
+    relocate_bytes_per_s = sample_size / large_relocate
+    small_bytes = small_size * sample_files
+
+    calibration = Calibration(
+        extract_bytes_per_s=extract_bytes_per_s,
+        extract_s_per_file=max(small_extract - small_bytes / extract_bytes_per_s, 0.0)
+        / sample_files,
+        relocate_bytes_per_s=relocate_bytes_per_s,
+        relocate_s_per_file=max(
+            small_relocate - small_bytes / relocate_bytes_per_s, 0.0
+        )
+        / sample_files,
+    )
+    logger.info("calibrate %s", calibration)
+
+    return calibration
+
+
+def concurrent_s(member_s: List[float], workers: int) -> float:
+    """Lower bound of the wall time of members installed workers at a time.
+
+    The install takes at least as long as its largest member, and as its
+    summed member times spread evenly over the workers.
+
+    """
+    return max(max(member_s, default=0.0), sum(member_s) / max(workers, 1))
+
+
+def analyze(
+    archive: Path,
+    work_dir: Optional[Path] = None,
+    calibrated: bool = True,
+    concurrency: Optional[int] = None,
+) -> dict:
+    """Analyze archive contents and predict startup cost.
+
+    Args:
+        archive: coex archive.
+        work_dir: Scratch directory for calibration.
+        calibrated: Calibrate, and predict, extraction and relocation times.
+        concurrency: Thread budget of the bootstrap, defaults to cpu count.
+
+    Returns:
+        Json-compatible analysis, with predicted times if calibrated.
+
+    """
+    binaries = COEXBootstrapBinaries(**COEXBootstrapBinaries.resolve())
+    members = archive_stats(archive, binaries)
+
+    with zipfile.ZipFile(str(archive)) as zf:
+        config = json.loads(zf.read("coex_bootstrap.json").decode("utf-8"))
+
+    result = dict(
+        archive=str(archive),
+        size=archive.stat().st_size,
+        config=config,
+        members=[dict(attr.asdict(m), ratio=m.ratio) for m in members],
+        calibration=None,
+        predicted=None,
+    )
+
+    if calibrated:
+        assert work_dir
+        calibration = calibrate(work_dir, binaries)
+        # Members are installed as the bootstrap does, workers at a time with
+        # the thread budget split between them, see split_threads
+        workers, threads = split_threads(concurrency, len(members))
+        for m, mdict in zip(members, result["members"]):
+            mdict["extract_s"] = calibration.extract_s(m, threads)
+            mdict["relocate_s"] = 0.0 if m.fixed_prefix else calibration.relocate_s(m)
+
+        extract_s = sum(m["extract_s"] for m in result["members"])
+        relocate_s = sum(m["relocate_s"] for m in result["members"])
+        fallback_relocate_s = sum(calibration.relocate_s(m) for m in members)
+        result["calibration"] = attr.asdict(calibration)
+        result["predicted"] = dict(
+            workers=workers,
+            threads=threads,
+            # Summed member times, the startup time of a serial install
+            extract_s=extract_s,
+            relocate_s=relocate_s,
+            # Prefix updates are required if the fixed prefix is unavailable
+            fallback_relocate_s=fallback_relocate_s,
+            total_s=concurrent_s(
+                [m["extract_s"] + m["relocate_s"] for m in result["members"]],
+                workers,
+            ),
+        )
+
+    return result
+
+
+def _format_compression(compression: Optional[dict]) -> str:
+    if not compression:
+        return ""
+    return str(compression["level"]) + (
+        f" long={compression['long']}" if compression.get("long") else ""
+    )
+
+
+def format_table(analysis: dict) -> str:
+    """Format analysis as a text table."""
+    calibrated = analysis["predicted"] is not None
+    header = ["member", "size", "unpacked", "ratio", "zstd", "files", "prefix"]
+    header += ["rewrite"]
+    header += ["noarch"] + (["extract", "relocate"] if calibrated else [])
+
+    def row(m):
+        cells = [
+            m["name"],
+            format_size(m["compressed_size"]),
+            format_size(m["uncompressed_size"]),
+            f"{m['ratio']:.2f}",
+            _format_compression(m["compression"]),
+            str(m["file_count"]),
+            str(m["prefix_files"]) + ("*" if m["fixed_prefix"] else ""),
+            format_size(m["prefix_bytes"]),
+            m["noarch"] or "",
+        ]
+        if calibrated:
+            cells += [f"{m['extract_s']:.3f}s", f"{m['relocate_s']:.3f}s"]
+        return cells
+
+    members = analysis["members"]
+    totals = dict(
+        name="total",
+        compressed_size=sum(m["compressed_size"] for m in members),
+        uncompressed_size=sum(m["uncompressed_size"] for m in members),
+        file_count=sum(m["file_count"] for m in members),
+        prefix_files=sum(m["prefix_files"] for m in members),
+        prefix_bytes=sum(m["prefix_bytes"] for m in members),
+        noarch=None,
+        fixed_prefix=None,
+        compression=None,
+    )
+    totals["ratio"] = totals["uncompressed_size"] / max(totals["compressed_size"], 1)
+    if calibrated:
+        totals["extract_s"] = analysis["predicted"]["extract_s"]
+        totals["relocate_s"] = analysis["predicted"]["relocate_s"]
+
+    rows = [header] + [row(m) for m in members] + [row(totals)]
+    widths = [max(len(r[i]) for r in rows) for i in range(len(header))]
+    lines = [
+        "  ".join(
+            c.ljust(w) if i == 0 else c.rjust(w)
+            for i, (c, w) in enumerate(zip(r, widths))
+        )
+        for r in rows
+    ]
+
+    lines += ["", f"archive: {analysis['archive']} {format_size(analysis['size'])}"]
+    if any(m["fixed_prefix"] for m in members):
+        lines += ["* relocated at build time, prefix updates skipped at fixed prefix"]
+    if calibrated:
+        predicted = analysis["predicted"]
+        lines += [
+            f"predicted startup: {predicted['total_s']:.3f}s "
+            f"(extract {predicted['extract_s']:.3f}s, "
+            f"relocate {predicted['relocate_s']:.3f}s, "
+            f"on {predicted['workers']}x{predicted['threads']} threads)"
+        ]
+
+    return "\n".join(lines)
@@ -0,0 +1,245 @@
+"""Streaming assembly of executable .coex archives."""
+
+import fnmatch
+import logging
+import os
+import queue
+import stat
+import struct
+import tempfile
+import threading
+import time
+import zipfile
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+from coex.compress import source_date_epoch
+from coex_bootstrap.verify import member_hash
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1 << 20
+READ_AHEAD = 8
+
+# Extra field id of local header padding, as used by Android's zipalign
+ALIGN_EXTRA_ID = 0xD935
+
+# Earliest zip timestamp, of members in archives built without SOURCE_DATE_EPOCH
+ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+
+
+def zip_date_time() -> Tuple[int, ...]:
+    """Member timestamp, from SOURCE_DATE_EPOCH if set."""
+    epoch = source_date_epoch()
+    if epoch is None:
+        return ZIP_EPOCH
+    return max(ZIP_EPOCH, time.gmtime(epoch)[:6])
+
+
+def read_ahead(path: Path, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """Iterate file blocks, read by a background thread up to READ_AHEAD blocks.
+
+    Overlaps file reads with processing, crc computation and output writes,
+    of the consumed blocks.
+    """
+    blocks: queue.Queue = queue.Queue(READ_AHEAD)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def reader():
+        try:
+            with open(str(path), "rb") as inf:
+                for block in iter(lambda: inf.read(chunk_size), b""):
+                    if not put(block):
+                        return
+            put(None)
+        except BaseException as ex:
+            put(ex)
+
+    thread = threading.Thread(target=reader, name=f"read_ahead:{path}", daemon=True)
+    thread.start()
+    try:
+        while True:
+            block = blocks.get()
+            if block is None:
+                return
+            elif isinstance(block, BaseException):
+                raise block
+            yield block
+    finally:
+        stop.set()
+        thread.join()
+
+
+class ArchiveWriter:
+    """Writer for executable .coex archives.
+
+    Members are streamed directly from their source files into the output
+    zip in a single pass, and the archive is moved to the output path when
+    successfully completed. Member timestamps and permissions are normalized,
+    so that archives of the same members are byte-identical. Member hashes,
+    see coex_bootstrap.verify, are computed as members are written.
+
+    With replace_from, the existing output archive is updated in place,
+    truncating the archive at member replace_from, which with all following
+    members is replaced by the written members. Members are rewritten at the
+    same offsets, so the updated archive is identical to a full rebuild. An
+    interrupted update leaves the archive unreadable, until the next update.
+    """
+
+    def __init__(
+        self,
+        output: Path,
+        interpreter: str = "/usr/bin/env python",
+        replace_from: Optional[str] = None,
+    ):
+        """Init writer over output path.
+
+        Args:
+            output: Output .coex path.
+            interpreter: Archive shebang interpreter.
+            replace_from: First replaced member, updating output in place.
+
+        """
+        self.output = Path(output)
+        self.interpreter = interpreter
+        self.replace_from = replace_from
+        self._tmp_output: Optional[Path] = None
+        self._zip: Optional[zipfile.ZipFile] = None
+        self.date_time = zip_date_time()
+        self.digests: Dict[str, str] = {}
+
+    def _open_replace(self, replace_from: str) -> None:
+        self._fp = open(str(self.output), "r+b")
+        try:
+            self._zip = zipfile.ZipFile(self._fp, "a")
+            offset = self._zip.getinfo(replace_from).header_offset
+        except (KeyError, zipfile.BadZipFile) as ex:
+            self._fp.close()
+            raise ValueError(f"unable to update {self.output} in place: {ex}")
+
+        # Drop the replaced tail, writing members from its offset
+        kept = [i for i in self._zip.filelist if i.header_offset < offset]
+        self._zip.filelist = kept
+        self._zip.NameToInfo = {i.filename: i for i in kept}
+        self._zip.start_dir = offset
+        self._zip._didModify = True  # type: ignore
+
+    def __enter__(self) -> "ArchiveWriter":  # noqa: D
+        if self.replace_from is not None:
+            self._open_replace(self.replace_from)
+            return self
+
+        fd, tmp_output = tempfile.mkstemp(
+            prefix=f".{self.output.name}.", dir=str(self.output.parent.absolute())
+        )
+        self._tmp_output = Path(tmp_output)
+        self._fp = os.fdopen(fd, "wb")
+        self._fp.write(b"#!" + self.interpreter.encode("utf-8") + b"\n")
+        self._zip = zipfile.ZipFile(self._fp, "w")
+        return self
+
+    def __exit__(self, exc_type, exc, tb):  # noqa: D
+        assert self._zip
+        if self.replace_from is not None:
+            with self._fp:
+                self._zip.close()
+                self._fp.truncate()
+            return
+
+        assert self._tmp_output
+        try:
+            self._zip.close()
+            self._fp.close()
+            if exc_type is None:
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(str(self._tmp_output), (0o666 & ~umask) | stat.S_IEXEC)
+                self._tmp_output.rename(self.output)
+        finally:
+            if self._tmp_output.exists():
+                self._tmp_output.unlink()
+
+    def _zinfo(self, arcname: str, executable: bool = False) -> zipfile.ZipInfo:
+        zinfo = zipfile.ZipInfo(arcname, self.date_time)
+        zinfo.compress_type = zipfile.ZIP_STORED
+        zinfo.external_attr = (stat.S_IFREG | (0o755 if executable else 0o644)) << 16
+        return zinfo
+
+    def add(self, path: Path, arcname: str, align: Optional[int] = None) -> int:
+        """Stream file at path into archive member arcname.
+
+        Args:
+            path: Source file.
+            arcname: Archive member name.
+            align: Align the member data at a multiple of align bytes in the
+                archive file, padding the member's local header.
+
+        Returns:
+            Offset of the stored member data in the archive file.
+
+        """
+        assert self._zip
+        logger.debug("add path=%s arcname=%s align=%s", path, arcname, align)
+
+        st = os.stat(str(path))
+        zinfo = self._zinfo(arcname, bool(st.st_mode & stat.S_IXUSR))
+        zinfo.file_size = st.st_size
+        zip64 = st.st_size * 1.05 > zipfile.ZIP64_LIMIT
+
+        # Local header, name and extra fields precede the data
+        header_size = 30 + len(arcname.encode("utf-8")) + (20 if zip64 else 0)
+        if align:
+            pad = -(self._zip.start_dir + header_size + 4) % align
+            zinfo.extra = struct.pack("<HH", ALIGN_EXTRA_ID, pad) + b"\0" * pad
+
+        offset = self._zip.start_dir + header_size + len(zinfo.extra)
+        digest = member_hash()
+        with self._zip.open(zinfo, "w", force_zip64=zip64) as member:
+            for block in read_ahead(path):
+                digest.update(block)
+                member.write(block)
+        self.digests[arcname] = digest.hexdigest()
+
+        # Padding is only needed in the local header
+        zinfo.extra = b""
+        return offset
+
+    def add_tree(
+        self, path: Path, arcname: str, ignore: Iterable[str] = ("*.pyc",)
+    ) -> None:
+        """Add all files under path, skipping any path component matching ignore.
+
+        Args:
+            path: Source directory.
+            arcname: Archive directory.
+            ignore: fnmatch patterns of ignored files or directories.
+
+        """
+        for source in sorted(Path(path).rglob("*")):
+            relpath = source.relative_to(path)
+            if source.is_dir() or any(
+                fnmatch.fnmatch(part, pattern)
+                for part in relpath.parts
+                for pattern in ignore
+            ):
+                continue
+            self.add(source, f"{arcname}/{relpath.as_posix()}")
+
+    def writestr(self, arcname: str, data: bytes) -> None:
+        """Write data into archive member arcname."""
+        assert self._zip
+        logger.debug("writestr arcname=%s", arcname)
+
+        self._zip.writestr(self._zinfo(arcname), data)
+        digest = member_hash()
+        digest.update(data)
+        self.digests[arcname] = digest.hexdigest()
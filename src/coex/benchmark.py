@@ -0,0 +1,353 @@
+"""Offline benchmark of coex builds, over a local synthetic conda channel.
+
+Generates a file:// channel of synthetic packages, of configurable count,
+size, small file ratio and prefix files, and times `coex create` builds of an
+env of all the channel's packages. Build stages, the pkg_env solve, fetch and
+extract, repack and activation, and the sources and archive assembly, are
+timed through the create command itself.
+
+Each run builds with an empty build cache and conda package cache, "cold",
+and then rebuilds from the run's caches, "warm". Results are written as json
+with sorted keys and a fixed schema, for comparison across commits.
+"""
+
+import bz2
+import contextlib
+import hashlib
+import importlib
+import io
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import tarfile
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List
+
+import attr
+from conda.base.context import reset_context
+
+from coex_bootstrap.install import prefix_placeholder
+
+logger = logging.getLogger(__name__)
+
+# Version of the results json schema
+SCHEMA = 1
+
+SMALL_FILE_SIZE = 1 << 10
+LARGE_FILE_SIZE = 1 << 20
+
+# Timed stages, by module and function called by create
+STAGES = {
+    "solve": ("coex.pkg_env", "solve"),
+    "fetch": ("coex.pkg_env", "fetch"),
+    "repack": ("coex.pkg_env", "repack"),
+    "activation": ("coex.pkg_env", "activation"),
+    "sources": ("coex.cli", "pkg_src"),
+    "archive": ("coex.cli", "write_coex"),
+}
+
+
+@attr.s(auto_attribs=True, frozen=True)
+class ChannelSpec:
+    """Synthetic channel parameters.
+
+    Attributes:
+        packages: Package count.
+        package_size: Payload bytes per package.
+        small_file_ratio: Fraction of payload bytes in SMALL_FILE_SIZE files,
+            the remainder is in files of up to LARGE_FILE_SIZE.
+        prefix_files: Text files per package with an install prefix
+            placeholder, relocated on install.
+        seed: Random seed of the package contents.
+
+    """
+
+    packages: int = 20
+    package_size: int = 4 << 20
+    small_file_ratio: float = 0.25
+    prefix_files: int = 4
+    seed: int = 0
+
+    def package_names(self) -> List[str]:
+        """Names of the channel's packages."""
+        return [f"coex-bench-{i:04d}" for i in range(self.packages)]
+
+
+def _payload(rand: random.Random, size: int) -> bytes:
+    # Half random, half zero bytes, compressing about 2:1 as binaries do
+    half = size // 2
+    noise = rand.getrandbits(half * 8).to_bytes(half, "little") if half else b""
+    return noise + b"\0" * (size - half)
+
+
+def _package_files(spec: ChannelSpec, name: str) -> Dict[str, bytes]:
+    rand = random.Random(f"{spec.seed}:{name}")
+    files = {}
+
+    small_files = int(spec.package_size * spec.small_file_ratio) // SMALL_FILE_SIZE
+    for i in range(small_files):
+        files[f"lib/{name}/small/{i:05d}.py"] = _payload(rand, SMALL_FILE_SIZE)
+
+    remaining = spec.package_size - small_files * SMALL_FILE_SIZE
+    i = 0
+    while remaining > 0:
+        size = min(remaining, LARGE_FILE_SIZE)
+        files[f"lib/{name}/data/{i:04d}.bin"] = _payload(rand, size)
+        remaining -= size
+        i += 1
+
+    for i in range(spec.prefix_files):
+        files[f"bin/{name}-{i}"] = f"#!{prefix_placeholder}/bin/sh\n".encode()
+    return files
+
+
+def _package(spec: ChannelSpec, name: str) -> bytes:
+    files = _package_files(spec, name)
+    prefix_paths = [p for p in files if p.startswith("bin/")]
+    info = {
+        "info/index.json": json.dumps(
+            {
+                "name": name,
+                "version": "1.0",
+                "build": "0",
+                "build_number": 0,
+                "depends": [],
+                "subdir": "noarch",
+            }
+        ).encode(),
+        "info/files": "".join(f"{p}\n" for p in sorted(files)).encode(),
+        "info/has_prefix": "".join(
+            f"{prefix_placeholder} text {p}\n" for p in prefix_paths
+        ).encode(),
+        "info/paths.json": json.dumps(
+            {
+                "paths_version": 1,
+                "paths": [
+                    dict(
+                        _path=p,
+                        path_type="hardlink",
+                        sha256=hashlib.sha256(files[p]).hexdigest(),
+                        size_in_bytes=len(files[p]),
+                        **(
+                            dict(
+                                file_mode="text", prefix_placeholder=prefix_placeholder
+                            )
+                            if p in prefix_paths
+                            else {}
+                        ),
+                    )
+                    for p in sorted(files)
+                ],
+            }
+        ).encode(),
+    }
+
+    out = io.BytesIO()
+    with bz2.BZ2File(out, "wb", compresslevel=1) as bz:
+        with tarfile.open(fileobj=bz, mode="w", format=tarfile.PAX_FORMAT) as tar:
+            for path, data in sorted({**files, **info}.items()):
+                tarinfo = tarfile.TarInfo(path)
+                tarinfo.size = len(data)
+                tarinfo.mode = 0o755 if path.startswith("bin/") else 0o644
+                tar.addfile(tarinfo, io.BytesIO(data))
+    return out.getvalue()
+
+
+def write_channel(channel_dir: Path, spec: ChannelSpec) -> None:
+    """Write synthetic channel of spec to channel_dir, reusing an existing one.
+
+    Packages are noarch, and the channel holds an empty repodata of the native
+    subdir, as conda requires.
+    """
+    spec_json = json.dumps(attr.asdict(spec), sort_keys=True)
+    if (channel_dir / "spec.json").exists():
+        if (channel_dir / "spec.json").read_text() == spec_json:
+            logger.info("reuse channel %s", channel_dir)
+            return
+        shutil.rmtree(str(channel_dir))
+
+    logger.info("write_channel %s %s", channel_dir, spec)
+    (channel_dir / "noarch").mkdir(parents=True)
+    packages = {}
+    for name in spec.package_names():
+        data = _package(spec, name)
+        fn = f"{name}-1.0-0.tar.bz2"
+        (channel_dir / "noarch" / fn).write_bytes(data)
+        packages[fn] = {
+            "name": name,
+            "version": "1.0",
+            "build": "0",
+            "build_number": 0,
+            "depends": [],
+            "subdir": "noarch",
+            "md5": hashlib.md5(data).hexdigest(),
+            "sha256": hashlib.sha256(data).hexdigest(),
+            "size": len(data),
+        }
+
+    from conda.base.context import context
+
+    for subdir, subdir_packages in (("noarch", packages), (context.subdir, {})):
+        (channel_dir / subdir).mkdir(exist_ok=True)
+        (channel_dir / subdir / "repodata.json").write_text(
+            json.dumps(
+                {"info": {"subdir": subdir}, "packages": subdir_packages},
+                sort_keys=True,
+            )
+        )
+    (channel_dir / "spec.json").write_text(spec_json)
+
+
+@contextlib.contextmanager
+def timed_stages(times: Dict[str, float]) -> Iterator[None]:
+    """Accumulate STAGES call times into times, by stage, within the context."""
+
+    def timer(stage, func):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                times[stage] = times.get(stage, 0.0) + time.perf_counter() - start
+
+        return timed
+
+    modules = {stage: importlib.import_module(m) for stage, (m, _) in STAGES.items()}
+    originals = {
+        stage: getattr(modules[stage], name) for stage, (_, name) in STAGES.items()
+    }
+    try:
+        for stage, (_, name) in STAGES.items():
+            setattr(modules[stage], name, timer(stage, originals[stage]))
+        yield
+    finally:
+        for stage, (_, name) in STAGES.items():
+            setattr(modules[stage], name, originals[stage])
+
+
+@contextlib.contextmanager
+def conda_pkgs_dir(pkgs_dir: Path) -> Iterator[None]:
+    """Use pkgs_dir as the conda package cache within the context."""
+    previous = os.environ.get("CONDA_PKGS_DIRS")
+    os.environ["CONDA_PKGS_DIRS"] = str(pkgs_dir)
+    reset_context()
+    try:
+        yield
+    finally:
+        if previous is None:
+            del os.environ["CONDA_PKGS_DIRS"]
+        else:
+            os.environ["CONDA_PKGS_DIRS"] = previous
+        reset_context()
+
+
+def run_create(run_dir: Path, env_file: Path, create_args: List[str]) -> dict:
+    """Time a coex create build of env_file, with the caches under run_dir.
+
+    Returns:
+        Run result, {"sections": {stage: seconds, "total": seconds},
+        "archive_size": bytes}.
+
+    """
+    # coex.cli imports this module, for the benchmark command
+    from coex.cli import cli
+
+    app_dir = run_dir / "app"
+    app_dir.mkdir(parents=True, exist_ok=True)
+    (app_dir / "run.sh").write_text("#!/bin/sh\nexec true\n")
+    output = run_dir / "bench.coex"
+
+    times: Dict[str, float] = {}
+    args = ["--cache", str(run_dir / "cache"), "create", "-f", str(env_file)]
+    args += ["--entrypoint", "app/run.sh", "-o", str(output)] + create_args
+    cwd = os.getcwd()
+    with conda_pkgs_dir(run_dir / "pkgs"), timed_stages(times):
+        os.chdir(str(run_dir))
+        start = time.perf_counter()
+        try:
+            cli.main(args + ["app"], standalone_mode=False)
+        finally:
+            os.chdir(cwd)
+        times["total"] = time.perf_counter() - start
+
+    return {
+        "sections": {k: round(v, 6) for k, v in sorted(times.items())},
+        "archive_size": output.stat().st_size,
+    }
+
+
+def summarize_runs(runs: List[dict]) -> Dict[str, Dict[str, dict]]:
+    """Min and median section times of runs, by cache state."""
+    times: Dict[str, Dict[str, List[float]]] = {}
+    for run in runs:
+        for section, elapsed in run["sections"].items():
+            times.setdefault(run["cache"], {}).setdefault(section, []).append(elapsed)
+    return {
+        state: {
+            section: dict(
+                min=round(min(values), 6),
+                median=round(statistics.median(values), 6),
+            )
+            for section, values in sorted(sections.items())
+        }
+        for state, sections in sorted(times.items())
+    }
+
+
+def benchmark(
+    work_dir: Path, spec: ChannelSpec, repeat: int = 3, create_args: List[str] = ()
+) -> dict:
+    """Benchmark coex create over a synthetic channel of spec.
+
+    Args:
+        work_dir: Benchmark directory, holding the channel, reused between
+            benchmarks of the same spec, and the run caches.
+        spec: Synthetic channel spec.
+        repeat: Cold and warm build pairs.
+        create_args: Additional create options, eg. compression.
+
+    Returns:
+        Results, {"schema", "spec", "host", "create_args", "runs", "summary"}.
+
+    """
+    channel_dir = work_dir / "channel"
+    write_channel(channel_dir, spec)
+
+    env_file = work_dir / "environment.yml"
+    env_file.write_text(
+        json.dumps(
+            {
+                "channels": [channel_dir.absolute().as_uri(), "nodefaults"],
+                "dependencies": spec.package_names(),
+            }
+        )
+    )
+
+    runs = []
+    for i in range(repeat):
+        run_dir = work_dir / "runs" / f"{i:02d}"
+        if run_dir.exists():
+            shutil.rmtree(str(run_dir))
+        for state in ("cold", "warm"):
+            logger.info("benchmark run=%i cache=%s", i, state)
+            run = run_create(run_dir, env_file, list(create_args))
+            runs.append(dict(run, cache=state))
+        shutil.rmtree(str(run_dir))
+
+    return {
+        "schema": SCHEMA,
+        "spec": attr.asdict(spec),
+        "host": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "create_args": list(create_args),
+        "runs": runs,
+        "summary": summarize_runs(runs),
+    }
@@ -0,0 +1,455 @@
+"""Build cache management.
+
+Cache entries, the repacked packages under `pkgs/` and source archives under
+`srcs/`, have a `<entry>.json` metadata sidecar recording the entry hash and
+size. The sidecar mtime is updated on each use, so that cache eviction is
+least-recently-used without reading entries or relying on filesystem atime.
+
+Builds hold a `BuildLease`, a locked `build_*` directory listing the entries
+pinned by the build. Garbage collection never evicts entries pinned by an
+active build, and removes build directories left by finished builds.
+
+The cache may be shared by concurrent builds, on one or many hosts over a
+shared filesystem. Entries are written to a temporary file and renamed into
+place by a single writer, holding the entry's advisory lock, while other
+builds of the entry wait, and are checked against their metadata on read.
+"""
+
+import contextlib
+import datetime
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Set
+
+import attr
+
+logger = logging.getLogger(__name__)
+
+ENTRY_DIRS = ("pkgs", "srcs")
+CHUNK_SIZE = 1 << 20
+
+_size_units = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+_age_units = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60, "w": 7 * 24 * 60 * 60}
+
+# Process locks of entries, by path, see entry_lock
+_thread_locks: Dict[str, threading.Lock] = {}
+_thread_locks_lock = threading.Lock()
+
+
+def parse_size(value: str) -> int:
+    """Parse byte size with optional K, M, G or T binary suffix, eg. '50G'.
+
+    Raises:
+        ValueError: Invalid size.
+
+    """
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([KMGT]?)B?", value.strip().upper())
+    if not match:
+        raise ValueError(f"invalid size: {value!r}")
+    return int(float(match.group(1)) * _size_units[match.group(2)])
+
+
+def parse_age(value: str) -> float:
+    """Parse age in seconds with s, m, h, d or w suffix, eg. '30d'.
+
+    Raises:
+        ValueError: Invalid age.
+
+    """
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([smhdw])", value.strip().lower())
+    if not match:
+        raise ValueError(f"invalid age: {value!r}")
+    return float(match.group(1)) * _age_units[match.group(2)]
+
+
+def file_sha256(path: Path) -> str:
+    """Hex sha256 of file contents."""
+    digest = hashlib.sha256()
+    with open(str(path), "rb") as inf:
+        for block in iter(lambda: inf.read(CHUNK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def meta_path(path: Path) -> Path:
+    """Metadata sidecar path of cache entry."""
+    return path.with_name(path.name + ".json")
+
+
+def lock_path(path: Path) -> Path:
+    """Advisory lock file path of cache entry, see entry_lock."""
+    return path.with_name(f".{path.name}.lock")
+
+
+def record(path: Path, **extra) -> dict:
+    """Record metadata of a new cache entry, marking the entry as accessed.
+
+    The entry's inode and mtime are recorded with its hash and size, so that
+    the unchanged entry is checked on read without rehashing, see check.
+
+    Args:
+        path: Cache entry.
+        extra: Additional metadata, eg. the entry's compression parameters.
+
+    """
+    st = path.stat()
+    meta = dict(
+        sha256=file_sha256(path),
+        size=st.st_size,
+        ino=st.st_ino,
+        mtime_ns=st.st_mtime_ns,
+        created=time.time(),
+    )
+    meta.update(extra)
+
+    fd, tmp_path = tempfile.mkstemp(prefix=".tmp_", dir=str(path.parent))
+    with os.fdopen(fd, "w") as meta_out:
+        json.dump(meta, meta_out, indent=2)
+    os.rename(tmp_path, str(meta_path(path)))
+
+    return meta
+
+
+def touch(path: Path) -> None:
+    """Mark cache entry as accessed, recording metadata if not present."""
+    try:
+        os.utime(str(meta_path(path)))
+    except FileNotFoundError:
+        record(path)
+
+
+def read_meta(path: Path) -> Optional[dict]:
+    """Read metadata of cache entry, None if not recorded."""
+    try:
+        with open(str(meta_path(path))) as meta_in:
+            return json.load(meta_in)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def check(path: Path) -> bool:
+    """Check cache entry against its recorded metadata, before reuse.
+
+    Entries are renamed into place once written, so an entry with its recorded
+    size, inode and mtime is complete. Otherwise, eg. an entry copied between
+    caches, its sha256 is checked.
+
+    Returns:
+        If the entry exists and matches its metadata, False if unrecorded.
+
+    """
+    meta = read_meta(path)
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return False
+    if meta is None or st.st_size != meta.get("size"):
+        return False
+    if (st.st_ino, st.st_mtime_ns) == (meta.get("ino"), meta.get("mtime_ns")):
+        return True
+
+    logger.info("check rehash %s", path)
+    return file_sha256(path) == meta.get("sha256")
+
+
+@contextlib.contextmanager
+def entry_lock(path: Path) -> Iterator[None]:
+    """Hold the exclusive advisory lock of cache entry, while writing it.
+
+    Builds check the entry again once locked, reusing the entry if written
+    by another build while waiting. fcntl.lockf locks are held across hosts
+    on NFS, but are per process, so threads also hold a process lock of the
+    entry.
+    """
+    with _thread_locks_lock:
+        thread_lock = _thread_locks.setdefault(str(path), threading.Lock())
+
+    with thread_lock, open(str(lock_path(path)), "a") as lock:
+        logger.debug("entry_lock %s", path)
+        fcntl.lockf(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.lockf(lock, fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def new_entry(path: Path) -> Iterator[Path]:
+    """Temporary path of new cache entry, renamed to path once written."""
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=".tmp_", suffix=".tar.zst", dir=str(path.parent)
+    )
+    os.close(fd)
+    try:
+        yield Path(tmp_path)
+        os.rename(tmp_path, str(path))
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+@contextlib.contextmanager
+def cache_lock(cache_dir: Path, exclusive: bool) -> Iterator[None]:
+    """Hold cache-wide lock, shared for pinning entries, exclusive for gc."""
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    with open(str(cache_dir / ".lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class BuildLease:
+    """Locked build directory in the cache, pinning the cache entries in use.
+
+    The lease is held for the lifetime of a build, the build directory is
+    removed on exit if cleanup, otherwise left for garbage collection.
+    """
+
+    def __init__(self, cache_dir: Path, cleanup: bool = True):
+        """Init lease over cache_dir.
+
+        Args:
+            cache_dir: Coex build cache directory.
+            cleanup: Remove build directory on exit.
+
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cleanup = cleanup
+        self.build_dir: Optional[Path] = None
+        self._lock = None
+
+    def __enter__(self) -> "BuildLease":  # noqa: D
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.build_dir = Path(
+            tempfile.mkdtemp(prefix="build_", dir=str(self.cache_dir))
+        )
+        self._lock = open(str(self.build_dir / "lock"), "a")
+        fcntl.flock(self._lock, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):  # noqa: D
+        assert self._lock and self.build_dir
+        try:
+            if self.cleanup:
+                shutil.rmtree(str(self.build_dir))
+        finally:
+            fcntl.flock(self._lock, fcntl.LOCK_UN)
+            self._lock.close()
+            self._lock = None
+
+    def pin(self, path: Path) -> None:
+        """Pin cache entry, which may not yet exist, for the lease lifetime."""
+        assert self.build_dir
+        with cache_lock(self.cache_dir, exclusive=False):
+            with open(str(self.build_dir / "pins"), "a") as pins:
+                pins.write(str(Path(path).absolute()) + "\n")
+
+
+def build_active(build_dir: Path) -> bool:
+    """Check if build directory lease is held by an active build."""
+    try:
+        lock = open(str(build_dir / "lock"), "r")
+    except FileNotFoundError:
+        # Lease may be in creation, consider recent build dirs active
+        return time.time() - build_dir.stat().st_mtime < 60 * 60
+
+    with lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError as ex:
+            if ex.errno in (errno.EAGAIN, errno.EACCES):
+                return True
+            raise
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        return False
+
+
+def read_pins(build_dir: Path) -> Set[Path]:
+    """Cache entries pinned by a build directory lease."""
+    try:
+        with open(str(build_dir / "pins")) as pins:
+            return {Path(line.strip()) for line in pins if line.strip()}
+    except FileNotFoundError:
+        return set()
+
+
+def tree_size(path: Path) -> int:
+    """Total size of files under path."""
+    if not path.is_dir() or path.is_symlink():
+        return path.lstat().st_size
+    return sum(
+        os.lstat(os.path.join(dirpath, f)).st_size
+        for dirpath, _, filenames in os.walk(str(path))
+        for f in filenames
+    )
+
+
+@attr.s(auto_attribs=True)
+class CacheEntry:
+    """Cache entry, package or source archive, or build directory."""
+
+    kind: str
+    path: Path
+    size: int
+    # Last access time, seconds since epoch
+    accessed: float
+    active: bool = False
+
+    @property
+    def age(self) -> float:
+        """Seconds since last access."""
+        return time.time() - self.accessed
+
+
+def scan(cache_dir: Path) -> List[CacheEntry]:
+    """Scan cache entries and build directories, excluding temporary files."""
+    entries = []
+    for kind in ENTRY_DIRS:
+        entry_dir = cache_dir / kind
+        if not entry_dir.is_dir():
+            continue
+        for path in sorted(entry_dir.iterdir()):
+            if path.name.startswith(".") or path.name.endswith(".json"):
+                continue
+            try:
+                accessed = meta_path(path).stat().st_mtime
+            except FileNotFoundError:
+                accessed = path.stat().st_mtime
+            entries.append(CacheEntry(kind, path, tree_size(path), accessed))
+
+    for path in sorted(cache_dir.glob("build_*")):
+        entries.append(
+            CacheEntry(
+                "build",
+                path,
+                tree_size(path),
+                path.stat().st_mtime,
+                active=build_active(path),
+            )
+        )
+
+    return entries
+
+
+def temp_files(cache_dir: Path) -> List[Path]:
+    """Temporary files and directories of in-progress, or failed, writes."""
+    return sorted(p for kind in ENTRY_DIRS for p in (cache_dir / kind).glob(".tmp_*"))
+
+
+def remove(path: Path) -> None:
+    """Remove cache entry, its metadata and lock, or build directory."""
+    logger.info("remove %s", path)
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(str(path))
+    else:
+        path.unlink()
+    for extra in (meta_path(path), lock_path(path)):
+        if extra.exists():
+            extra.unlink()
+
+
+def gc(
+    cache_dir: Path,
+    max_size: Optional[int] = None,
+    max_age: Optional[float] = None,
+    dry_run: bool = False,
+) -> List[CacheEntry]:
+    """Evict least-recently-used cache entries.
+
+    Entries pinned by active builds are never evicted, finished build
+    directories are evicted as any other entry. Temporary files are removed
+    if no builds are active.
+
+    Args:
+        cache_dir: Coex build cache directory.
+        max_size: Evict entries until total cache size is below max_size bytes.
+        max_age: Evict entries not accessed within max_age seconds.
+        dry_run: Report, but do not remove, evicted entries.
+
+    Returns:
+        Evicted entries.
+
+    """
+    with cache_lock(cache_dir, exclusive=True):
+        entries = scan(cache_dir)
+
+        active = [e for e in entries if e.kind == "build" and e.active]
+        pinned = set().union(*(read_pins(e.path) for e in active))
+        candidates = sorted(
+            (e for e in entries if not e.active and e.path.absolute() not in pinned),
+            key=lambda e: e.accessed,
+        )
+
+        total = sum(e.size for e in entries)
+        evicted = []
+        for entry in candidates:
+            if (max_age is not None and entry.age > max_age) or (
+                max_size is not None and total > max_size
+            ):
+                evicted.append(entry)
+                total -= entry.size
+
+        if not dry_run:
+            for entry in evicted:
+                remove(entry.path)
+
+            if not active:
+                for path in temp_files(cache_dir):
+                    remove(path)
+
+    return evicted
+
+
+def verify(cache_dir: Path) -> List[CacheEntry]:
+    """Verify cache entry hashes, recording metadata of unrecorded entries.
+
+    Entries without recorded metadata are checked via `zstd --test`.
+
+    Returns:
+        Corrupt cache entries.
+
+    """
+    corrupt = []
+    for entry in scan(cache_dir):
+        if entry.kind == "build":
+            continue
+
+        meta = read_meta(entry.path)
+        if meta is None:
+            logger.info("verify unrecorded %s", entry.path)
+            if subprocess.call(["zstd", "-q", "--test", str(entry.path)]) != 0:
+                corrupt.append(entry)
+            else:
+                record(entry.path)
+                os.utime(str(meta_path(entry.path)), (entry.accessed, entry.accessed))
+        elif meta["size"] != entry.size or meta["sha256"] != file_sha256(entry.path):
+            corrupt.append(entry)
+
+    return corrupt
+
+
+def format_size(size: float) -> str:
+    """Format byte size with binary suffix."""
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if abs(size) < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TiB"
+
+
+def format_time(timestamp: float) -> str:
+    """Format timestamp as local time."""
+    return datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M")
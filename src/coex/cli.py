@@ -1,22 +1,38 @@
 import contextlib
 import json
 import logging
-import shutil
-import tempfile
-import zipapp
+import os
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Dict, List, Optional, Set
 
 import attr
 import click
 
 import coex_bootstrap
-from coex.pkg_env import pkg_env
-from coex.pkg_src import pkg_src
+from coex import cache, compress
+from coex.analyze import analyze, format_table
+from coex.archive import ArchiveWriter
+from coex.benchmark import ChannelSpec, benchmark
+from coex.cache import BuildLease
+from coex.compress import CompressionPolicy, entry_compression
+from coex.delta import apply_delta, create_delta, verify_delta
+from coex.metrics import GROUP_KEYS, format_stats, read_records, summarize
+from coex.oci import export_oci
+from coex.pkg_env import FIXED_PREFIX_ROOT, PkgEnv, pkg_env, pkg_envs
+from coex.pkg_src import ASSET_ALIGN, asset_files, pkg_src
+from coex.watch import SRCS_MEMBER, SourceWatcher, write_tail
 from coex_bootstrap.binaries import COEXBootstrapBinaries
 from coex_bootstrap.config import COEXBootstrapConfig
+from coex_bootstrap.layers import archive_id
+from coex_bootstrap.verify import HASH_NAME, file_hash
 
 logger = logging.getLogger(__name__)
 
+# Archive member layouts, see write_coex
+LAYOUTS = ("zip", "stream")
+
 
 @attr.s()
 class COEXConfig:
@@ -29,6 +45,202 @@ class COEXConfig:
 pass_config = click.make_pass_decorator(COEXConfig, ensure=True)
 
 
+def read_archive_config(archive: Path) -> COEXBootstrapConfig:
+    """Read bootstrap config of .coex archive."""
+    return COEXBootstrapConfig.read_archive(str(archive))
+
+
+def make_build_dir(config: COEXConfig, cstack: contextlib.ExitStack) -> Path:
+    """Create leased build directory in cache, removed on exit if cleanup."""
+    lease = cstack.enter_context(BuildLease(config.cache, cleanup=config.cleanup))
+    assert lease.build_dir
+    return lease.build_dir
+
+
+def _parse_option(parse):
+    def callback(ctx, param, value):
+        if value is None:
+            return None
+        try:
+            return parse(value)
+        except ValueError as ex:
+            raise click.BadParameter(str(ex))
+
+    return callback
+
+
+def _absolute_path(value: str) -> str:
+    if not os.path.isabs(value):
+        raise ValueError(f"not an absolute path: {value}")
+    return value
+
+
+def build_options(command):
+    """Package relocation and compression options, shared by build commands."""
+    for option in reversed(
+        [
+            click.option(
+                "--fixed-prefix/--no-fixed-prefix",
+                default=False,
+                help="Relocate packages at build time to a fixed, environment "
+                "specific, prefix. Runs install without prefix updates when the "
+                "prefix is available.",
+            ),
+            click.option(
+                "--fixed-prefix-root",
+                envvar="COEX_FIXED_PREFIX_ROOT",
+                default=FIXED_PREFIX_ROOT,
+                show_default=True,
+                callback=_parse_option(_absolute_path),
+                help="Root dir of the fixed prefix on run hosts, eg. the hosts' "
+                "COEX_WORK_DIR where /tmp is noexec or shared.",
+            ),
+            click.option(
+                "--compression",
+                type=click.Choice(sorted(compress.POLICIES) + [compress.AUTO]),
+                default="default",
+                help="Compression policy of packages and sources.",
+            ),
+            click.option(
+                "--compression-override",
+                "compression_overrides",
+                multiple=True,
+                callback=_parse_option(compress.parse_overrides),
+                metavar="NAME=POLICY",
+                help="Compression policy of the named package, may be repeated.",
+            ),
+            click.option(
+                "--auto-max-ms",
+                type=float,
+                default=compress.AUTO_MAX_MS,
+                help="Decompression time budget per package of the auto policy, "
+                "the smallest benchmarked compression within the budget is "
+                "selected.",
+            ),
+            click.option(
+                "--chunk-size",
+                callback=_parse_option(cache.parse_size),
+                help="Split packages larger than the uncompressed size, eg. "
+                "'256M', into chunks extracted concurrently at startup.",
+            ),
+        ]
+    ):
+        command = option(command)
+    return command
+
+
+def write_coex(
+    output: Path,
+    entrypoint: str,
+    env: PkgEnv,
+    srcs: Optional[Path],
+    compression: CompressionPolicy,
+    base_ref: Optional[Dict[str, str]] = None,
+    assets: Optional[Dict[str, Path]] = None,
+    layout: str = "zip",
+) -> None:
+    """Write .coex archive of repacked env and sources.
+
+    Args:
+        output: Output .coex path.
+        entrypoint: coex executable entrypoint.
+        env: Repacked env packages.
+        srcs: Compressed usr sources.
+        compression: Compression policy of the build.
+        base_ref: Base layer reference, for layered coex packages.
+        assets: Asset files by name, stored uncompressed and page-aligned for
+            access without extraction.
+        layout: Member layout, one of LAYOUTS. The "stream" layout writes the
+            config and sources before packages, for extraction as the archive
+            is read, see coex_bootstrap.stream.
+
+    """
+    if layout == "stream" and assets:
+        raise ValueError("assets are not supported by the stream layout")
+
+    # Record member compression and chunks, required to extract the members
+    members = {}
+    chunk_names = {}
+    for name, pkg in env.packages.items():
+        members[f"pkgs/{name}"] = dict(compression=env.compression[pkg].as_dict())
+        if name in env.origins:
+            members[f"pkgs/{name}"]["origin"] = env.origins[name]
+        for i, chunk in enumerate(env.chunks.get(name, []), 1):
+            chunk_names[chunk] = f"chunks/{name[:-len('.tar.zst')]}.c{i:04d}.tar.zst"
+            members[f"pkgs/{name}"].setdefault("chunks", []).append(
+                dict(
+                    name=chunk_names[chunk],
+                    compression=env.compression[chunk].as_dict(),
+                )
+            )
+    if srcs:
+        src_compression = entry_compression(srcs, compression.default)
+        assert src_compression
+        members[SRCS_MEMBER] = dict(compression=src_compression.as_dict())
+        members[SRCS_MEMBER][HASH_NAME] = file_hash(str(srcs))
+
+    # Write a bootstrap configuration object into
+    bootstrap_config = COEXBootstrapConfig(
+        entrypoint=entrypoint,
+        base=base_ref,
+        prefix=env.prefix,
+        members=members,
+        activate=env.activate,
+    )
+
+    # Stream bootstrap, binaries, pkgs and srcs into output archive
+    logging.info("create_archive target=%s", output)
+    with ArchiveWriter(output) as archive:
+        coex_bootstrap_path = Path(coex_bootstrap.__file__).parent
+        logging.info("setup coex_bootstrap_path=%s", coex_bootstrap_path)
+        archive.add(coex_bootstrap_path / "__main__.py", "__main__.py")
+        archive.add_tree(
+            coex_bootstrap_path,
+            "coex_bootstrap",
+            ignore=("*.pyc", "__pycache__", "__main__.py"),
+        )
+
+        for name, bin_path in COEXBootstrapBinaries.resolve().items():
+            archive.add(Path(bin_path), f"bin/{name}")
+
+        if layout == "stream":
+            # Config and sources precede the packages, as the manifest of the
+            # following members, so package hashes are read ahead
+            for name, pkg in env.packages.items():
+                pkg_member = members[f"pkgs/{name}"]
+                pkg_member[HASH_NAME] = file_hash(str(pkg))
+                for chunk, chunk_member in zip(
+                    env.chunks.get(name, []), pkg_member.get("chunks", [])
+                ):
+                    chunk_member[HASH_NAME] = file_hash(str(chunk))
+            for member, digest in archive.digests.items():
+                members[member] = {HASH_NAME: digest}
+            write_tail(archive, bootstrap_config, srcs)
+
+        for name, pkg in env.packages.items():
+            archive.add(pkg, f"pkgs/{name}")
+            for chunk in env.chunks.get(name, []):
+                archive.add(chunk, chunk_names[chunk])
+
+        if layout == "stream":
+            return
+
+        for name, asset_path in sorted((assets or {}).items()):
+            member = f"assets/{name}"
+            offset = archive.add(asset_path, member, align=ASSET_ALIGN)
+            bootstrap_config.assets[name] = dict(
+                member=member, offset=offset, size=asset_path.stat().st_size
+            )
+
+        # Record member hashes, of chunks in their chunk metadata
+        chunks = {c["name"]: c for m in members.values() for c in m.get("chunks", [])}
+        for member, digest in archive.digests.items():
+            (chunks.get(member) or members.setdefault(member, {}))[HASH_NAME] = digest
+
+        # Config and sources last, rewritten in place by source updates
+        write_tail(archive, bootstrap_config, srcs)
+
+
 @click.group()
 @click.option(
     "--cache", type=click.Path(file_okay=False, writable=True), default="coex_cache"
@@ -49,56 +261,529 @@ def cli(ctx, **kwargs):
     "-f",
     "env_file",
     type=click.Path(exists=True, dir_okay=False),
-    required=True,
+    help="Environment file, optional if a base layer is provided.",
 )
+@click.option(
+    "--base",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Base layer .coex, output only contains packages not in the base.",
+)
+@build_options
 @click.option("--entrypoint", type=str, required=True)
 @click.option("--output", "-o", type=click.Path(), required=True)
+@click.option(
+    "--watch",
+    is_flag=True,
+    help="After the build, watch sources and rewrite the output's sources in "
+    "place on change, keeping the environment, until interrupted.",
+)
+@click.option(
+    "--layout",
+    type=click.Choice(LAYOUTS),
+    default="zip",
+    help="Archive member layout, 'stream' orders the config and sources before "
+    "packages, for extraction as the archive is read from a pipe.",
+)
+@click.option(
+    "--asset",
+    "asset_paths",
+    type=click.Path(exists=True),
+    multiple=True,
+    help="Asset file or directory, stored uncompressed and page-aligned and "
+    "exposed to the app by COEX_ASSETS without extraction.",
+)
 @click.argument("sources", type=click.Path(exists=True), nargs=-1)
-def create(config: COEXConfig, env_file, entrypoint, output, sources):
+def create(
+    config: COEXConfig,
+    env_file,
+    base,
+    fixed_prefix,
+    fixed_prefix_root,
+    compression,
+    compression_overrides,
+    auto_max_ms,
+    chunk_size,
+    entrypoint,
+    output,
+    watch,
+    layout,
+    asset_paths,
+    sources,
+):
     """Create output .coex from env, entrypoint, and usr sources."""
 
     logger.info("create %s", locals())
-    env_file = Path(env_file)
+    if env_file is None and base is None:
+        raise click.UsageError("One of --file or --base must be provided.")
+    if fixed_prefix and base is not None:
+        raise click.UsageError("--fixed-prefix is not supported with --base.")
+    if watch and not sources:
+        raise click.UsageError("--watch requires sources.")
+    if layout == "stream" and (watch or base is not None or asset_paths):
+        raise click.UsageError(
+            "--watch, --base and --asset are not supported with --layout stream."
+        )
+    try:
+        assets = asset_files(list(asset_paths))
+    except ValueError as ex:
+        raise click.BadParameter(str(ex), param_hint="asset")
 
-    with contextlib.ExitStack() as cstack:
+    try:
+        compression_policy = CompressionPolicy(
+            compression, compression_overrides, auto_max_ms
+        )
+    except ValueError as ex:
+        raise click.BadParameter(str(ex), param_hint="compression-override")
 
-        # Create the working directory
-        config.cache.mkdir(parents=True, exist_ok=True)
-        build_dir = Path(tempfile.mkdtemp(prefix="build_", dir=str(config.cache)))
+    base_ref = None
+    base_pkgs: Set[str] = set()
+    if base is not None:
+        base_config = read_archive_config(Path(base))
+        if base_config.base is not None:
+            raise click.BadParameter(
+                f"base is a layered coex: {base}", param_hint="base"
+            )
 
-        if config.cleanup:
-            cstack.callback(shutil.rmtree, build_dir)
+        base_ref = dict(archive_id=archive_id(base), name=Path(base).name)
+        with zipfile.ZipFile(base) as base_zip:
+            base_pkgs = {
+                name[len("pkgs/") : -len(".tar.zst")]
+                for name in base_zip.namelist()
+                if name.startswith("pkgs/")
+            }
+        logging.info("base base_ref=%s base_pkgs=%s", base_ref, base_pkgs)
 
-        logging.info("start build build_dir=%s", build_dir)
-        build_root = build_dir / "root"
+    # Lease cache entries used by the build, protecting them from cache gc
+    with BuildLease(config.cache, cleanup=config.cleanup) as lease:
+        # Compress env pkgs, less base layer packages, and usr sources into cache
+        env = (
+            pkg_env(
+                Path(env_file),
+                config.cache / "pkgs",
+                exclude=base_pkgs,
+                relocate_fixed=fixed_prefix,
+                lease=lease,
+                compression=compression_policy,
+                chunk_size=chunk_size,
+                fixed_prefix_root=fixed_prefix_root,
+                prefix_key=Path(output).name,
+            )
+            if env_file is not None
+            else PkgEnv(packages={})
+        )
+        if base is not None:
+            # Base layer activation applies first, as the base is installed first
+            env.activate = base_config.activate + env.activate
+        srcs = pkg_src(
+            sources,
+            config.cache / "srcs",
+            lease,
+            compression_policy,
+            exclude=[str(p) for p in assets.values()],
+        )
 
-        # Copy coex_bootstrap template into coex src
-        coex_bootstrap_path = Path(coex_bootstrap.__file__).parent
-        logging.info("setup coex_bootstrap_path=%s", coex_bootstrap_path)
-        shutil.copytree(
-            str(coex_bootstrap_path),
-            str(build_root / "coex_bootstrap"),
-            ignore=shutil.ignore_patterns("*.pyc", "__pycache__", "__main__.py"),
+        write_coex(
+            Path(output),
+            entrypoint,
+            env,
+            srcs,
+            compression_policy,
+            base_ref=base_ref,
+            assets=assets,
+            layout=layout,
+        )
+
+        if watch:
+            click.echo(f"watching {', '.join(sources)} for changes")
+            watcher = SourceWatcher(
+                Path(output),
+                list(sources),
+                config.cache / "srcs",
+                compression_policy,
+                lease,
+                exclude=[str(p) for p in assets.values()],
+            )
+            try:
+                watcher.run()
+            except KeyboardInterrupt:
+                pass
+
+
+def read_manifest(path: Path) -> List[dict]:
+    """Read create-many manifest, a json list of app entries.
+
+    Each entry has an env "file", "entrypoint", "output" and optional
+    "sources" and "assets", paths are relative to the working directory as for
+    create.
+
+    Raises:
+        ValueError: Invalid manifest.
+
+    """
+    with open(str(path)) as manifest_in:
+        apps = json.load(manifest_in)
+
+    if not isinstance(apps, list):
+        raise ValueError("manifest must be a list of app entries")
+
+    outputs = set()
+    for app in apps:
+        missing = {"file", "entrypoint", "output"} - set(app)
+        unknown = set(app) - {"file", "entrypoint", "output", "sources", "assets"}
+        if missing or unknown:
+            raise ValueError(
+                f"invalid manifest entry, missing={sorted(missing)} "
+                f"unknown={sorted(unknown)}: {app}"
+            )
+        if app["output"] in outputs:
+            raise ValueError(f"duplicate manifest output: {app['output']}")
+        outputs.add(app["output"])
+        app.setdefault("sources", [])
+        app.setdefault("assets", [])
+
+    return apps
+
+
+@cli.command("create-many")
+@pass_config
+@build_options
+@click.option(
+    "--jobs",
+    "-j",
+    type=int,
+    default=None,
+    help="Concurrent repacks and outputs, defaults to cpu count.",
+)
+@click.argument("manifest", type=click.Path(exists=True, dir_okay=False))
+def create_many(
+    config: COEXConfig,
+    fixed_prefix,
+    fixed_prefix_root,
+    compression,
+    compression_overrides,
+    auto_max_ms,
+    chunk_size,
+    jobs,
+    manifest,
+):
+    """Create many .coex outputs from a json manifest, sharing packages.
+
+    The manifest lists {"file", "entrypoint", "sources", "assets", "output"}
+    entries, as the create options. Envs are solved together, and packages
+    shared by outputs are fetched and repacked once.
+    """
+
+    logger.info("create_many %s", locals())
+    try:
+        apps = read_manifest(Path(manifest))
+        assets = [asset_files(app["assets"]) for app in apps]
+    except ValueError as ex:
+        raise click.BadParameter(str(ex), param_hint="manifest")
+
+    try:
+        compression_policy = CompressionPolicy(
+            compression, compression_overrides, auto_max_ms
+        )
+    except ValueError as ex:
+        raise click.BadParameter(str(ex), param_hint="compression-override")
+
+    with BuildLease(config.cache, cleanup=config.cleanup) as lease:
+        envs = pkg_envs(
+            [Path(app["file"]) for app in apps],
+            config.cache / "pkgs",
+            relocate_fixed=fixed_prefix,
+            lease=lease,
+            compression=compression_policy,
+            chunk_size=chunk_size,
+            jobs=jobs,
+            fixed_prefix_root=fixed_prefix_root,
+            prefix_keys=[Path(app["output"]).name for app in apps],
+        )
+
+        def build(app: dict, env: PkgEnv, app_assets: Dict[str, Path]) -> None:
+            srcs = pkg_src(
+                app["sources"],
+                config.cache / "srcs",
+                lease,
+                compression_policy,
+                exclude=[str(p) for p in app_assets.values()],
+            )
+            write_coex(
+                Path(app["output"]),
+                app["entrypoint"],
+                env,
+                srcs,
+                compression_policy,
+                assets=app_assets,
+            )
+
+        with ThreadPoolExecutor(jobs or os.cpu_count()) as pool:
+            for _ in pool.map(build, apps, envs, assets):
+                pass
+
+
+@cli.command()
+@pass_config
+@click.argument("old", type=click.Path(exists=True, dir_okay=False))
+@click.argument("new", type=click.Path(exists=True, dir_okay=False))
+@click.option("--output", "-o", type=click.Path(), required=True)
+@click.option("--verify/--no-verify", default=True)
+def delta(config: COEXConfig, old, new, output, verify):
+    """Create binary delta patch updating old .coex to new .coex."""
+
+    logger.info("delta %s", locals())
+
+    with contextlib.ExitStack() as cstack:
+        build_dir = make_build_dir(config, cstack)
+
+        manifest = create_delta(Path(old), Path(new), Path(output), build_dir)
+        logging.info(
+            "delta ops=%s size=%s",
+            {
+                op: sum(1 for s in manifest["segments"] if s["op"] == op)
+                for op in ("literal", "copy", "patch", "data")
+            },
+            Path(output).stat().st_size,
         )
-        shutil.copy(
-            str(coex_bootstrap_path / "__main__.py"), str(build_root / "__main__.py")
+
+        if verify:
+            logging.info("verify delta=%s", output)
+            verify_delta(Path(old), Path(output), Path(new), build_dir)
+
+
+@cli.command("apply")
+@pass_config
+@click.argument("old", type=click.Path(exists=True, dir_okay=False))
+@click.argument("patch", type=click.Path(exists=True, dir_okay=False))
+@click.option("--output", "-o", type=click.Path(), required=True)
+@click.option(
+    "--verify-old/--no-verify-old",
+    default=True,
+    help="Verify old .coex hash before applying patch.",
+)
+def apply_(config: COEXConfig, old, patch, output, verify_old):
+    """Rebuild new .coex from old .coex and delta patch, verifying output."""
+
+    logger.info("apply %s", locals())
+
+    with contextlib.ExitStack() as cstack:
+        build_dir = make_build_dir(config, cstack)
+        apply_delta(Path(old), Path(patch), Path(output), build_dir, verify_old)
+
+
+@cli.command("inspect")
+@pass_config
+@click.argument("archive", type=click.Path(exists=True, dir_okay=False))
+@click.option("--json", "as_json", is_flag=True, help="Output analysis as json.")
+@click.option(
+    "--calibrate/--no-calibrate",
+    default=True,
+    help="Predict startup time from a calibration run of the bootstrap.",
+)
+@click.option(
+    "--concurrency",
+    type=click.IntRange(min=1),
+    envvar="COEX_CONCURRENCY",
+    help="Bootstrap thread budget to predict startup with, defaults to cpu count.",
+)
+def inspect_(config: COEXConfig, archive, as_json, calibrate, concurrency):
+    """Report package contents and predicted startup cost of .coex archive."""
+
+    logger.info("inspect %s", locals())
+
+    with contextlib.ExitStack() as cstack:
+        build_dir = make_build_dir(config, cstack) if calibrate else None
+        analysis = analyze(Path(archive), build_dir, calibrate, concurrency)
+
+    if as_json:
+        click.echo(json.dumps(analysis, indent=2))
+    else:
+        click.echo(format_table(analysis))
+
+
+@cli.command()
+@pass_config
+@click.argument("archive", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--format",
+    "format_",
+    type=click.Choice(["oci"]),
+    default="oci",
+    help="Export format, an OCI image layout tarball.",
+)
+@click.option("--tag", default="latest", help="Image reference name.")
+@click.option("--output", "-o", type=click.Path(), required=True)
+def export(config: COEXConfig, archive, format_, tag, output):
+    """Export .coex archive as a container image, one layer per package."""
+
+    logger.info("export %s", locals())
+
+    with contextlib.ExitStack() as cstack:
+        build_dir = make_build_dir(config, cstack)
+        try:
+            manifest = export_oci(Path(archive), Path(output), build_dir, tag)
+        except ValueError as ex:
+            raise click.ClickException(str(ex))
+
+    click.echo(f"{output}: {len(manifest['layers'])} layers")
+
+
+@cli.command("stats")
+@click.argument("logs", type=click.Path(dir_okay=False), nargs=-1, required=True)
+@click.option(
+    "--by",
+    type=click.Choice(GROUP_KEYS),
+    default="archive",
+    help="Group launches by archive, host, work dir filesystem or install mode.",
+)
+@click.option("--json", "as_json", is_flag=True, help="Output summary as json.")
+def stats_(logs, by, as_json):
+    """Summarize COEX_METRICS_LOG launch metrics into per-section percentiles."""
+
+    logger.info("stats %s", locals())
+
+    records = read_records(Path(log) for log in logs)
+    if not records:
+        raise click.ClickException(f"no launch records in {', '.join(logs)}")
+
+    summaries = summarize(records, by)
+    if as_json:
+        click.echo(json.dumps(summaries, indent=2))
+    else:
+        click.echo(format_stats(summaries, by))
+
+
+DEFAULT_SPEC = ChannelSpec()
+
+
+@cli.command("benchmark")
+@click.option(
+    "--work-dir",
+    type=click.Path(file_okay=False),
+    default="coex_benchmark",
+    help="Benchmark directory, holding the synthetic channel and run caches.",
+)
+@click.option("--packages", type=int, default=DEFAULT_SPEC.packages)
+@click.option(
+    "--package-size",
+    callback=_parse_option(cache.parse_size),
+    default=str(DEFAULT_SPEC.package_size),
+    help="Payload size per package, eg. '4M'.",
+)
+@click.option(
+    "--small-file-ratio",
+    type=click.FloatRange(0, 1),
+    default=DEFAULT_SPEC.small_file_ratio,
+    help="Fraction of package payload in 1KiB files.",
+)
+@click.option(
+    "--prefix-files",
+    type=int,
+    default=DEFAULT_SPEC.prefix_files,
+    help="Files per package relocated on install.",
+)
+@click.option("--seed", type=int, default=DEFAULT_SPEC.seed)
+@click.option("--repeat", type=int, default=3, help="Cold and warm build pairs.")
+@click.option("--output", "-o", type=click.Path(dir_okay=False))
+@click.argument("create_args", nargs=-1, type=click.UNPROCESSED)
+def benchmark_(
+    work_dir,
+    packages,
+    package_size,
+    small_file_ratio,
+    prefix_files,
+    seed,
+    repeat,
+    output,
+    create_args,
+):
+    """Benchmark create offline, over a local synthetic channel.
+
+    Builds an env of all the channel's packages, passing CREATE_ARGS, eg.
+    "-- --compression auto", to create. Each run builds with empty caches, the
+    --cache option is not used, and then rebuilds from the run's caches. Stage
+    times are written as json, to output or stdout.
+    """
+
+    logger.info("benchmark %s", locals())
+
+    spec = ChannelSpec(packages, package_size, small_file_ratio, prefix_files, seed)
+    results = benchmark(Path(work_dir), spec, repeat, list(create_args))
+
+    results_json = json.dumps(results, indent=2, sort_keys=True)
+    if output:
+        Path(output).write_text(results_json + "\n")
+    else:
+        click.echo(results_json)
+
+
+@cli.group("cache")
+def cache_():
+    """Manage the build cache."""
+
+
+@cache_.command()
+@pass_config
+def stats(config: COEXConfig):
+    """Report cache size and entries."""
+    entries = cache.scan(config.cache)
+
+    for kind in cache.ENTRY_DIRS + ("build",):
+        kind_entries = [e for e in entries if e.kind == kind]
+        active = sum(1 for e in kind_entries if e.active)
+        click.echo(
+            f"{kind}: {len(kind_entries)} entries"
+            + (f" ({active} active)" if active else "")
+            + f", {cache.format_size(sum(e.size for e in kind_entries))}"
         )
 
-        # Copy zstd binary into bootstrap bin
-        COEXBootstrapBinaries.copy_to(str(build_root))
+    click.echo(f"temp: {len(cache.temp_files(config.cache))} files")
+    click.echo(f"total: {cache.format_size(sum(e.size for e in entries))}")
+    if entries:
+        oldest = min(e.accessed for e in entries)
+        click.echo(f"least recently used: {cache.format_time(oldest)}")
 
-        # Write a bootstrap configuration object into
-        bootstrap_config = COEXBootstrapConfig(entrypoint=entrypoint)
 
-        with open(build_root / "coex_bootstrap.json", "w") as config_out:
-            json.dump(bootstrap_config.as_dict(), config_out, indent=2)
+@cache_.command("gc")
+@pass_config
+@click.option(
+    "--max-size",
+    callback=_parse_option(cache.parse_size),
+    help="Evict least recently used entries until cache is below size, eg. 50G.",
+)
+@click.option(
+    "--max-age",
+    callback=_parse_option(cache.parse_age),
+    help="Evict entries not used within age, eg. 30d or 12h.",
+)
+@click.option("--dry-run", is_flag=True, help="Report, but do not remove, entries.")
+def gc_(config: COEXConfig, max_size, max_age, dry_run):
+    """Evict least recently used cache entries, not in use by active builds."""
+    if max_size is None and max_age is None:
+        raise click.UsageError("One of --max-size or --max-age must be provided.")
+
+    evicted = cache.gc(config.cache, max_size, max_age, dry_run)
+    for entry in evicted:
+        click.echo(
+            f"{'would evict' if dry_run else 'evicted'} {entry.path} "
+            f"{cache.format_size(entry.size)} {cache.format_time(entry.accessed)}"
+        )
+    click.echo(
+        f"{'would free' if dry_run else 'freed'} "
+        f"{cache.format_size(sum(e.size for e in evicted))}"
+    )
 
-        # Copy env pkgs into coex src
-        pkg_env(env_file, build_root, config.cache / "pkgs")
 
-        # Copy src files into coex src
-        pkg_src(sources, build_root)
+@cache_.command("verify")
+@pass_config
+@click.option("--delete", is_flag=True, help="Remove corrupt entries.")
+def verify_(config: COEXConfig, delete):
+    """Verify hashes of cached packages and sources."""
+    corrupt = cache.verify(config.cache)
+    for entry in corrupt:
+        click.echo(f"corrupt: {entry.path}")
+        if delete:
+            cache.remove(entry.path)
 
-        # Create zipapp archive
-        logging.info("create_archive source=%s target=%s", build_root, output)
-        zipapp.create_archive(build_root, output, interpreter="/usr/bin/env python")
+    if corrupt and not delete:
+        raise click.ClickException(f"{len(corrupt)} corrupt cache entries")
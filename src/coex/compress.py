@@ -0,0 +1,306 @@
+"""Package compression policies.
+
+Packages and sources are tar archives compressed with zstd. A compression
+policy selects the zstd parameters of each archive, the parameters are
+recorded in the cache entry metadata and in the bootstrap config so that
+archives are decompressed with matching parameters.
+"""
+
+import functools
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import attr
+
+from coex import cache
+
+logger = logging.getLogger(__name__)
+
+# Member order and ownership of created tars are independent of the build
+# host, so that archives of the same inputs are byte-identical
+GNU_TAR_ARGS = [
+    "--format=gnu",
+    "--sort=name",
+    "--owner=0",
+    "--group=0",
+    "--numeric-owner",
+]
+# bsdtar, as on macos, adds members in directory order
+BSD_TAR_ARGS = ["--uid", "0", "--gid", "0", "--numeric-owner"]
+
+
+@functools.lru_cache(maxsize=None)
+def gnu_tar() -> bool:
+    """Build host tar is GNU tar."""
+    version = subprocess.check_output(["tar", "--version"])
+    return b"GNU tar" in version
+
+
+def reproducible_tar_args(epoch: Optional[int] = None) -> List[str]:
+    """Reproducible tar create arguments, clamping mtimes to epoch if given."""
+    if not gnu_tar():
+        if epoch is not None:
+            logger.warning("SOURCE_DATE_EPOCH requires GNU tar, mtimes not clamped")
+        return list(BSD_TAR_ARGS)
+
+    args = list(GNU_TAR_ARGS)
+    if epoch is not None:
+        args += [f"--mtime=@{epoch}", "--clamp-mtime"]
+    return args
+
+
+def source_date_epoch() -> Optional[int]:
+    """Build timestamp from SOURCE_DATE_EPOCH, None if unset."""
+    epoch = os.environ.get("SOURCE_DATE_EPOCH")
+    if not epoch:
+        return None
+    try:
+        return int(epoch)
+    except ValueError:
+        raise ValueError(f"invalid SOURCE_DATE_EPOCH: {epoch!r}")
+
+
+@attr.s(auto_attribs=True, frozen=True)
+class Compression:
+    """zstd compression parameters."""
+
+    # Compression level, negative levels are zstd --fast levels
+    level: int = 3
+    # Long distance matching window log
+    long: Optional[int] = None
+
+    def compress_args(self) -> List[str]:
+        """zstd compression arguments."""
+        if self.level < 0:
+            args = [f"--fast={-self.level}"]
+        elif self.level > 19:
+            args = ["--ultra", f"-{self.level}"]
+        else:
+            args = [f"-{self.level}"]
+
+        if self.long:
+            args.append(f"--long={self.long}")
+
+        return args
+
+    def decompress_args(self) -> List[str]:
+        """zstd decompression arguments."""
+        return [f"--long={self.long}"] if self.long else []
+
+    def as_dict(self) -> dict:
+        """As json-compatible object, as recorded in the bootstrap config."""
+        return dict(codec="zstd", level=self.level, long=self.long)
+
+    @classmethod
+    def from_dict(cls, obj: dict) -> "Compression":
+        """From json-compatible object."""
+        return cls(level=obj["level"], long=obj.get("long"))
+
+
+POLICIES = {
+    # zstd defaults
+    "default": Compression(),
+    # Smallest archive, for archives downloaded once and run often
+    "max-ratio": Compression(level=19, long=30),
+    # Fastest decompression, for startup latency sensitive archives
+    "max-decompress-speed": Compression(level=-3),
+}
+
+# Benchmark policy, selecting the smallest candidate within a time budget
+AUTO = "auto"
+AUTO_MAX_MS = 200.0
+
+AUTO_CANDIDATES = [
+    Compression(level=-3),
+    Compression(level=1),
+    Compression(level=3),
+    Compression(level=9),
+    Compression(level=19),
+    Compression(level=19, long=30),
+]
+
+
+@attr.s(auto_attribs=True, frozen=True)
+class CompressionPolicy:
+    """Compression policy of a build, with per-package overrides."""
+
+    default: str = "default"
+    # Policy overrides, by package name
+    overrides: Dict[str, str] = attr.Factory(dict)
+    # Decompression time budget of each archive, for the auto policy
+    auto_max_ms: float = AUTO_MAX_MS
+
+    def __attrs_post_init__(self):  # noqa: D
+        for policy in [self.default] + list(self.overrides.values()):
+            if policy != AUTO and policy not in POLICIES:
+                raise ValueError(f"Unknown compression policy: {policy!r}")
+
+    def for_package(self, name: str) -> str:
+        """Policy name of package."""
+        return self.overrides.get(name, self.default)
+
+    def tag(self, policy: str) -> str:
+        """Cache entry name tag of policy, empty for the default policy."""
+        if policy == AUTO:
+            return f".auto{self.auto_max_ms:g}ms"
+        elif policy == "default":
+            return ""
+        else:
+            compression = POLICIES[policy]
+            return f".z{compression.level}" + (
+                f"w{compression.long}" if compression.long else ""
+            )
+
+
+def entry_compression(path: Path, policy: str) -> Optional[Compression]:
+    """Compression of cache entry, from entry metadata.
+
+    Entries recorded without compression metadata were compressed with the
+    policy's fixed parameters, returns None if unknown for the auto policy.
+    """
+    meta = cache.read_meta(path) or {}
+    if "compression" in meta:
+        return Compression.from_dict(meta["compression"])
+    return POLICIES.get(policy)
+
+
+def _compress(source: Path, output: Path, compression: Compression) -> None:
+    """Compress source file into output."""
+    subprocess.check_call(
+        ["zstd", "-q", "-f", "-T0"]
+        + compression.compress_args()
+        + [str(source), "-o", str(output)]
+    )
+
+
+def _decompress_ms(path: Path, compression: Compression, repeat: int = 2) -> float:
+    """Best-of-repeat decompression time of path."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.check_call(
+            ["zstd", "-q", "-d", "-c"] + compression.decompress_args() + [str(path)],
+            stdout=subprocess.DEVNULL,
+        )
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000
+
+
+def select_compression(
+    source: Path, output: Path, max_ms: float, work_dir: Path
+) -> Compression:
+    """Benchmark AUTO_CANDIDATES, selecting the smallest within max_ms.
+
+    Falls back to the fastest decompressing candidate if none are within the
+    decompression time budget.
+
+    Args:
+        source: Uncompressed tar.
+        output: Output path of the selected candidate.
+        max_ms: Decompression time budget.
+        work_dir: Scratch directory for candidates.
+
+    Returns:
+        Selected compression.
+
+    """
+    results = []
+    for i, compression in enumerate(AUTO_CANDIDATES):
+        candidate = work_dir / f"candidate_{i}.tar.zst"
+        _compress(source, candidate, compression)
+        size = candidate.stat().st_size
+        ms = _decompress_ms(candidate, compression)
+        logger.info("auto candidate=%s size=%s ms=%.1f", compression, size, ms)
+        results.append((compression, candidate, size, ms))
+
+    within = [r for r in results if r[3] <= max_ms]
+    if within:
+        selected = min(within, key=lambda r: r[2])
+    else:
+        selected = min(results, key=lambda r: r[3])
+    logger.info("auto selected=%s source=%s", selected[0], source)
+
+    shutil.move(str(selected[1]), str(output))
+    return selected[0]
+
+
+def compress_tar(
+    tar_args: List[str],
+    output: Path,
+    policy: str,
+    auto_max_ms: float = AUTO_MAX_MS,
+    epoch: Optional[int] = None,
+) -> Compression:
+    """Create compressed tar at output.
+
+    Members are sorted by name and owned by root, see reproducible_tar_args.
+
+    Args:
+        tar_args: tar create arguments, the input paths and any tar options.
+        output: Output .tar.zst path.
+        policy: Compression policy name.
+        auto_max_ms: Decompression time budget, for the auto policy.
+        epoch: Clamp member mtimes to epoch.
+
+    Returns:
+        Compression of output.
+
+    """
+    tar_args = reproducible_tar_args(epoch) + tar_args
+
+    compression = POLICIES.get(policy)
+    if compression and not compression.long:
+        # Stream tar through zstd
+        tar_cmd = ["tar", "-f", "-", "-c"] + tar_args
+        zstd_cmd = ["zstd", "-q", "-f", "-T0"] + compression.compress_args()
+        zstd_cmd += ["-o", str(output)]
+        logger.info("compress_tar %s | %s", tar_cmd, zstd_cmd)
+
+        tar = subprocess.Popen(tar_cmd, stdout=subprocess.PIPE)
+        zstd = subprocess.Popen(zstd_cmd, stdin=tar.stdout)
+        assert tar.stdout
+        tar.stdout.close()
+
+        for proc in (zstd, tar):
+            if proc.wait():
+                raise subprocess.CalledProcessError(proc.returncode, proc.args)
+        return compression
+
+    # Compress from a complete tar, zstd limits the long distance matching
+    # window, and so decompression memory, to the input size if known.
+    work_dir = Path(tempfile.mkdtemp(prefix=".tmp_", dir=str(output.parent)))
+    try:
+        tar_path = work_dir / "archive.tar"
+        tar_cmd = ["tar", "-f", str(tar_path), "-c"] + tar_args
+        logger.info("compress_tar %s", tar_cmd)
+        subprocess.check_call(tar_cmd)
+
+        if compression:
+            _compress(tar_path, output, compression)
+            return compression
+        else:
+            return select_compression(tar_path, output, auto_max_ms, work_dir)
+    finally:
+        shutil.rmtree(str(work_dir))
+
+
+def parse_overrides(values: List[str]) -> Dict[str, str]:
+    """Parse NAME=POLICY override strings.
+
+    Raises:
+        ValueError: Invalid override.
+
+    """
+    overrides = {}
+    for value in values:
+        name, sep, policy = value.partition("=")
+        if not sep or not name:
+            raise ValueError(f"invalid override, expected NAME=POLICY: {value!r}")
+        overrides[name] = policy
+    return overrides
@@ -0,0 +1,370 @@
+"""Binary delta updates between coex archives.
+
+A delta transforms an "old" coex into a byte-identical "new" coex. Deltas are
+computed per zip member: member data present in the old archive is referenced
+by hash, changed members are encoded via `zstd --patch-from` against the
+matching member of the old archive and remaining bytes (local headers, central
+directory, new members) are stored literally.
+
+Deltas are stored as zip files containing a `coex_delta.json` manifest and
+the referenced literal, data and patch blobs.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import zipfile
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterator, List
+
+import attr
+
+logger = logging.getLogger(__name__)
+
+DELTA_VERSION = 1
+MANIFEST_NAME = "coex_delta.json"
+LITERALS_NAME = "literals"
+CHUNK_SIZE = 1 << 20
+
+_LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+_LOCAL_HEADER_SIGNATURE = b"PK\003\004"
+
+
+@attr.s(frozen=True)
+class MemberRange:
+    """Byte range of a zip member's (compressed) data within an archive."""
+
+    name: str = attr.ib()
+    start: int = attr.ib()
+    size: int = attr.ib()
+
+    @property
+    def end(self) -> int:
+        """End offset of member data."""
+        return self.start + self.size
+
+
+def member_ranges(archive: Path) -> List[MemberRange]:
+    """Resolve data byte ranges of all members in zip archive, in file order."""
+
+    ranges = []
+    with zipfile.ZipFile(str(archive)) as zf, open(str(archive), "rb") as inf:
+        for info in sorted(zf.infolist(), key=lambda i: i.header_offset):
+            inf.seek(info.header_offset)
+            header = _LOCAL_HEADER.unpack(inf.read(_LOCAL_HEADER.size))
+            if header[0] != _LOCAL_HEADER_SIGNATURE:
+                raise ValueError(
+                    "Invalid local header: %s" % dict(archive=archive, name=info)
+                )
+            name_len, extra_len = header[-2:]
+            start = info.header_offset + _LOCAL_HEADER.size + name_len + extra_len
+            ranges.append(MemberRange(info.filename, start, info.compress_size))
+
+    return ranges
+
+
+def iter_range(inf: BinaryIO, start: int, size: int) -> Iterator[bytes]:
+    """Iterate CHUNK_SIZE blocks of byte range in file."""
+    inf.seek(start)
+    remaining = size
+    while remaining:
+        block = inf.read(min(CHUNK_SIZE, remaining))
+        if not block:
+            raise EOFError("Truncated range: %s" % dict(start=start, size=size))
+        remaining -= len(block)
+        yield block
+
+
+def _sha256(blocks: Iterator[bytes]) -> str:
+    digest = hashlib.sha256()
+    for block in blocks:
+        digest.update(block)
+    return digest.hexdigest()
+
+
+def file_sha256(path: Path) -> str:
+    """Sha256 hexdigest of file contents."""
+    with open(str(path), "rb") as inf:
+        return _sha256(iter(lambda: inf.read(CHUNK_SIZE), b""))
+
+
+def _copy_range(inf: BinaryIO, rng: MemberRange, dest: Path) -> None:
+    with open(str(dest), "wb") as outf:
+        for block in iter_range(inf, rng.start, rng.size):
+            outf.write(block)
+
+
+def _patch_key(name: str) -> str:
+    """Key used to match a changed member to its patch base.
+
+    Packages are matched on conda package name, so that version bumps encode
+    as patches against the previous version of the package.
+    """
+    if name.startswith("pkgs/"):
+        return "pkgs/" + name[len("pkgs/") :].rsplit("-", 2)[0]
+    if name.startswith("chunks/"):
+        # chunks/<dist>.cNNNN.tar.zst, matched on package name and chunk index
+        dist, _, chunk = name[: -len(".tar.zst")].rpartition(".")
+        return "chunks/" + dist[len("chunks/") :].rsplit("-", 2)[0] + "." + chunk
+    return name
+
+
+def _zstd_patch(base: Path, target: Path, patch: Path) -> bool:
+    """Encode target as zstd patch from base, False if encoding failed."""
+    cmd = ["zstd", "-q", "-f", "--long=31", f"--patch-from={base}"] + [
+        str(target),
+        "-o",
+        str(patch),
+    ]
+    logger.debug("zstd_patch %s", cmd)
+    try:
+        subprocess.check_call(cmd)
+    except subprocess.CalledProcessError:
+        logger.warning("zstd --patch-from failed, storing data: %s", target)
+        return False
+    return True
+
+
+def _zstd_unpatch(base: Path, patch: Path, target: Path) -> None:
+    cmd = ["zstd", "-q", "-d", "-f", "--long=31", f"--patch-from={base}"] + [
+        str(patch),
+        "-o",
+        str(target),
+    ]
+    logger.debug("zstd_unpatch %s", cmd)
+    subprocess.check_call(cmd)
+
+
+def create_delta(old: Path, new: Path, output: Path, work_dir: Path) -> dict:
+    """Create delta patch transforming old coex archive into new.
+
+    Args:
+        old: Old coex archive.
+        new: New coex archive.
+        output: Output delta file.
+        work_dir: Scratch directory for patch encoding.
+
+    Returns:
+        Delta manifest.
+
+    """
+    old_ranges = member_ranges(old)
+    new_ranges = member_ranges(new)
+    work_dir = Path(tempfile.mkdtemp(prefix="delta_", dir=str(work_dir)))
+
+    try:
+        segments: List[dict] = []
+        literals = bytearray()
+        blobs: Dict[str, Path] = {}
+
+        def literal(data: bytes) -> None:
+            if data:
+                segments.append(
+                    dict(op="literal", offset=len(literals), size=len(data))
+                )
+                literals.extend(data)
+
+        with open(str(old), "rb") as oldf, open(str(new), "rb") as newf:
+            old_by_hash: Dict[str, MemberRange] = {}
+            old_by_key: Dict[str, MemberRange] = {}
+            old_hashes: Dict[MemberRange, str] = {}
+            for rng in old_ranges:
+                sha = _sha256(iter_range(oldf, rng.start, rng.size))
+                old_hashes[rng] = sha
+                old_by_hash.setdefault(sha, rng)
+                old_by_key.setdefault(_patch_key(rng.name), rng)
+
+            pos = 0
+            for rng in new_ranges:
+                newf.seek(pos)
+                literal(newf.read(rng.start - pos))
+                pos = rng.end
+
+                sha = _sha256(iter_range(newf, rng.start, rng.size))
+
+                if sha in old_by_hash:
+                    logger.debug("copy %s", rng.name)
+                    source = old_by_hash[sha]
+                    segments.append(
+                        dict(op="copy", name=source.name, sha256=sha, size=rng.size)
+                    )
+                    continue
+
+                target = work_dir / "target"
+                _copy_range(newf, rng, target)
+
+                base_rng = old_by_key.get(_patch_key(rng.name))
+                if base_rng is not None:
+                    base = work_dir / "base"
+                    _copy_range(oldf, base_rng, base)
+                    blob_name = f"patch/{len(blobs)}"
+                    blob = work_dir / blob_name.replace("/", ".")
+                    if (
+                        _zstd_patch(base, target, blob)
+                        and blob.stat().st_size < rng.size
+                    ):
+                        logger.info("patch %s base=%s", rng.name, base_rng.name)
+                        blobs[blob_name] = blob
+                        segments.append(
+                            dict(
+                                op="patch",
+                                name=rng.name,
+                                blob=blob_name,
+                                base=base_rng.name,
+                                base_sha256=old_hashes[base_rng],
+                                sha256=sha,
+                                size=rng.size,
+                            )
+                        )
+                        continue
+                    elif blob.exists():
+                        blob.unlink()
+
+                logger.info("data %s", rng.name)
+                blob_name = f"data/{len(blobs)}"
+                blob = work_dir / blob_name.replace("/", ".")
+                target.rename(blob)
+                blobs[blob_name] = blob
+                segments.append(
+                    dict(
+                        op="data",
+                        name=rng.name,
+                        blob=blob_name,
+                        sha256=sha,
+                        size=rng.size,
+                    )
+                )
+
+            newf.seek(pos)
+            literal(newf.read())
+
+        manifest = dict(
+            version=DELTA_VERSION,
+            old_sha256=file_sha256(old),
+            new_sha256=file_sha256(new),
+            new_size=new.stat().st_size,
+            new_mode=new.stat().st_mode & 0o777,
+            segments=segments,
+        )
+
+        with zipfile.ZipFile(str(output), "w") as zf:
+            zf.writestr(
+                MANIFEST_NAME, json.dumps(manifest, indent=2), zipfile.ZIP_DEFLATED
+            )
+            zf.writestr(LITERALS_NAME, bytes(literals), zipfile.ZIP_DEFLATED)
+            for name, blob in blobs.items():
+                zf.write(str(blob), name, zipfile.ZIP_STORED)
+    finally:
+        shutil.rmtree(str(work_dir))
+
+    return manifest
+
+
+class DeltaError(ValueError):
+    """Delta does not apply to, or produce, the expected archive."""
+
+
+def apply_delta(
+    old: Path, delta: Path, output: Path, work_dir: Path, check_old: bool = True
+) -> None:
+    """Rebuild new coex archive from old archive and delta patch.
+
+    Output is verified against the sha256 of the archive the delta was created
+    from, and only moved to the output path on success.
+
+    Args:
+        old: Old coex archive.
+        delta: Delta created via create_delta.
+        output: Output coex archive.
+        work_dir: Scratch directory for patch decoding.
+        check_old: Verify sha256 of the complete old archive before applying.
+
+    Raises:
+        DeltaError: Delta or old archive mismatch, or verification failed.
+
+    """
+    with zipfile.ZipFile(str(delta)) as dz:
+        manifest = json.loads(dz.read(MANIFEST_NAME).decode("utf-8"))
+        if manifest["version"] != DELTA_VERSION:
+            raise DeltaError("Unsupported delta version: %s" % manifest["version"])
+
+        if check_old and file_sha256(old) != manifest["old_sha256"]:
+            raise DeltaError("Delta does not apply to old archive: %s" % old)
+
+        literals = dz.read(LITERALS_NAME)
+        old_ranges = {rng.name: rng for rng in member_ranges(old)}
+        work_dir = Path(tempfile.mkdtemp(prefix="apply_", dir=str(work_dir)))
+
+        fd, tmp_path = tempfile.mkstemp(prefix=output.name, dir=str(output.parent))
+        os.close(fd)
+        tmp_output = Path(tmp_path)
+        try:
+            digest = hashlib.sha256()
+            with open(str(old), "rb") as oldf, open(str(tmp_output), "wb") as outf:
+
+                def emit(blocks: Iterator[bytes], seg: dict) -> None:
+                    member_digest = hashlib.sha256()
+                    for block in blocks:
+                        member_digest.update(block)
+                        digest.update(block)
+                        outf.write(block)
+                    if "sha256" in seg and member_digest.hexdigest() != seg["sha256"]:
+                        raise DeltaError("Member hash mismatch: %s" % seg)
+
+                for seg in manifest["segments"]:
+                    op = seg["op"]
+                    if op == "literal":
+                        start = seg["offset"]
+                        emit(iter([literals[start : start + seg["size"]]]), seg)
+                    elif op == "copy":
+                        rng = old_ranges[seg["name"]]
+                        emit(iter_range(oldf, rng.start, rng.size), seg)
+                    elif op == "data":
+                        with dz.open(seg["blob"]) as blob:
+                            emit(iter(lambda: blob.read(CHUNK_SIZE), b""), seg)
+                    elif op == "patch":
+                        base = work_dir / "base"
+                        _copy_range(oldf, old_ranges[seg["base"]], base)
+                        if file_sha256(base) != seg["base_sha256"]:
+                            raise DeltaError("Patch base hash mismatch: %s" % seg)
+                        patch = work_dir / "patch"
+                        with dz.open(seg["blob"]) as blob, open(str(patch), "wb") as pf:
+                            shutil.copyfileobj(blob, pf, CHUNK_SIZE)
+                        target = work_dir / "target"
+                        _zstd_unpatch(base, patch, target)
+                        with open(str(target), "rb") as tf:
+                            emit(iter(lambda: tf.read(CHUNK_SIZE), b""), seg)
+                    else:
+                        raise DeltaError("Unknown delta op: %s" % seg)
+
+            if digest.hexdigest() != manifest["new_sha256"]:
+                raise DeltaError(
+                    "Output verification failed: %s"
+                    % dict(expected=manifest["new_sha256"], actual=digest.hexdigest())
+                )
+
+            os.chmod(str(tmp_output), manifest["new_mode"])
+            tmp_output.rename(output)
+        finally:
+            if tmp_output.exists():
+                tmp_output.unlink()
+            shutil.rmtree(str(work_dir))
+
+
+def verify_delta(old: Path, delta: Path, new: Path, work_dir: Path) -> None:
+    """Verify that delta rebuilds new archive from old archive.
+
+    Raises:
+        DeltaError: Rebuilt archive does not match new archive.
+
+    """
+    rebuilt = work_dir / "verify.coex"
+    apply_delta(old, delta, rebuilt, work_dir, check_old=True)
+    if file_sha256(rebuilt) != file_sha256(new):
+        raise DeltaError("Rebuilt archive does not match: %s" % new)
+    rebuilt.unlink()
@@ -0,0 +1,126 @@
+"""Summary of bootstrap launch metrics logs.
+
+Launch records are appended by the bootstrap to COEX_METRICS_LOG, see
+coex_bootstrap.metrics, and summarized here into per-section percentiles by
+archive or host, to find slow nodes and startup regressions.
+"""
+
+import json
+import logging
+import math
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, Iterable, List
+
+from coex.cache import format_size
+
+logger = logging.getLogger(__name__)
+
+PERCENTILES = (50, 90, 99)
+
+GROUP_KEYS = ("archive", "host", "work_dir_fs", "mode")
+
+
+def read_records(paths: Iterable[Path]) -> List[dict]:
+    """Read launch records from metrics logs, and their rotated backups.
+
+    Truncated or malformed lines, eg. of a full disk, are skipped.
+    """
+    records = []
+    for path in paths:
+        for log in (Path(f"{path}.1"), Path(path)):
+            if not log.exists():
+                continue
+            for line in log.read_text().splitlines():
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    logger.warning("skipping malformed record in %s", log)
+    return records
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Nearest-rank percentile of values."""
+    ordered = sorted(values)
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+
+def _group(record: dict, by: str) -> str:
+    if by == "archive":
+        return f"{record.get('archive')} {(record.get('archive_id') or '')[:12]}"
+    return str(record.get(by))
+
+
+def summarize(records: List[dict], by: str = "archive") -> List[dict]:
+    """Summarize launch records into per-section percentiles.
+
+    Args:
+        records: Launch records.
+        by: Record key grouping the summary, one of GROUP_KEYS.
+
+    Returns:
+        Summaries, [{"group", "launches", "extracted_bytes", "sections":
+        {section: {"count", "p50", "p90", "p99", "max"}}}], sorted by group.
+
+    """
+    groups: Dict[str, List[dict]] = defaultdict(list)
+    for record in records:
+        groups[_group(record, by)].append(record)
+
+    summaries = []
+    for group, group_records in sorted(groups.items()):
+        times: Dict[str, List[float]] = defaultdict(list)
+        for record in group_records:
+            sections = dict(record.get("sections") or {})
+            sections.update(record.get("cleanup_sections") or {})
+            for section, elapsed in sections.items():
+                times[section].append(elapsed)
+
+        summaries.append(
+            {
+                "group": group,
+                "launches": len(group_records),
+                "extracted_bytes": percentile(
+                    [r.get("extracted_bytes", 0) for r in group_records], 50
+                ),
+                "sections": {
+                    section: dict(
+                        count=len(values),
+                        max=max(values),
+                        **{f"p{p}": percentile(values, p) for p in PERCENTILES},
+                    )
+                    for section, values in sorted(times.items())
+                },
+            }
+        )
+    return summaries
+
+
+def format_stats(summaries: List[dict], by: str = "archive") -> str:
+    """Format summaries as text tables, one per group."""
+    header = ["section", "count"] + [f"p{p}" for p in PERCENTILES] + ["max"]
+
+    lines: List[str] = []
+    for summary in summaries:
+        rows = [header] + [
+            [section, str(s["count"])]
+            + [f"{s[f'p{p}']:.3f}s" for p in PERCENTILES]
+            + [f"{s['max']:.3f}s"]
+            for section, s in summary["sections"].items()
+        ]
+        widths = [max(len(r[i]) for r in rows) for i in range(len(header))]
+
+        if lines:
+            lines.append("")
+        lines.append(
+            f"{by}: {summary['group']}, {summary['launches']} launches, "
+            f"{format_size(summary['extracted_bytes'])} extracted (p50)"
+        )
+        lines += [
+            "  ".join(
+                c.ljust(w) if i == 0 else c.rjust(w)
+                for i, (c, w) in enumerate(zip(r, widths))
+            )
+            for r in rows
+        ]
+    return "\n".join(lines)
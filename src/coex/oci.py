@@ -0,0 +1,398 @@
+"""Export of coex archives as OCI image layouts.
+
+Each repacked conda package becomes a content-addressed image layer,
+relocated to the image's conda prefix, with the usr sources as a final
+application layer. Layers are written deterministically, so that a package
+shared between images is stored, and cached by container runtimes, once.
+
+The exported images contain the environment and application only, without
+an OS base layer.
+"""
+
+import calendar
+import gzip
+import hashlib
+import json
+import logging
+import os
+import platform
+import shutil
+import string
+import tarfile
+import tempfile
+import zipfile
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Tuple
+
+import attr
+
+from coex.pkg_env import relocate, retain_mtimes
+from coex_bootstrap import assets as assets_helper
+from coex_bootstrap.activate import activate_vars
+from coex_bootstrap.binaries import COEXBootstrapBinaries
+from coex_bootstrap.config import COEXBootstrapConfig
+from coex_bootstrap.install import (
+    PaddingError,
+    package_info_dir,
+    read_coex_prefix,
+    update_prefix,
+)
+from coex_bootstrap.unpack import ZipPkgHandle
+
+logger = logging.getLogger(__name__)
+
+# Run directory of images exported from coex archives without a fixed prefix
+OCI_ROOT = "/opt/coex"
+
+MANIFEST_MEDIA_TYPE = "application/vnd.oci.image.manifest.v1+json"
+CONFIG_MEDIA_TYPE = "application/vnd.oci.image.config.v1+json"
+LAYER_MEDIA_TYPE = "application/vnd.oci.image.layer.v1.tar+gzip"
+TITLE = "org.opencontainers.image.title"
+
+# conda subdir to OCI platform, os and architecture
+PLATFORMS = {
+    "linux-64": ("linux", "amd64"),
+    "linux-aarch64": ("linux", "arm64"),
+    "linux-ppc64le": ("linux", "ppc64le"),
+    "linux-s390x": ("linux", "s390x"),
+}
+MACHINES = {"x86_64": "amd64", "aarch64": "arm64"}
+
+DEFAULT_PATH = "/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin"
+
+
+class _HashingWriter:
+    """Write-only file wrapper computing the sha256 and size of written data."""
+
+    def __init__(self, out: BinaryIO):
+        self.out = out
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        self.digest.update(data)
+        self.size += len(data)
+        return self.out.write(data)
+
+    def flush(self) -> None:
+        self.out.flush()
+
+
+@attr.s(auto_attribs=True)
+class Blob:
+    """Content-addressed blob in the image layout."""
+
+    media_type: str
+    digest: str
+    size: int
+    annotations: Dict[str, str] = attr.Factory(dict)
+
+    def descriptor(self) -> dict:
+        """OCI content descriptor."""
+        descriptor = {
+            "mediaType": self.media_type,
+            "digest": self.digest,
+            "size": self.size,
+        }
+        if self.annotations:
+            descriptor["annotations"] = self.annotations
+        return descriptor
+
+
+class ImageLayout:
+    """OCI image layout directory, writing content-addressed blobs."""
+
+    def __init__(self, path: Path):
+        """Init layout at path, creating the blobs directory."""
+        self.path = path
+        self.blob_dir = path / "blobs" / "sha256"
+        self.blob_dir.mkdir(parents=True, exist_ok=True)
+        (path / "oci-layout").write_text(json.dumps({"imageLayoutVersion": "1.0.0"}))
+
+    def write_json(self, media_type: str, obj: dict) -> Blob:
+        """Write json blob, with sorted keys."""
+        data = json.dumps(obj, sort_keys=True, separators=(",", ":")).encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        (self.blob_dir / digest).write_bytes(data)
+        return Blob(media_type, f"sha256:{digest}", len(data))
+
+    def write_layer(self, root: Path, arcroot: str, title: str) -> Tuple[Blob, str]:
+        """Write gzipped tar layer of root's contents, placed at arcroot.
+
+        Entries are sorted and owned by root, and the gzip header carries no
+        name or timestamp, so that layers are reproducible.
+
+        Args:
+            root: Layer contents.
+            arcroot: Absolute path of root in the image.
+            title: Layer title annotation.
+
+        Returns:
+            Layer blob and uncompressed tar digest, the layer diff id.
+
+        """
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp_", dir=str(self.blob_dir))
+        try:
+            with os.fdopen(fd, "wb") as out:
+                compressed = _HashingWriter(out)
+                with gzip.GzipFile(
+                    filename="", mode="wb", fileobj=compressed, mtime=0  # type: ignore
+                ) as gz:
+                    uncompressed = _HashingWriter(gz)  # type: ignore
+                    with tarfile.open(
+                        fileobj=uncompressed, mode="w|", format=tarfile.PAX_FORMAT
+                    ) as tar:
+                        _add_tree(tar, root, arcroot.strip("/"))
+
+            digest = compressed.digest.hexdigest()
+            os.rename(tmp_path, str(self.blob_dir / digest))
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+        blob = Blob(
+            LAYER_MEDIA_TYPE,
+            f"sha256:{digest}",
+            compressed.size,
+            {TITLE: title},
+        )
+        return blob, f"sha256:{uncompressed.digest.hexdigest()}"
+
+
+def _normalize(tarinfo: tarfile.TarInfo) -> tarfile.TarInfo:
+    """Reset ownership, and directory mtimes which depend on extraction order."""
+    tarinfo.uid = tarinfo.gid = 0
+    tarinfo.uname = tarinfo.gname = ""
+    if tarinfo.isdir():
+        tarinfo.mtime = 0
+    return tarinfo
+
+
+def _add_tree(tar: tarfile.TarFile, root: Path, arcroot: str) -> None:
+    """Add sorted contents of root to tar under arcroot, with parent dirs."""
+    parts = arcroot.split("/")
+    for i in range(1, len(parts) + 1):
+        tarinfo = tarfile.TarInfo("/".join(parts[:i]))
+        tarinfo.type = tarfile.DIRTYPE
+        tarinfo.mode = 0o755
+        tar.addfile(tarinfo)
+
+    for dirpath, dirnames, filenames in os.walk(str(root)):
+        dirnames.sort()
+        for name in dirnames + sorted(filenames):
+            path = os.path.join(dirpath, name)
+            arcname = arcroot + "/" + os.path.relpath(path, str(root))
+            tar.add(path, arcname, recursive=False, filter=_normalize)
+
+
+def _platform(info_dirs: List[Path]) -> Tuple[str, str]:
+    """Image os and architecture, from the conda subdir of the packages."""
+    for info_dir in info_dirs:
+        index = info_dir / "index.json"
+        if index.exists():
+            subdir = json.loads(index.read_text()).get("subdir")
+            if subdir in PLATFORMS:
+                return PLATFORMS[subdir]
+
+    machine = platform.machine()
+    return "linux", MACHINES.get(machine, machine)
+
+
+def _prepare_package(package_dir: Path, info_dir: Path, prefix: str) -> None:
+    """Install extracted package files at prefix, as the bootstrap post_extract.
+
+    Packages are laid out for install at build time, prefix files are
+    relocated and the package info removed. Packages relocated to a fixed
+    prefix at build time are moved on from that prefix.
+
+    Raises:
+        ValueError: Package can not be relocated to prefix.
+
+    """
+    coex_prefix = info_dir / "coex_prefix.json"
+    try:
+        if coex_prefix.exists():
+            prefix_files = read_coex_prefix(str(coex_prefix), prefix)
+            with retain_mtimes(package_dir):
+                for f, (placeholder, mode, slack) in sorted(prefix_files.items()):
+                    update_prefix(
+                        str(package_dir / f), prefix, placeholder, mode, slack
+                    )
+        else:
+            relocate(package_dir, prefix, info_dir)
+    except PaddingError:
+        raise ValueError(
+            f"unable to relocate package, placeholder too short: {package_dir}"
+        )
+
+    if (info_dir / "recipe" / "post-link.sh").exists():
+        logger.warning("skipping post-link script %s", package_dir.name)
+
+    shutil.rmtree(str(package_dir / "info"))
+
+
+def _entrypoint(entrypoint: str, usr_prefix: str, env: Dict[str, str]) -> List[str]:
+    """Image entrypoint, resolved as the bootstrap resolve_entrypoint."""
+    entrypoint = string.Template(entrypoint).safe_substitute(env)
+    if os.path.dirname(entrypoint) and not os.path.isabs(entrypoint):
+        entrypoint = os.path.join(usr_prefix, entrypoint)
+    return [entrypoint]
+
+
+def _extract_assets(archive: Path, config: COEXBootstrapConfig, root: Path) -> None:
+    """Extract assets under root/assets, and the coex_assets helper module."""
+    with zipfile.ZipFile(str(archive)) as zf:
+        for name, asset in config.assets.items():
+            info = zf.getinfo(asset["member"])
+            path = root / "assets" / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with zf.open(info) as asset_in, path.open("wb") as asset_out:
+                shutil.copyfileobj(asset_in, asset_out)
+            # Member timestamps are normalized at build, see ArchiveWriter
+            mtime = calendar.timegm(info.date_time + (0, 0, 0))
+
+    helper = root / "python" / "coex_assets.py"
+    helper.parent.mkdir()
+    shutil.copyfile(assets_helper.__file__, str(helper))
+    for path in [helper] + [root / "assets" / name for name in config.assets]:
+        path.chmod(0o644)
+        os.utime(str(path), (mtime, mtime))
+
+
+def export_oci(
+    archive: Path, output: Path, work_dir: Path, tag: str = "latest"
+) -> dict:
+    """Export coex archive as an OCI image layout tarball.
+
+    Packages are installed under the constant OCI_ROOT, also when the archive
+    has a fixed prefix, which is specific to the archive, so that packages
+    shared between images have identical layers.
+
+    Args:
+        archive: coex archive.
+        output: Output image layout .tar.
+        work_dir: Scratch directory.
+        tag: Image reference name.
+
+    Returns:
+        Image manifest.
+
+    Raises:
+        ValueError: Archive is layered, or a package can not be relocated.
+
+    """
+    config = COEXBootstrapConfig.read_archive(str(archive))
+    if config.base:
+        raise ValueError(f"layered coex archives are not supported: {archive}")
+
+    run_dir = OCI_ROOT
+    conda_prefix = f"{OCI_ROOT}/conda"
+    usr_prefix = f"{run_dir}/usr"
+
+    binaries = COEXBootstrapBinaries(**COEXBootstrapBinaries.resolve())
+    with zipfile.ZipFile(str(archive)) as zf:
+        names = [i.filename for i in zf.infolist() if not i.is_dir()]
+    pkgs = sorted(n for n in names if n.startswith("pkgs/"))
+    srcs = sorted(n for n in names if n.startswith("srcs/"))
+
+    layout = ImageLayout(work_dir / "layout")
+    layers: List[Blob] = []
+    diff_ids: List[str] = []
+    package_dirs: List[Path] = []
+    info_dirs: List[Path] = []
+
+    for name in pkgs:
+        handle = ZipPkgHandle(str(archive), name, config.members.get(name))
+        package_dir = work_dir / "pkgs" / Path(name).name
+        package_dir.mkdir(parents=True)
+        handle.extract(binaries, str(package_dir))
+        package_dirs.append(package_dir)
+        info_dirs.append(Path(package_info_dir(str(package_dir), handle.dist)))
+
+    os_name, architecture = _platform(info_dirs)
+
+    for name, package_dir, info_dir in zip(pkgs, package_dirs, info_dirs):
+        logger.info("export layer %s prefix=%s", name, conda_prefix)
+        _prepare_package(package_dir, info_dir, conda_prefix)
+        layer, diff_id = layout.write_layer(package_dir, conda_prefix, name)
+        layers.append(layer)
+        diff_ids.append(diff_id)
+        shutil.rmtree(str(package_dir))
+
+    if srcs:
+        usr_dir = work_dir / "usr"
+        usr_dir.mkdir()
+        for name in srcs:
+            ZipPkgHandle(str(archive), name, config.members.get(name)).extract(
+                binaries, str(usr_dir)
+            )
+        layer, diff_id = layout.write_layer(usr_dir, usr_prefix, "srcs")
+        layers.append(layer)
+        diff_ids.append(diff_id)
+
+    env = {"PATH": DEFAULT_PATH}
+    activate_vars(env, conda_prefix, config.activate)
+    env.update(COEX_USR_PREFIX=usr_prefix, COEX_ROOT_PREFIX=run_dir)
+
+    if config.assets:
+        # Assets are plain files in the image, exposed as by the bootstrap
+        assets_dir = work_dir / "assets"
+        _extract_assets(archive, config, assets_dir)
+        layer, diff_id = layout.write_layer(assets_dir, run_dir, "assets")
+        layers.append(layer)
+        diff_ids.append(diff_id)
+
+        env["COEX_ASSETS"] = json.dumps(
+            {
+                name: [f"{run_dir}/assets/{name}", 0, asset["size"]]
+                for name, asset in config.assets.items()
+            },
+            sort_keys=True,
+        )
+        env["PYTHONPATH"] = f"{run_dir}/python"
+
+    image_config = layout.write_json(
+        CONFIG_MEDIA_TYPE,
+        {
+            "os": os_name,
+            "architecture": architecture,
+            "config": {
+                "Env": [f"{k}={v}" for k, v in sorted(env.items())],
+                "Entrypoint": _entrypoint(config.entrypoint, usr_prefix, env),
+                "WorkingDir": usr_prefix,
+            },
+            "rootfs": {"type": "layers", "diff_ids": diff_ids},
+            "history": [
+                {"created_by": f"coex export {layer.annotations[TITLE]}"}
+                for layer in layers
+            ],
+        },
+    )
+
+    manifest = {
+        "schemaVersion": 2,
+        "mediaType": MANIFEST_MEDIA_TYPE,
+        "config": image_config.descriptor(),
+        "layers": [layer.descriptor() for layer in layers],
+    }
+    manifest_blob = layout.write_json(MANIFEST_MEDIA_TYPE, manifest)
+    manifest_blob.annotations["org.opencontainers.image.ref.name"] = tag
+    (layout.path / "index.json").write_text(
+        json.dumps(
+            {"schemaVersion": 2, "manifests": [manifest_blob.descriptor()]},
+            sort_keys=True,
+        )
+    )
+
+    with tarfile.open(str(output), "w", format=tarfile.PAX_FORMAT) as tar:
+        for path in sorted(p for p in layout.path.rglob("*")):
+            info = tar.gettarinfo(str(path), str(path.relative_to(layout.path)))
+            info.mtime = 0
+            _normalize(info)
+            if info.isfile():
+                with open(str(path), "rb") as f:
+                    tar.addfile(info, f)
+            else:
+                tar.addfile(info)
+
+    return manifest
@@ -1,35 +1,83 @@
+import contextlib
+import hashlib
+import json
 import logging
 import os.path
-import platform
 import shutil
-import subprocess
+import stat
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from itertools import chain
 from pathlib import Path
-from typing import Set
+from typing import Collection, Dict, Iterable, Iterator, List, Optional, Tuple
 
+import attr
 from conda._vendor.boltons.setutils import IndexedSet
 from conda.base.context import context
-from conda.core.link import UnlinkLinkTransaction
 from conda.core.package_cache_data import PackageCacheData, ProgressiveFetchExtract
 from conda.core.solve import Solver
 from conda.models.channel import Channel, prioritize_channels
+from conda.models.match_spec import MatchSpec
 from conda.models.records import PackageCacheRecord, PackageRecord
 from conda_env.specs.yaml_file import YamlFileSpec
 
+from coex import cache
+from coex.activation import activation
+from coex.compress import (
+    Compression,
+    CompressionPolicy,
+    compress_tar,
+    entry_compression,
+)
+from coex_bootstrap.install import (
+    PaddingError,
+    package_info_dir,
+    prefix_placeholder,
+    read_has_prefix,
+    read_paths_json,
+    update_prefix,
+)
+
 logger = logging.getLogger(__name__)
 
+# Default root dir of fixed prefixes, see fixed_prefix
+FIXED_PREFIX_ROOT = "/tmp"
 
-def pkg_env(environment_file: Path, coex_path: Path, cache_dir: Path) -> None:
-    """Resolve, fetch, and repackage conda env into coex /pkgs directory.
+# Layout of repacked packages, recorded in the cache entry metadata so that
+# entries of an earlier layout are repacked
+REPACK_LAYOUT = 2
 
-    Resolve conda environment file to a specific package list via conda solver,
-    then fetch and unpack target packages. Repack into .coex package data in
-    cache_dir or reuse if pre-packed, and assemble into /pkgs under coex_path.
+# noarch python entry point, as conda's python_entry_point_template
+ENTRY_POINT_SCRIPT = """\
+#!{prefix}/bin/python
+# -*- coding: utf-8 -*-
+import re
+import sys
+
+from {module} import {import_name}
+
+if __name__ == '__main__':
+    sys.argv[0] = re.sub(r'(-script\\.pyw?|\\.exe)?$', '', sys.argv[0])
+    sys.exit({func}())
+"""
+
+
+def pinned_spec(dist: str) -> MatchSpec:
+    """Spec matching only the package name-version-build string dist."""
+    name, version, build = dist.rsplit("-", 2)
+    return MatchSpec(name=name, version=version, build=build)
+
+
+def solve(environment_file: Path, pinned: Collection[str] = ()) -> List[PackageRecord]:
+    """Resolve conda environment file to target package records.
 
     Args:
         environment_file: Standard conda env file, can not contain pip deps.
-        coex_path: Output coex build path.
-        cache_dir: Coex build cache directory.
+        pinned: Package name-version-build strings, eg. of a base layer, the
+            solved environment must include.
+
+    Returns:
+        Package records of the solved environment.
 
     """
     # Resolve environment file to dependencies
@@ -49,26 +97,40 @@ def pkg_env(environment_file: Path, coex_path: Path, cache_dir: Path) -> None:
     _channel_priority_map = prioritize_channels(channel_urls)
 
     # Setup an dummpy environment resolution for install into /dev/null
-    # Execute fetch-and-extract operations for required conda packages
     prefix = "/dev/null"
 
     channels = IndexedSet(Channel(url) for url in _channel_priority_map)
     subdirs = IndexedSet(os.path.basename(url) for url in _channel_priority_map)
 
-    solver = Solver(prefix, channels, subdirs, specs_to_add=env.dependencies["conda"])
-    transaction: UnlinkLinkTransaction = solver.solve_for_transaction()
+    # Base layer packages are pinned, so that the solve reuses them rather
+    # than other versions or builds, and fails if the env is incompatible
+    specs = list(env.dependencies["conda"]) + [pinned_spec(d) for d in sorted(pinned)]
+    solver = Solver(prefix, channels, subdirs, specs_to_add=specs)
+    records: List[PackageRecord] = list(solver.solve_final_state())
 
-    logging.info(transaction)
+    logging.info("solved records=%s", records)
 
-    transaction.download_and_extract()
+    return records
 
-    # Resolve all the, now extracted, target packages in the filesystem
-    fetcher: ProgressiveFetchExtract = transaction._pfe
 
-    target_records: Set[PackageRecord] = set(fetcher.link_precs)
-    logging.debug("target_records=%s", target_records)
+def fetch(records: Iterable[PackageRecord]) -> List[PackageCacheRecord]:
+    """Fetch and extract package records into the conda package cache.
 
-    extracted: Set[PackageCacheRecord] = {
+    Args:
+        records: Target package records.
+
+    Returns:
+        Extracted package cache records.
+
+    """
+    records = list(records)
+
+    # Execute fetch-and-extract operations for required conda packages
+    fetcher = ProgressiveFetchExtract(records)
+    fetcher.execute()
+
+    # Resolve all the, now extracted, target packages in the filesystem
+    extracted: List[PackageCacheRecord] = [
         next(
             (
                 pcrec
@@ -82,40 +144,776 @@ def pkg_env(environment_file: Path, coex_path: Path, cache_dir: Path) -> None:
             ),
             None,
         )
-        for precord in target_records
-    }
+        for precord in records
+    ]
 
     logging.debug("extracted=%s", extracted)
 
-    # Repackage into a single-file .zst in the cache, then copy into the output
-    # package.
-    output_path = coex_path / "pkgs"
+    return extracted
+
+
+def fixed_prefix(
+    records: Iterable[PackageRecord], root: str = FIXED_PREFIX_ROOT, key: str = ""
+) -> str:
+    """Deterministic install prefix for an environment's package records.
+
+    The prefix is `<root>/coex-<hash>/conda`, hashing the package records and
+    key, eg. the output archive name, so that archives of the same env do not
+    contend for one prefix. Under the default root, the prefix is no longer
+    than the legacy 32 character prefix placeholder, so that binary files may
+    always be relocated to the fixed prefix. Under a longer root, packages
+    with the legacy placeholder are repacked without relocation.
+
+    Args:
+        records: Package records of the environment.
+        root: Absolute root dir of the prefix, on the run hosts.
+        key: Additional prefix key.
+
+    """
+    env_hash = hashlib.sha256(
+        "\n".join(sorted(dist_name(r) for r in records) + [key]).encode("utf-8")
+    ).hexdigest()
+    return f"{root.rstrip('/')}/coex-{env_hash[:16]}/conda"
+
+
+@contextlib.contextmanager
+def retain_mtimes(package_dir: Path) -> Iterator[None]:
+    """Restore package mtimes after modifying the package in place.
+
+    Files and directories keep their mtime when modified, replaced or moved
+    within the package. New paths are stamped with the mtime of the package
+    info, so that modified packages are reproducible and bytecode caches of
+    the package stay valid.
+    """
+
+    def walk() -> Iterator[Tuple[Path, os.stat_result]]:
+        for path in chain([package_dir], package_dir.rglob("*")):
+            st = path.lstat()
+            if not stat.S_ISLNK(st.st_mode):
+                yield path, st
+
+    stamp = (package_dir / "info").stat().st_mtime_ns
+    path_mtimes = {}
+    inode_mtimes = {}
+    for path, st in walk():
+        path_mtimes[path] = inode_mtimes[st.st_dev, st.st_ino] = st.st_mtime_ns
+
+    yield
+
+    for path, st in walk():
+        mtime = path_mtimes.get(path, inode_mtimes.get((st.st_dev, st.st_ino), stamp))
+        os.utime(str(path), ns=(mtime, mtime))
+
+
+def _replace_text(path: Path, text: str) -> None:
+    """Replace file, rather than writing through any hard links to the file."""
+    path.unlink()
+    path.write_text(text)
+
+
+def relocate(package_dir: Path, prefix: str, info_dir: Optional[Path] = None) -> None:
+    """Relocate extracted package to prefix, in place.
+
+    Updates prefix files from their placeholder to prefix, and records the
+    relocated files in info/coex_prefix.json so the bootstrap can skip, or
+    redo, prefix updates at install time. Package mtimes are retained, so
+    that relocated packages are reproducible and bytecode caches stay valid.
+
+    Args:
+        package_dir: Extracted package directory.
+        prefix: Target install prefix.
+        info_dir: Package info directory, defaults to package_dir/info.
+
+    Raises:
+        PaddingError: Placeholder is too short for prefix.
+
+    """
+    info_dir = info_dir or package_dir / "info"
+
+    with retain_mtimes(package_dir):
+        if (info_dir / "paths.json").exists():
+            prefix_files = read_paths_json(str(info_dir / "paths.json"))
+        else:
+            prefix_files = read_has_prefix(str(info_dir / "has_prefix"))
+
+        relocated = {}
+        for f, (placeholder, mode) in sorted(prefix_files.items()):
+            logging.debug("relocate %s %s %s", package_dir.name, f, mode)
+            update_prefix(str(package_dir / f), prefix, placeholder, mode)
+            # Binary strings retain the unused placeholder length as null padding
+            slack = len(placeholder) - len(prefix) if mode == "binary" else 0
+            relocated[f] = (mode, slack)
+
+        with open(info_dir / "coex_prefix.json", "w") as coex_prefix:
+            json.dump(
+                dict(prefix=prefix, files=relocated),
+                coex_prefix,
+                indent=2,
+                sort_keys=True,
+            )
+
+
+def python_site_packages(records: Iterable[PackageRecord]) -> Optional[str]:
+    """Prefix relative site-packages dir of the env's python, None if no python."""
+    for record in records:
+        if record.name == "python":
+            major, minor = record.version.split(".")[:2]
+            return f"lib/python{major}.{minor}/site-packages"
+    return None
+
+
+def noarch_python(package_dir: Path) -> bool:
+    """Package is noarch python, with files relative to site-packages."""
+    for name in ("repodata_record.json", "index.json"):
+        path = package_dir / "info" / name
+        if path.exists():
+            return json.loads(path.read_text()).get("noarch") == "python"
+    return False
+
+
+def resolve_noarch(package_dir: Path, site_packages: str) -> None:
+    """Lay out extracted noarch python package for the env's python, in place.
+
+    Moves site-packages and python-scripts files to their install paths,
+    rewriting the package's prefix file paths, and writes the package entry
+    point scripts, as conda does at install time.
+
+    Args:
+        package_dir: Extracted package directory.
+        site_packages: Prefix relative site-packages dir of the env's python.
+
+    """
+    info_dir = package_dir / "info"
+    install_dirs = {"site-packages": site_packages, "python-scripts": "bin"}
+
+    def install_path(path: str) -> str:
+        top, sep, rest = path.partition("/")
+        return install_dirs[top] + sep + rest if top in install_dirs else path
+
+    noarch = {}
+    if (info_dir / "link.json").exists():
+        noarch = json.loads((info_dir / "link.json").read_text()).get("noarch", {})
+    elif (info_dir / "noarch.json").exists():
+        noarch = json.loads((info_dir / "noarch.json").read_text())
+
+    with retain_mtimes(package_dir):
+        for source, target in install_dirs.items():
+            if (package_dir / source).is_dir():
+                (package_dir / target).mkdir(parents=True, exist_ok=True)
+                for f in sorted((package_dir / source).iterdir()):
+                    f.rename(package_dir / target / f.name)
+                (package_dir / source).rmdir()
+
+        scripts = []
+        for entry_point in noarch.get("entry_points", []):
+            name, _, target = (s.strip() for s in entry_point.partition("="))
+            module, _, func = target.partition(":")
+            script = package_dir / "bin" / name
+            script.parent.mkdir(exist_ok=True)
+            script.write_text(
+                ENTRY_POINT_SCRIPT.format(
+                    prefix=prefix_placeholder,
+                    module=module,
+                    import_name=func.split(".")[0],
+                    func=func,
+                )
+            )
+            script.chmod(0o755)
+            scripts.append(f"bin/{name}")
+
+        if (info_dir / "paths.json").exists():
+            paths = json.loads((info_dir / "paths.json").read_text())
+            for entry in paths.get("paths", []):
+                entry["_path"] = install_path(entry["_path"])
+            paths.setdefault("paths", []).extend(
+                dict(
+                    _path=script,
+                    path_type="hardlink",
+                    file_mode="text",
+                    prefix_placeholder=prefix_placeholder,
+                )
+                for script in scripts
+            )
+            _replace_text(
+                info_dir / "paths.json", json.dumps(paths, indent=2, sort_keys=True)
+            )
+        elif (info_dir / "has_prefix").exists() or scripts:
+            prefix_files = read_has_prefix(str(info_dir / "has_prefix"))
+            lines = [
+                f'{placeholder} {mode} "{install_path(f)}"\n'
+                for f, (placeholder, mode) in sorted(prefix_files.items())
+            ]
+            lines += [f'{prefix_placeholder} text "{s}"\n' for s in scripts]
+            if (info_dir / "has_prefix").exists():
+                (info_dir / "has_prefix").unlink()
+            (info_dir / "has_prefix").write_text("".join(lines))
+
+
+def isolate_info(package_dir: Path) -> None:
+    """Move package info to its package specific dir, see package_info_dir."""
+    with retain_mtimes(package_dir):
+        (package_dir / "info").rename(package_dir / ".info")
+        info_dir = Path(package_info_dir(str(package_dir), package_dir.name))
+        info_dir.parent.mkdir()
+        (package_dir / ".info").rename(info_dir)
+
+
+def stage(extracted_dir: Path, stage_dir: Path) -> Path:
+    """Copy extracted package into stage_dir, hard linking files if possible.
+
+    Package files are replaced, rather than modified, when updated in the
+    staged copy, leaving the extracted package unchanged.
+    """
+    package_dir = stage_dir / extracted_dir.name
+    try:
+        shutil.copytree(
+            str(extracted_dir), str(package_dir), symlinks=True, copy_function=os.link
+        )
+    except (OSError, shutil.Error):
+        # Package cache on another file system
+        shutil.rmtree(str(package_dir), ignore_errors=True)
+        shutil.copytree(str(extracted_dir), str(package_dir), symlinks=True)
+    return package_dir
+
+
+def plan_chunks(package_dir: Path, chunk_size: int) -> List[List[str]]:
+    """Split package files into chunks, along file boundaries.
+
+    The first chunk holds all directories and the package info, chunks hold
+    up to chunk_size bytes of files unless a single file exceeds chunk_size.
+    Hard linked files are kept in a single chunk.
+
+    Args:
+        package_dir: Extracted package directory.
+        chunk_size: Target uncompressed chunk size.
+
+    Returns:
+        Package relative paths of each chunk.
+
+    """
+    dirs = []
+    files = []
+    for dirpath, dirnames, filenames in os.walk(str(package_dir)):
+        dirnames.sort()
+        for name in dirnames:
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                files.append(path)
+            else:
+                dirs.append(path)
+        files.extend(os.path.join(dirpath, name) for name in sorted(filenames))
+
+    def rel(path):
+        return os.path.relpath(path, str(package_dir))
+
+    chunks: List[List[str]] = [[rel(d) for d in dirs]]
+    chunk_sizes = [0]
+    linked: Dict[Tuple[int, int], int] = {}
+
+    for path in sorted(files, key=lambda p: not rel(p).startswith("info/")):
+        st = os.lstat(path)
+        key = (st.st_dev, st.st_ino)
+
+        if rel(path).startswith("info/"):
+            index = 0
+        elif st.st_nlink > 1 and key in linked:
+            index = linked[key]
+        elif chunk_sizes[-1] and chunk_sizes[-1] + st.st_size > chunk_size:
+            chunks.append([])
+            chunk_sizes.append(0)
+            index = len(chunks) - 1
+        else:
+            index = len(chunks) - 1
+
+        linked[key] = index
+        chunks[index].append(rel(path))
+        chunk_sizes[index] += st.st_size
+
+    return chunks
+
+
+def lay_out(
+    extracted_dir: Path,
+    stage_dir: Path,
+    prefix: Optional[str],
+    site_packages: Optional[str],
+) -> Path:
+    """Lay out a staged copy of extracted package for install.
+
+    Resolves noarch python packages to site_packages, relocates the package to
+    prefix, if the package's placeholders allow, and isolates the package info.
+
+    Returns:
+        Staged package directory.
+
+    """
+    package_dir = stage(extracted_dir, stage_dir)
+    if site_packages and noarch_python(package_dir):
+        resolve_noarch(package_dir, site_packages)
+
+    if prefix:
+        try:
+            relocate(package_dir, prefix)
+        except PaddingError:
+            logging.warning(
+                "unable to relocate package, placeholder too short: %s",
+                extracted_dir.name,
+            )
+            # Restage, discarding the partially relocated copy
+            shutil.rmtree(str(package_dir))
+            return lay_out(extracted_dir, stage_dir, None, site_packages)
+
+    isolate_info(package_dir)
+    return package_dir
+
+
+def repack(
+    extracted: PackageCacheRecord,
+    cache_dir: Path,
+    prefix: Optional[str] = None,
+    lease: Optional[cache.BuildLease] = None,
+    compression: CompressionPolicy = CompressionPolicy(),
+    chunk_size: Optional[int] = None,
+    site_packages: Optional[str] = None,
+) -> List[Path]:
+    """Repackage extracted package into .tar.zst chunks in the cache.
+
+    The package is laid out for install at build time. noarch python packages
+    are resolved to site_packages, and the package info is moved to its
+    package specific dir, so that packages are extracted concurrently, and
+    installed without file moves, by the bootstrap.
+
+    Args:
+        extracted: Extracted package cache record.
+        cache_dir: Coex build cache directory.
+        prefix: Fixed install prefix, package is relocated to prefix if given.
+        lease: Build lease, pinning the repacked package.
+        compression: Compression policy.
+        chunk_size: Split packages larger than chunk_size bytes into
+            independently decompressible chunks.
+        site_packages: Prefix relative site-packages dir of the env's python.
+
+    Returns:
+        Paths of repacked package chunks, reused if pre-packed. The first
+        chunk holds the package info, packages smaller than chunk_size are
+        repacked into a single chunk.
+
+    Raises:
+        ValueError: noarch python package in an env without python.
+
+    """
+    extracted_dir = Path(extracted.extracted_package_dir)
+    policy = compression.for_package(extracted.name)
+    chunked = bool(chunk_size) and cache.tree_size(extracted_dir) > chunk_size
+
+    pkgname = extracted_dir.name
+    if noarch_python(extracted_dir):
+        if not site_packages:
+            raise ValueError(
+                f"noarch python package in env without python: {extracted_dir.name}"
+            )
+        pkgname += "." + Path(site_packages).parent.name
+    if prefix:
+        pkgname += "." + hashlib.sha256(prefix.encode("utf-8")).hexdigest()[:16]
+    # Keyed by package content, so distinct builds of the same dist, eg. from
+    # different channels, do not share an entry in a shared cache
+    source_hash = getattr(extracted, "sha256", None) or getattr(extracted, "md5", None)
+    if source_hash:
+        pkgname += "." + source_hash[:16]
+    pkgname += compression.tag(policy)
+    if chunked:
+        pkgname += f".k{chunk_size}"
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    pkg_path = cache_dir / (pkgname + ".tar.zst")
+
+    if lease:
+        lease.pin(pkg_path)
+
+    cached = _cached_chunks(pkg_path, policy, chunked, lease)
+    if cached:
+        return cached
+
+    with cache.entry_lock(pkg_path):
+        # Repacked by a concurrent build, while waiting for the lock
+        cached = _cached_chunks(pkg_path, policy, chunked, lease)
+        if cached:
+            return cached
+
+        return _repack(
+            extracted_dir,
+            pkg_path,
+            prefix,
+            lease,
+            compression,
+            policy,
+            chunk_size if chunked else None,
+            site_packages,
+        )
+
+
+def _cached_chunks(
+    pkg_path: Path,
+    policy: str,
+    chunked: bool,
+    lease: Optional[cache.BuildLease],
+) -> Optional[List[Path]]:
+    # Chunk paths of the cached repacked package, None if incomplete or invalid
+    meta = cache.read_meta(pkg_path) or {}
+    cached = [pkg_path] + [pkg_path.parent / c for c in meta.get("chunks", [])]
+    if lease:
+        for chunk_path in cached[1:]:
+            lease.pin(chunk_path)
+
+    # Chunked packages are complete once recorded with their chunk list
+    complete = meta.get("layout") == REPACK_LAYOUT and ("chunks" in meta or not chunked)
+    if complete and all(
+        entry_compression(p, policy) and cache.check(p) for p in cached
+    ):
+        for chunk_path in cached:
+            cache.touch(chunk_path)
+        return cached
+    return None
+
+
+def _repack(
+    extracted_dir: Path,
+    pkg_path: Path,
+    prefix: Optional[str],
+    lease: Optional[cache.BuildLease],
+    compression: CompressionPolicy,
+    policy: str,
+    chunk_size: Optional[int],
+    site_packages: Optional[str],
+) -> List[Path]:
+    # Repack into pkg_path, and chunks if chunk_size, holding its entry_lock.
+    # Entries are renamed into place once written, see cache.new_entry
+    cache_dir = pkg_path.parent
+    pkgname = pkg_path.name[: -len(".tar.zst")]
+    with contextlib.ExitStack() as cstack:
+        # Lay out a copy of the extracted package
+        stage_dir = Path(tempfile.mkdtemp(prefix=".tmp_", dir=str(cache_dir)))
+        cstack.callback(shutil.rmtree, str(stage_dir))
+
+        package_dir = lay_out(extracted_dir, stage_dir, prefix, site_packages)
+
+        if not chunk_size:
+            # chdir to staged package directory and add all package dirs
+            tar_args = ["-C", str(package_dir)]
+            tar_args += sorted(f.name for f in package_dir.iterdir())
+            logging.info("packaging: %s policy=%s", tar_args, policy)
+            with cache.new_entry(pkg_path) as tmp_path:
+                pkg_compression = compress_tar(
+                    tar_args, tmp_path, policy, compression.auto_max_ms
+                )
+            cache.record(
+                pkg_path, compression=pkg_compression.as_dict(), layout=REPACK_LAYOUT
+            )
+            return [pkg_path]
+
+        list_dir = Path(tempfile.mkdtemp(prefix=".tmp_", dir=str(cache_dir)))
+        cstack.callback(shutil.rmtree, str(list_dir))
+
+        chunk_paths = [pkg_path]
+        for i, chunk in enumerate(plan_chunks(package_dir, chunk_size)):
+            if i:
+                chunk_paths.append(cache_dir / f"{pkgname}.c{i:04d}.tar.zst")
+                if lease:
+                    lease.pin(chunk_paths[i])
+
+            chunk_list = list_dir / f"chunk_{i}"
+            chunk_list.write_bytes(b"".join(os.fsencode(p) + b"\0" for p in chunk))
+
+            tar_args = ["-C", str(package_dir), "--no-recursion"]
+            tar_args += ["--null", "-T", str(chunk_list)]
+            logging.info("packaging: %s chunk=%i policy=%s", package_dir, i, policy)
+            with cache.new_entry(chunk_paths[i]) as tmp_path:
+                chunk_compression = compress_tar(
+                    tar_args, tmp_path, policy, compression.auto_max_ms
+                )
+            if i:
+                cache.record(chunk_paths[i], compression=chunk_compression.as_dict())
+            else:
+                pkg_compression = chunk_compression
+
+    # Record the package last, completing the cached chunk set
+    cache.record(
+        pkg_path,
+        compression=pkg_compression.as_dict(),
+        layout=REPACK_LAYOUT,
+        chunks=[p.name for p in chunk_paths[1:]],
+    )
+
+    return chunk_paths
+
+
+def dist_name(record: PackageRecord) -> str:
+    """Package name-version-build string, as used for repacked package names."""
+    return f"{record.name}-{record.version}-{record.build}"
+
+
+@attr.s(auto_attribs=True)
+class PkgEnv:
+    """Repacked conda environment."""
+
+    # Repacked packages, {package archive name : repacked package path}
+    packages: Dict[str, Path]
+    # Fixed install prefix of relocated packages
+    prefix: Optional[str] = None
+    # Additional package chunks, {package archive name : [chunk path]}
+    chunks: Dict[str, List[Path]] = attr.Factory(dict)
+    # Compression of repacked packages and chunks, {path : compression}
+    compression: Dict[Path, Compression] = attr.Factory(dict)
+    # Activation delta of the packages' activate.d scripts
+    activate: List[dict] = attr.Factory(list)
+    # Conda package identity of packages repacked without changes to their
+    # files, {package archive name : {name, version, build, sha256}}, see
+    # coex_bootstrap.host_pkgs
+    origins: Dict[str, Dict[str, str]] = attr.Factory(dict)
+
+    def add(
+        self,
+        extracted: PackageCacheRecord,
+        paths: List[Path],
+        compression: CompressionPolicy,
+    ) -> None:
+        """Add repacked package, as returned by repack."""
+        name = Path(extracted.extracted_package_dir).name + ".tar.zst"
+        self.packages[name] = paths[0]
+        if len(paths) > 1:
+            self.chunks[name] = paths[1:]
+
+        # Relocated and noarch python packages differ from the conda package
+        sha256 = getattr(extracted, "sha256", None)
+        if (
+            sha256
+            and self.prefix is None
+            and not noarch_python(Path(extracted.extracted_package_dir))
+        ):
+            self.origins[name] = dict(
+                name=extracted.name,
+                version=extracted.version,
+                build=extracted.build,
+                sha256=sha256,
+            )
+
+        for path in paths:
+            path_compression = entry_compression(
+                path, compression.for_package(extracted.name)
+            )
+            assert path_compression
+            self.compression[path] = path_compression
+
+
+def exclude_records(
+    records: List[PackageRecord], exclude: Collection[str] = ()
+) -> List[PackageRecord]:
+    """Filter package records provided by a base layer.
+
+    Args:
+        records: Solved package records.
+        exclude: Package name-version-build strings provided by a base layer.
+
+    Returns:
+        Records not in exclude.
+
+    Raises:
+        ValueError: Resolved package conflicts with an excluded package, eg.
+            of records not solved with exclude pinned, see solve.
+
+    """
+    excluded_names = {d.rsplit("-", 2)[0] for d in exclude}
+    target_records = []
+    for record in records:
+        if dist_name(record) in exclude:
+            logging.debug("exclude %s", record)
+        elif record.name in excluded_names:
+            raise ValueError(
+                "Package conflicts with base layer: %s"
+                % dict(record=dist_name(record), exclude=sorted(exclude))
+            )
+        else:
+            target_records.append(record)
+
+    return target_records
+
+
+def pkg_env(
+    environment_file: Path,
+    cache_dir: Path,
+    exclude: Collection[str] = (),
+    relocate_fixed: bool = False,
+    lease: Optional[cache.BuildLease] = None,
+    compression: CompressionPolicy = CompressionPolicy(),
+    chunk_size: Optional[int] = None,
+    fixed_prefix_root: str = FIXED_PREFIX_ROOT,
+    prefix_key: str = "",
+) -> PkgEnv:
+    """Resolve, fetch, and repackage conda env into cached coex packages.
+
+    Resolve conda environment file to a specific package list via conda solver,
+    then fetch and unpack target packages. Repack into .coex package data in
+    cache_dir or reuse if pre-packed.
+
+    Args:
+        environment_file: Standard conda env file, can not contain pip deps.
+        cache_dir: Coex build cache directory.
+        exclude: Package name-version-build strings provided by a base layer,
+            pinned in the solve, which are not included in the output.
+        relocate_fixed: Relocate packages to a deterministic, environment
+            specific, install prefix.
+        lease: Build lease, pinning repacked packages used by the build.
+        compression: Compression policy.
+        chunk_size: Split packages larger than chunk_size into chunks.
+        fixed_prefix_root: Root dir of the fixed prefix, see fixed_prefix.
+        prefix_key: Key of the fixed prefix, eg. the output archive name.
+
+    Returns:
+        Repacked packages.
+
+    Raises:
+        ValueError: Resolved package conflicts with an excluded package.
+
+    """
+    records = solve(environment_file, exclude)
+    target_records = exclude_records(records, exclude)
+
+    prefix = (
+        fixed_prefix(target_records, fixed_prefix_root, prefix_key)
+        if relocate_fixed
+        else None
+    )
+    # python may be provided by a base layer
+    site_packages = python_site_packages(records)
+    logging.info("prefix=%s site_packages=%s", prefix, site_packages)
+
+    # Repackage into a single-file .zst in the cache, packages are streamed
+    # from the cache into the output archive.
+    env = PkgEnv(packages={}, prefix=prefix)
+    extracted = fetch(target_records)
     for e in extracted:
-        extracted_dir = Path(e.extracted_package_dir)
-        pkgname = extracted_dir.name + ".tar.zst"
-
-        cache_dir.mkdir(parents=True, exist_ok=True)
-
-        if not (cache_dir / pkgname).exists():
-            pkg_cmd = (
-                # tar filtered through zstd
-                # Seeing errors on macos 10.13 image when using --use-compress-program
-                # with arguments, consider (a) installing conda-forge tar or (b) using
-                # a wrapper script if zstd arguments are needed
-                [
-                    "tar",
-                    "--use-compress-program",
-                    "zstd -T0" if platform.system() != "Darwin" else "zstd",
-                ]
-                # write to archive file
-                + ["-f", str(cache_dir / pkgname)]
-                # chdir to extracted package directory
-                + ["-C", str(extracted_dir)]
-                # and add all package dirs
-                + (["-c"] + [f.name for f in extracted_dir.iterdir()])
+        paths = repack(
+            e, cache_dir, prefix, lease, compression, chunk_size, site_packages
+        )
+        env.add(e, paths, compression)
+
+    env.activate = activation(
+        [Path(e.extracted_package_dir) for e in extracted], cache_dir
+    )
+    return env
+
+
+def pkg_envs(
+    environment_files: List[Path],
+    cache_dir: Path,
+    relocate_fixed: bool = False,
+    lease: Optional[cache.BuildLease] = None,
+    compression: CompressionPolicy = CompressionPolicy(),
+    chunk_size: Optional[int] = None,
+    jobs: Optional[int] = None,
+    fixed_prefix_root: str = FIXED_PREFIX_ROOT,
+    prefix_keys: Optional[List[str]] = None,
+) -> List[PkgEnv]:
+    """Resolve, fetch, and repackage many conda envs, sharing packages.
+
+    Envs are solved one at a time, over channel indexes loaded once. Packages
+    are fetched once for all envs, and each package is repacked once per
+    install prefix, so that build time scales with the unique packages.
+
+    Args:
+        environment_files: Standard conda env files.
+        cache_dir: Coex build cache directory.
+        relocate_fixed: Relocate packages to a deterministic, environment
+            specific, install prefix.
+        lease: Build lease, pinning repacked packages used by the builds.
+        compression: Compression policy.
+        chunk_size: Split packages larger than chunk_size into chunks.
+        jobs: Number of concurrent repacks, defaults to cpu count.
+        fixed_prefix_root: Root dir of the fixed prefixes, see fixed_prefix.
+        prefix_keys: Fixed prefix key of each environment file, eg. its
+            output archive name.
+
+    Returns:
+        Repacked packages of each environment file.
+
+    """
+    if not environment_files:
+        return []
+
+    # Solves share conda's process global context, solver and SubdirData
+    # caches, which are not thread safe. The channel indexes loaded by the
+    # first solve are reused by the remaining solves.
+    env_records = [solve(environment_file) for environment_file in environment_files]
+
+    with ThreadPoolExecutor(jobs or os.cpu_count()) as pool:
+        keys = prefix_keys or [""] * len(env_records)
+        prefixes = [
+            fixed_prefix(records, fixed_prefix_root, key) if relocate_fixed else None
+            for records, key in zip(env_records, keys)
+        ]
+
+        unique = {dist_name(r): r for records in env_records for r in records}
+        logging.info("pkg_envs envs=%i packages=%i", len(env_records), len(unique))
+        extracted = dict(zip(unique, fetch(unique.values())))
+
+        noarch = {
+            dist: noarch_python(Path(e.extracted_package_dir))
+            for dist, e in extracted.items()
+        }
+        env_site_packages = [python_site_packages(records) for records in env_records]
+
+        def target(
+            record: PackageRecord, prefix: Optional[str], site_packages: Optional[str]
+        ) -> Tuple[str, Optional[str], Optional[str]]:
+            dist = dist_name(record)
+            return dist, prefix, site_packages if noarch[dist] else None
+
+        def repack_target(target: Tuple[str, Optional[str], Optional[str]]):
+            dist, prefix, site_packages = target
+            return repack(
+                extracted[dist],
+                cache_dir,
+                prefix,
+                lease,
+                compression,
+                chunk_size,
+                site_packages,
+            )
+
+        # Repack each package once per install prefix, and noarch python
+        # packages once per python
+        targets = list(
+            dict.fromkeys(
+                target(r, prefix, site_packages)
+                for records, prefix, site_packages in zip(
+                    env_records, prefixes, env_site_packages
+                )
+                for r in records
+            )
+        )
+        repacked = dict(zip(targets, pool.map(repack_target, targets)))
+
+        env_activate = list(
+            pool.map(
+                lambda records: activation(
+                    [
+                        Path(extracted[dist_name(r)].extracted_package_dir)
+                        for r in records
+                    ],
+                    cache_dir,
+                ),
+                env_records,
             )
-            logging.info("packaging: %s", pkg_cmd)
-            subprocess.check_call(pkg_cmd)
+        )
+
+    envs = []
+    for records, prefix, site_packages, activate in zip(
+        env_records, prefixes, env_site_packages, env_activate
+    ):
+        env = PkgEnv(packages={}, prefix=prefix, activate=activate)
+        for r in records:
+            paths = repacked[target(r, prefix, site_packages)]
+            env.add(extracted[dist_name(r)], paths, compression)
+        envs.append(env)
 
-        output_path.mkdir(parents=True, exist_ok=True)
-        shutil.copyfile(cache_dir / pkgname, output_path / pkgname)
+    return envs
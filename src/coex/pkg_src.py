@@ -1,36 +1,140 @@
+import hashlib
 import logging
-import platform
-import subprocess
+import os
 from pathlib import Path
-from typing import List
+from typing import Collection, Dict, List, Optional
+
+from coex import cache
+from coex.compress import (
+    CompressionPolicy,
+    compress_tar,
+    entry_compression,
+    source_date_epoch,
+)
 
 logger = logging.getLogger(__name__)
 
+# Alignment of asset data in archives, a multiple of the mmap allocation
+# granularity on all supported platforms
+ASSET_ALIGN = 1 << 16
+
+
+def asset_files(paths: List[str]) -> Dict[str, Path]:
+    """Asset files under paths, by asset name, their normalized relative path.
+
+    Raises:
+        ValueError: Asset path is outside the working directory.
+
+    """
+    assets = {}
+    for path in paths:
+        files = sorted(p for p in Path(path).rglob("*") if p.is_file())
+        for f in [Path(path)] if Path(path).is_file() else files:
+            name = os.path.normpath(str(f))
+            if os.path.isabs(name) or name.startswith(".."):
+                raise ValueError(f"asset outside the working directory: {f}")
+            assets[Path(name).as_posix()] = f
+    return assets
+
+
+def source_tree_hash(sources: List[str], exclude: Collection[str] = ()) -> str:
+    """Hash of source tree paths and file metadata.
+
+    Covers the relative path, mode, size, mtime and link target of every file
+    under sources, matching the information used by incremental build tools to
+    detect modified files without reading file contents. Excluded paths are
+    not covered.
+    """
+    digest = hashlib.sha256()
+    excluded = {os.path.normpath(p) for p in exclude}
+    for path in sorted(excluded):
+        digest.update(f"exclude\0{path}\n".encode("utf-8", "surrogateescape"))
+
+    def update(path: str) -> None:
+        if os.path.normpath(path) in excluded:
+            return
+        st = os.lstat(path)
+        link = os.readlink(path) if os.path.islink(path) else ""
+        entry = f"{path}\0{st.st_mode}\0{st.st_size}\0{st.st_mtime_ns}\0{link}\n"
+        digest.update(entry.encode("utf-8", "surrogateescape"))
+
+    for source in sources:
+        update(source)
+        if os.path.isdir(source) and not os.path.islink(source):
+            for dirpath, dirnames, filenames in os.walk(source):
+                dirnames.sort()
+                for name in dirnames + sorted(filenames):
+                    update(os.path.join(dirpath, name))
+
+    return digest.hexdigest()
 
-def pkg_src(sources: List[str], coex_path: Path) -> None:
-    """Compress usr sources into coex /srcs."""
+
+def _reuse(src_path: Path, policy: str) -> bool:
+    # Reuse the cached sources archive, if complete and valid
+    if entry_compression(src_path, policy) and cache.check(src_path):
+        logger.info("pkg_src reuse %s", src_path)
+        cache.touch(src_path)
+        return True
+    return False
+
+
+def pkg_src(
+    sources: List[str],
+    cache_dir: Path,
+    lease: Optional[cache.BuildLease] = None,
+    compression: CompressionPolicy = CompressionPolicy(),
+    exclude: Collection[str] = (),
+) -> Optional[Path]:
+    """Compress usr sources into cached .tar.zst.
+
+    Reuses cached sources archive if the source tree hash is unchanged. File
+    mtimes are clamped to SOURCE_DATE_EPOCH, if set, for reproducible builds.
+
+    Args:
+        sources: Source paths.
+        cache_dir: Coex source cache directory.
+        lease: Build lease, pinning the source archive.
+        compression: Compression policy, sources use the default policy.
+        exclude: Paths under sources not included, eg. assets.
+
+    Returns:
+        Path of source archive, None if no sources.
+
+    """
 
     if not sources:
         logger.info("no sources")
-        return
-
-    (coex_path / "srcs").mkdir(parents=True)
-
-    cmd = (
-        # tar filtered through zstd
-        # Seeing errors on macos 10.13 image when using --use-compress-program
-        # with arguments, consider (a) installing conda-forge tar or (b) using
-        # a wrapper script if zstd arguments are needed
-        [
-            "tar",
-            "--use-compress-program",
-            "zstd -T0" if platform.system() != "Darwin" else "zstd",
-        ]
-        # write to archive file
-        + ["-f", str(coex_path / "srcs" / "src.tar.zst")]
+        return None
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    policy = compression.default
+    epoch = source_date_epoch()
+    src_name = source_tree_hash(sources, exclude)
+    if epoch is not None:
+        src_name += f".e{epoch}"
+    src_path = cache_dir / (src_name + compression.tag(policy) + ".tar.zst")
+    if lease:
+        lease.pin(src_path)
+
+    if _reuse(src_path, policy):
+        return src_path
+
+    with cache.entry_lock(src_path):
+        # Written by a concurrent build, while waiting for the lock
+        if _reuse(src_path, policy):
+            return src_path
+
         # include all specified sources
-        + (["-c"] + list(sources))
-    )
-    logger.info("pkg_src %r", cmd)
+        logger.info("pkg_src %r policy=%s epoch=%s", sources, policy, epoch)
+        tar_args = [f"--exclude={os.path.normpath(p)}" for p in sorted(exclude)]
+        with cache.new_entry(src_path) as tmp_path:
+            src_compression = compress_tar(
+                tar_args + list(sources),
+                tmp_path,
+                policy,
+                compression.auto_max_ms,
+                epoch,
+            )
+        cache.record(src_path, compression=src_compression.as_dict())
 
-    subprocess.check_call(cmd)
+    return src_path
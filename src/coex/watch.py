@@ -0,0 +1,124 @@
+"""Incremental source rebuilds of .coex archives, for development.
+
+Archives are written with the bootstrap config and sources as their final
+members, so that a source change only rewrites the archive tail in place.
+The solved environment and package members are kept, and rebuild latency is
+that of compressing the changed sources.
+"""
+
+import json
+import logging
+import time
+from pathlib import Path
+from typing import Collection, List, Optional
+
+from coex import cache
+from coex.archive import ArchiveWriter
+from coex.compress import CompressionPolicy, entry_compression
+from coex.pkg_src import pkg_src, source_tree_hash
+from coex_bootstrap.config import COEXBootstrapConfig
+from coex_bootstrap.verify import HASH_NAME, file_hash
+
+logger = logging.getLogger(__name__)
+
+CONFIG_MEMBER = "coex_bootstrap.json"
+SRCS_MEMBER = "srcs/src.tar.zst"
+
+# Source tree poll interval, seconds
+POLL_INTERVAL = 0.5
+
+
+def write_tail(
+    archive: ArchiveWriter, config: COEXBootstrapConfig, srcs: Optional[Path]
+) -> None:
+    """Write the archive's final members, bootstrap config and sources."""
+    config_json = json.dumps(config.as_dict(), indent=2, sort_keys=True)
+    archive.writestr(CONFIG_MEMBER, config_json.encode("utf-8"))
+    if srcs:
+        archive.add(srcs, SRCS_MEMBER)
+
+
+def update_sources(
+    output: Path, srcs: Optional[Path], compression: CompressionPolicy
+) -> None:
+    """Replace the sources of .coex archive in place.
+
+    Args:
+        output: .coex archive, written by write_coex.
+        srcs: Compressed usr sources.
+        compression: Compression policy of the build.
+
+    Raises:
+        ValueError: Archive can not be updated in place.
+
+    """
+    config = COEXBootstrapConfig.read_archive(str(output))
+    config.members.pop(SRCS_MEMBER, None)
+    if srcs:
+        src_compression = entry_compression(srcs, compression.default)
+        assert src_compression
+        config.members[SRCS_MEMBER] = dict(compression=src_compression.as_dict())
+        config.members[SRCS_MEMBER][HASH_NAME] = file_hash(str(srcs))
+
+    with ArchiveWriter(output, replace_from=CONFIG_MEMBER) as archive:
+        write_tail(archive, config, srcs)
+
+
+class SourceWatcher:
+    """Rebuild the sources of a .coex archive as the source tree changes.
+
+    Polls the source tree metadata hash, as used to cache sources, rather than
+    depending on filesystem notification APIs.
+    """
+
+    def __init__(
+        self,
+        output: Path,
+        sources: List[str],
+        cache_dir: Path,
+        compression: CompressionPolicy = CompressionPolicy(),
+        lease: Optional[cache.BuildLease] = None,
+        exclude: Collection[str] = (),
+    ):
+        """Init watcher of sources, built into output.
+
+        Args:
+            output: .coex archive, written by write_coex from sources.
+            sources: Source paths.
+            cache_dir: Coex source cache directory.
+            compression: Compression policy of the build.
+            lease: Build lease, pinning rebuilt source archives.
+            exclude: Paths under sources not included, eg. assets.
+
+        """
+        self.output = output
+        self.sources = sources
+        self.cache_dir = cache_dir
+        self.compression = compression
+        self.lease = lease
+        self.exclude = exclude
+        self.tree_hash = source_tree_hash(sources, exclude) if sources else None
+
+    def poll(self) -> bool:
+        """Rebuild sources if the source tree changed, returning if rebuilt."""
+        if not self.sources:
+            return False
+
+        tree_hash = source_tree_hash(self.sources, self.exclude)
+        if tree_hash == self.tree_hash:
+            return False
+
+        start = time.time()
+        srcs = pkg_src(
+            self.sources, self.cache_dir, self.lease, self.compression, self.exclude
+        )
+        update_sources(self.output, srcs, self.compression)
+        self.tree_hash = tree_hash
+        logger.info("rebuilt %s in %.3fs", self.output, time.time() - start)
+        return True
+
+    def run(self, interval: float = POLL_INTERVAL) -> None:
+        """Poll for source changes until interrupted."""
+        while True:
+            time.sleep(interval)
+            self.poll()
@@ -1,34 +1,44 @@
 from __future__ import print_function
 
-import argparse
 import logging
 import os
 import os.path
-import pkgutil
 import shutil
 import subprocess
 import sys
+import threading
 import time
 import zipimport
 from collections import defaultdict
-from distutils.util import strtobool
 
 from coex_bootstrap.activate import activate_env
 from coex_bootstrap.binaries import COEXBootstrapBinaries
 from coex_bootstrap.config import COEXBootstrapConfig
-from coex_bootstrap.install import post_extract
+from coex_bootstrap.install import PaddingError, package_info_dir, post_extract
 from coex_bootstrap.unpack import file_pkgs, zip_pkgs
+from coex_bootstrap.verify import IntegrityError, is_verified, mark_verified
 
-try:
+# Modules used off the common launch path, eg. argparse and layers, are
+# imported where used, the bootstrap is imported on every coex launch.
+MYPY = False
+if MYPY:
     import typing
-except ImportError:
-    pass
+
+    from coex_bootstrap.prefetch import Prefetcher
+    from coex_bootstrap.stream import StreamInstall
+    from coex_bootstrap.unpack import PkgHandle
 
 
 class SectionTimer(object):
-    """Accumulate timers into sections."""
+    """Accumulate timers into sections.
+
+    Sections are wall time, except for sections suffixed "_threads", timed
+    by each of the threads of a concurrent section, eg. install_pkgs, which
+    sum the time of all threads.
+    """
 
     sections = defaultdict(float)  # type: typing.Dict[str, float]
+    lock = threading.Lock()
 
     def __init__(self, name):
         # type: (str) -> None
@@ -45,7 +55,24 @@ class SectionTimer(object):
     def __exit__(self, *args):  # noqa: D
         # type: (*typing.Any) -> None
         self.span = time.time() - self.start
-        self.sections[self.name] += self.span
+        with self.lock:
+            self.sections[self.name] += self.span
+
+
+def strtobool(value):
+    # type: (str) -> bool
+    """Convert truth value string to bool, as distutils.util.strtobool.
+
+    Raises:
+        ValueError: Invalid truth value.
+
+    """
+    value = value.lower()
+    if value in ("y", "yes", "t", "true", "on", "1"):
+        return True
+    elif value in ("n", "no", "f", "false", "off", "0"):
+        return False
+    raise ValueError("invalid truth value %r" % (value,))
 
 
 class COEXOptions(object):
@@ -54,6 +81,14 @@ class COEXOptions(object):
     work_dir = "/tmp"
     cleanup = True
     log_level = None
+    base_path = None  # type: typing.Optional[str]
+    concurrency = None  # type: typing.Optional[int]
+    prefetch = "auto"
+    install_dir = None  # type: typing.Optional[str]
+    prefix_dir = None  # type: typing.Optional[str]
+    metrics_log = None  # type: typing.Optional[str]
+    verify = False
+    pkgs_dirs = None  # type: typing.Optional[str]
     program_args = []  # type: typing.List[str]
 
     def __init__(self, args=None):
@@ -66,6 +101,41 @@ class COEXOptions(object):
         if args is None:
             args = sys.argv[1:]
 
+        self.work_dir = os.environ.get("COEX_WORK_DIR", self.work_dir)
+        if "COEX_CLEANUP" in os.environ:
+            self.cleanup = strtobool(os.environ["COEX_CLEANUP"])
+        self.base_path = os.environ.get("COEX_BASE_PATH", self.base_path)
+        self.log_level = os.environ.get("COEX_LOG_LEVEL", self.log_level)
+        if "COEX_CONCURRENCY" in os.environ:
+            self.concurrency = int(os.environ["COEX_CONCURRENCY"])
+        self.prefetch = os.environ.get("COEX_PREFETCH", self.prefetch)
+        self.install_dir = os.environ.get("COEX_INSTALL", self.install_dir)
+        self.prefix_dir = os.environ.get("COEX_PREFIX", self.prefix_dir)
+        self.metrics_log = os.environ.get("COEX_METRICS_LOG", self.metrics_log)
+        if "COEX_VERIFY" in os.environ:
+            self.verify = strtobool(os.environ["COEX_VERIFY"])
+        self.pkgs_dirs = os.environ.get("COEX_PKGS_DIRS", self.pkgs_dirs)
+
+        if strtobool(os.environ.get("COEX_ARGS", "false")):
+            if "--" in args:
+                split_idx = args.index("--")
+                self.parse_args(args[:split_idx])
+                self.program_args = args[split_idx:][1:]
+            else:
+                self.parse_args(args)
+                self.program_args = []
+        else:
+            self.program_args = args
+
+    def parse_args(self, cex_args):
+        # type: (typing.List[str]) -> None
+        """Parse coex control args, overriding env options.
+
+        Args:
+            cex_args: Command line args preceding the program args.
+        """
+        import argparse
+
         parser = argparse.ArgumentParser(
             ".cex trampoline",
             usage="Control variables for the conda executable packages",
@@ -75,38 +145,89 @@ class COEXOptions(object):
             "--work_dir",
             type=str,
             help="Work directory to cex unpack and run. Override: COEX_WORK_DIR",
-            default=os.environ.get("COEX_WORK_DIR", self.work_dir),
+            default=self.work_dir,
         )
         parser.add_argument(
             "--cleanup",
-            type=bool,
+            type=strtobool,
             help="Remove environment after run. Override: COEX_CLEANUP",
-            default=os.environ.get("COEX_CLEANUP", self.cleanup),
+            default=self.cleanup,
+        )
+        parser.add_argument(
+            "--base-path",
+            dest="base_path",
+            type=str,
+            help="Search path for base layer coex files, os.pathsep separated. "
+            "Override: COEX_BASE_PATH",
+            default=self.base_path,
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            help="Packages installed concurrently, defaults to the cpu count. "
+            "Override: COEX_CONCURRENCY",
+            default=self.concurrency,
+        )
+        parser.add_argument(
+            "--prefetch",
+            choices=["auto", "willneed", "read", "off"],
+            help="Prefetch package members ahead of extraction, for archives "
+            "on network filesystems. Override: COEX_PREFETCH",
+            default=self.prefetch,
+        )
+        parser.add_argument(
+            "--install",
+            dest="install_dir",
+            type=str,
+            help="Install environment and sources into a persistent directory, "
+            "without running the entrypoint. Override: COEX_INSTALL",
+            default=self.install_dir,
+        )
+        parser.add_argument(
+            "--prefix",
+            dest="prefix_dir",
+            type=str,
+            help="Run from a persistent directory installed via --install, "
+            "unpacking as usual if not installed from this coex. "
+            "Override: COEX_PREFIX",
+            default=self.prefix_dir,
+        )
+        parser.add_argument(
+            "--metrics-log",
+            dest="metrics_log",
+            type=str,
+            help="Append launch metrics, section times and bytes extracted, to "
+            "a size-capped local log, summarized by `coex stats`. "
+            "Override: COEX_METRICS_LOG",
+            default=self.metrics_log,
+        )
+        parser.add_argument(
+            "--verify",
+            type=strtobool,
+            help="Verify members against their recorded hashes as they are "
+            "extracted, once per unchanged archive on a host. Override: COEX_VERIFY",
+            default=self.verify,
+        )
+        parser.add_argument(
+            "--pkgs-dirs",
+            dest="pkgs_dirs",
+            type=str,
+            help="Link packages found in host conda package caches, os.pathsep "
+            "separated, or 'conda' for the host conda's caches, rather than "
+            "extracting them. Override: COEX_PKGS_DIRS",
+            default=self.pkgs_dirs,
         )
         parser.add_argument(
             "--log-level",
             dest="log_level",
             choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
             help="Log COEX status to stderr. Override: COEX_LOG_LEVEL",
-            default=os.environ.get("COEX_LOG_LEVEL", self.log_level),
+            default=self.log_level,
         )
 
-        if strtobool(os.environ.get("COEX_ARGS", "false")):
-            if "--" in args:
-                split_idx = args.index("--")
-                cex_args = args[:split_idx]
-                program_args = args[split_idx:][1:]
-            else:
-                cex_args = args
-                program_args = []
-        else:
-            cex_args = []
-            program_args = args
-
         parsed = parser.parse_args(cex_args)
         for k, v in parsed.__dict__.items():
             setattr(self, k, v)
-        self.program_args = program_args
 
     def __repr__(self):  # noqa: D
         return "COEXOptions(%s)" % self.__dict__
@@ -141,100 +262,599 @@ def resolve_entrypoint(entrypoint, prefix_dir):
         return os.path.join(prefix_dir, entrypoint)
 
 
-def main(__name__, __file__, options):
-    # type: (str, str, COEXOptions) -> None
-    """Main bootstrap entrypoint.
+def main_archive(name):
+    # type: (str) -> typing.Optional[str]
+    """Path of the coex archive main module name is run from, None if unpacked."""
+    loader = getattr(sys.modules.get(name), "__loader__", None)
+    if isinstance(loader, zipimport.zipimporter):
+        return loader.archive
+    return None
+
 
-    Main bootstrap, unpacks coex and executes entrypoint program.
+def claim_prefix_dir(prefix):
+    # type: (typing.Optional[str]) -> typing.Optional[str]
+    """Claim parent dir of fixed prefix as the run dir.
 
     Args:
-        __name__: __name__ of main module.
-        __file__: __file__ of main module.
-        options: Initialized COEXOptions.
+        prefix: Fixed conda prefix from COEXBootstrapConfig.
+
+    Returns:
+        Claimed run dir, or None if no fixed prefix or the prefix is in use.
 
     """
-    with SectionTimer("total"):
-        if options.log_level:
-            logging.basicConfig(level=logging.getLevelName(options.log_level))
+    if not prefix:
+        return None
 
-        logging.info("options=%s", options)
+    run_dir = os.path.dirname(prefix)
+    try:
+        os.mkdir(run_dir)
+    except OSError as ex:
+        logging.info("fixed prefix unavailable run_dir=%s ex=%s", run_dir, ex)
+        return None
 
-        config = COEXBootstrapConfig.read_from(package=__name__)
-        logging.info("config=%s", config)
+    return run_dir
 
-        run_dir = os.path.join(
-            options.work_dir, "%s_%i" % (os.path.basename(__file__), os.getpid())
-        )
-        logging.info("run_dir=%s", run_dir)
-        os.makedirs(run_dir)
 
-        conda_dir = os.path.join(run_dir, "conda")
-        logging.info("run_dir=%s", run_dir)
+def split_threads(concurrency, count):
+    # type: (typing.Optional[int], int) -> typing.Tuple[int, int]
+    """Split a thread budget between count packages, and within each package.
+
+    Each package extracts its chunks, and updates its prefix files, on a pool
+    of its own. Pools are sized so that the threads of all packages installed
+    concurrently are within the budget, rather than each sized to the host.
+
+    Args:
+        concurrency: Thread budget, defaults to cpu count.
+        count: Packages to install.
+
+    Returns:
+        Packages installed concurrently, and the threads of each package.
+
+    """
+    if concurrency is None:
+        import multiprocessing
+
+        concurrency = multiprocessing.cpu_count()
+    workers = max(1, min(concurrency, count))
+    return workers, max(1, concurrency // workers)
+
+
+def install_pkgs(
+    pkgs,  # type: typing.List[PkgHandle]
+    coex_binaries,  # type: COEXBootstrapBinaries
+    conda_dir,  # type: str
+    concurrency=None,  # type: typing.Optional[int]
+    prefetcher=None,  # type: typing.Optional[Prefetcher]
+):
+    # type: (...) -> None
+    """Unpack and install conda packages into conda_dir.
+
+    Packages are laid out for install at build time, with package specific
+    info dirs, so are extracted and installed concurrently in any order.
+
+    Args:
+        pkgs: Package handles.
+        coex_binaries: Unpacked coex bootstrap binaries.
+        conda_dir: Conda env prefix.
+        concurrency: Thread budget of the install, see split_threads,
+            defaults to cpu count.
+        prefetcher: Prefetch of pkgs, advanced as packages are extracted.
+
+    """
+    workers, threads = split_threads(concurrency, len(pkgs))
+
+    def install(p):
+        # type: (PkgHandle) -> None
+        if prefetcher:
+            prefetcher.extracting(p)
+        with SectionTimer("extract_threads"):
+            p.extract(coex_binaries, conda_dir, threads)
+
+        with SectionTimer("post_extract_threads"):
+            logging.debug("post_extract pkg=%s prefix=%s", p, conda_dir)
+            post_extract(conda_dir, package_info_dir(conda_dir, p.dist), threads)
+
+    try:
+        if workers <= 1:
+            for p in pkgs:
+                install(p)
+        else:
+            from multiprocessing.pool import ThreadPool
+
+            pool = ThreadPool(workers)
+            try:
+                for _ in pool.imap_unordered(install, pkgs):
+                    pass
+            finally:
+                pool.terminate()
+                pool.join()
+    except PaddingError as ex:
+        f, placeholder = ex.args
+        sys.exit("ERROR: placeholder '%s' too short in: %s\n" % (placeholder, f))
+    except IntegrityError as ex:
+        sys.exit("ERROR: %s\n" % ex)
+
+    if os.path.isdir(os.path.join(conda_dir, "info")):
+        os.rmdir(os.path.join(conda_dir, "info"))
+
+
+def install_base(
+    base,  # type: typing.Dict[str, str]
+    search_path,  # type: typing.List[str]
+    work_dir,  # type: str
+    coex_binaries,  # type: COEXBootstrapBinaries
+    concurrency=None,  # type: typing.Optional[int]
+    prefetch_mode="off",  # type: str
+    verify=False,  # type: bool
+):
+    # type: (...) -> str
+    """Install base layer into shared work_dir prefix, or reuse if installed.
+
+    Args:
+        base: Base layer reference from COEXBootstrapConfig.
+        search_path: Directories searched for base archive.
+        work_dir: coex work directory.
+        coex_binaries: Unpacked coex bootstrap binaries.
+        concurrency: Packages installed concurrently, defaults to cpu count.
+        prefetch_mode: Prefetch mode of the base packages.
+        verify: Verify the base packages, unless the base archive is verified.
+
+    Returns:
+        Base layer conda prefix.
+
+    Raises:
+        ValueError: Base archive not found in search_path.
+
+    """
+    from coex_bootstrap.layers import (
+        base_dirs,
+        file_lock,
+        find_base,
+        makedirs,
+        read_stamp,
+        write_stamp,
+    )
+
+    base_dir, conda_dir = base_dirs(base, work_dir)
+
+    if read_stamp(base_dir) == base["archive_id"]:
+        logging.info("reuse base base_dir=%s", base_dir)
+        return conda_dir
+
+    makedirs(base_dir)
+    with file_lock(base_dir + ".lock"):
+        if read_stamp(base_dir) == base["archive_id"]:
+            logging.info("reuse base base_dir=%s", base_dir)
+            return conda_dir
+
+        base_archive = find_base(base, search_path)
+        if base_archive is None:
+            raise ValueError(
+                "Unable to find base layer: %s"
+                % dict(base=base, search_path=search_path)
+            )
+        logging.info("install base base_archive=%s base_dir=%s", base_archive, base_dir)
+
+        if os.path.exists(conda_dir):
+            shutil.rmtree(conda_dir)
         os.makedirs(conda_dir)
 
-        with SectionTimer("get_binaries"):
-            coex_binaries = COEXBootstrapBinaries.unpack(run_dir, __name__)
-            logging.debug("coex_binaries %s", coex_binaries)
+        from coex_bootstrap.prefetch import prefetch
 
-        ### Unpack and install conda packages
-        with SectionTimer("get_pkgs"):
-            loader = pkgutil.get_loader(__name__)
-            if isinstance(loader, zipimport.zipimporter):
-                pkgs = zip_pkgs(loader.archive, "pkgs/?*")
-            else:
-                pkgs = file_pkgs(os.path.dirname(__file__), "pkgs/*")
-        logging.debug("pkgs=%s", pkgs)
+        base_config = COEXBootstrapConfig.read_archive(base_archive)
+        verify = verify and not is_verified(work_dir, base_archive)
+        base_pkgs = zip_pkgs(base_archive, "pkgs/?*", base_config.members, verify)
+        with prefetch(base_pkgs, prefetch_mode, SectionTimer.sections) as prefetcher:
+            install_pkgs(base_pkgs, coex_binaries, conda_dir, concurrency, prefetcher)
+        if verify:
+            mark_verified(work_dir, base_archive)
+        write_stamp(base_dir, base["archive_id"])
 
-        # Horrid hack, unpack python first so we can noarch packages
-        for p in sorted(
-            pkgs, key=lambda v: 0 if v.name.startswith("pkgs/python-") else 1
-        ):
-            with SectionTimer("extract"):
-                p.extract(coex_binaries, conda_dir)
+    return conda_dir
+
+
+def install(
+    config,  # type: COEXBootstrapConfig
+    options,  # type: COEXOptions
+    package,  # type: str
+    package_dir,  # type: str
+    run_dir,  # type: str
+    conda_dir,  # type: str
+    shared_base=True,  # type: bool
+):
+    # type: (...) -> str
+    """Install coex env into conda_dir, and sources into run_dir/usr.
+
+    Args:
+        config: coex bootstrap config.
+        options: Initialized COEXOptions.
+        package: coex package, zipped or unpacked.
+        package_dir: Directory of the coex package.
+        run_dir: Run directory, holding the unpacked binaries and sources.
+        conda_dir: Conda env prefix.
+        shared_base: Run from the shared base layer prefix, rather than
+            conda_dir, if the coex has no packages over its base.
+
+    Returns:
+        Installed conda env prefix.
+
+    """
+    with SectionTimer("get_binaries"):
+        coex_binaries = COEXBootstrapBinaries.unpack(run_dir, package)
+        logging.debug("coex_binaries %s", coex_binaries)
+
+    ### Unpack and install conda packages
+    with SectionTimer("get_pkgs"):
+        archive = main_archive(package)
+        # Unpacked packages are verified on every run
+        verify = options.verify and not (
+            archive and is_verified(options.work_dir, archive)
+        )
+        if archive:
+            pkgs = zip_pkgs(archive, "pkgs/?*", config.members, verify)
+        else:
+            pkgs = file_pkgs(package_dir, "pkgs/*", config.members, verify)
+    logging.debug("pkgs=%s", pkgs)
+
+    linked = []  # type: typing.List[PkgHandle]
+    if options.pkgs_dirs:
+        from coex_bootstrap.host_pkgs import host_pkgs, resolve_pkgs_dirs
+
+        with SectionTimer("host_pkgs"):
+            pkgs, linked = host_pkgs(pkgs, resolve_pkgs_dirs(options.pkgs_dirs))
+
+    if config.base:
+        with SectionTimer("base"):
+            search_path = (
+                options.base_path.split(os.pathsep) if options.base_path else []
+            ) + [os.path.dirname(os.path.abspath(package_dir))]
+            base_conda_dir = install_base(
+                config.base,
+                search_path,
+                options.work_dir,
+                coex_binaries,
+                options.concurrency,
+                options.prefetch,
+                options.verify,
+            )
+
+        if pkgs or linked or not shared_base:
+            # Layer additional packages over a linked copy of the base
+            from coex_bootstrap.layers import link_tree
+
+            with SectionTimer("link_base"):
+                link_tree(base_conda_dir, conda_dir)
+        else:
+            conda_dir = base_conda_dir
+    else:
+        os.makedirs(conda_dir)
+
+    with SectionTimer("get_srcs"):
+        if archive:
+            srcs = zip_pkgs(archive, "srcs/?*", config.members, verify)
+        else:
+            srcs = file_pkgs(package_dir, "srcs/*", config.members, verify)
+    logging.debug("srcs=%r", srcs)
+
+    from coex_bootstrap.prefetch import member_ranges, prefetch
+
+    if options.metrics_log:
+        from coex_bootstrap.metrics import counters
+
+        counters["extracted_bytes"] += sum(r[3] for r in member_ranges(pkgs + srcs))
 
-            with SectionTimer("post_extract"):
-                logging.debug("post_extract pkg=%s prefix=%s", p, conda_dir)
-                post_extract(conda_dir)
+    # Prefetch members in install order, pkgs then srcs
+    with prefetch(pkgs + srcs, options.prefetch, SectionTimer.sections) as prefetcher:
+        with SectionTimer("install_pkgs"):
+            install_pkgs(
+                linked + pkgs, coex_binaries, conda_dir, options.concurrency, prefetcher
+            )
 
         ### Unpack usr packages
         usr_dir = os.path.join(run_dir, "usr")
-        logging.info("run_dir=%s", run_dir)
         os.makedirs(usr_dir)
 
-        with SectionTimer("get_srcs"):
-            loader = pkgutil.get_loader(__name__)
-            if isinstance(loader, zipimport.zipimporter):
-                srcs = zip_pkgs(loader.archive, "srcs/?*")
-            else:
-                srcs = file_pkgs(os.path.dirname(__file__), "srcs/*")
-        logging.debug("srcs=%r", srcs)
-
         for p in srcs:
+            if prefetcher:
+                prefetcher.extracting(p)
             with SectionTimer("extract"):
-                p.extract(coex_binaries, usr_dir)
+                try:
+                    p.extract(coex_binaries, usr_dir)
+                except IntegrityError as ex:
+                    sys.exit("ERROR: %s\n" % ex)
+
+    if verify and archive:
+        mark_verified(options.work_dir, archive)
+
+    return conda_dir
+
+
+def install_id(package, package_dir):
+    # type: (str, str) -> str
+    """Content id of the coex package, stamped on persistent installs."""
+    from coex_bootstrap.layers import archive_id
+
+    archive = main_archive(package)
+    if archive:
+        return archive_id(archive)
+
+    import hashlib
+
+    with open(os.path.join(package_dir, "coex_bootstrap.json"), "rb") as config:
+        return hashlib.sha256(config.read()).hexdigest()
+
+
+def install_persistent(config, options, package, package_dir):
+    # type: (COEXBootstrapConfig, COEXOptions, str, str) -> None
+    """Install coex into options.install_dir, for later runs via options.prefix_dir.
+
+    The install is stamped with the package's content id once complete, an
+    install of another package is replaced.
+
+    Args:
+        config: coex bootstrap config.
+        options: Initialized COEXOptions.
+        package: coex package, zipped or unpacked.
+        package_dir: Directory of the coex package.
+
+    """
+    from coex_bootstrap.layers import file_lock, makedirs, read_stamp, write_stamp
+
+    assert options.install_dir
+    install_dir = os.path.abspath(options.install_dir)
+    package_id = install_id(package, package_dir)
+
+    makedirs(install_dir)
+    with file_lock(os.path.join(install_dir, "coex.lock")):
+        if read_stamp(install_dir) == package_id:
+            logging.info("reuse install_dir=%s", install_dir)
+            return
+
+        logging.info("install install_dir=%s id=%s", install_dir, package_id)
+        for name in ("coex.stamp", "bin", "conda", "usr"):
+            path = os.path.join(install_dir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.unlink(path)
+
+        install(
+            config,
+            options,
+            package,
+            package_dir,
+            install_dir,
+            os.path.join(install_dir, "conda"),
+            shared_base=False,
+        )
+        write_stamp(install_dir, package_id)
+
+
+def installed_dir(options, package, package_dir):
+    # type: (COEXOptions, str, str) -> typing.Optional[str]
+    """options.prefix_dir, if a complete install of the coex package, else None."""
+    from coex_bootstrap.layers import read_stamp
+
+    assert options.prefix_dir
+    prefix_dir = os.path.abspath(options.prefix_dir)
+    stamp = read_stamp(prefix_dir)
+    if stamp and stamp == install_id(package, package_dir):
+        return prefix_dir
 
-        ### Activate the target environment
-        with SectionTimer("activate"):
-            activate_env(conda_dir)
-            os.environ["COEX_USR_PREFIX"] = usr_dir
-            os.environ["COEX_ROOT_PREFIX"] = run_dir
+    logging.info("prefix_dir=%s not installed from coex, unpacking", prefix_dir)
+    return None
 
-    logging.info("setup_times %r", dict(SectionTimer.sections))
+
+def run_install(
+    config,  # type: COEXBootstrapConfig
+    options,  # type: COEXOptions
+    package,  # type: str
+    package_dir,  # type: str
+    main_file,  # type: str
+):
+    # type: (...) -> typing.Tuple[str, str, str]
+    """Install coex for the run, or reuse a persistent install.
+
+    Args:
+        config: coex bootstrap config.
+        options: Initialized COEXOptions.
+        package: coex package, zipped or unpacked.
+        package_dir: Directory of the coex package.
+        main_file: __file__ of main module.
+
+    Returns:
+        Install mode, one of prefix, fixed_prefix or unpack, run dir and
+        conda env prefix.
+
+    """
+    run_dir = (
+        installed_dir(options, package, package_dir) if options.prefix_dir else None
+    )
+    if run_dir:
+        # Run from the persistent install, which is never cleaned up
+        return "prefix", run_dir, os.path.join(run_dir, "conda")
+
+    run_dir = claim_prefix_dir(config.prefix)
+    if run_dir:
+        # Install at the build-time prefix, skipping prefix updates
+        mode = "fixed_prefix"
+        conda_dir = config.prefix  # type: str
+    else:
+        mode = "unpack"
+        run_dir = os.path.join(
+            options.work_dir,
+            "%s_%i" % (os.path.basename(main_file), os.getpid()),
+        )
+        os.makedirs(run_dir)
+        conda_dir = os.path.join(run_dir, "conda")
+
+    conda_dir = install(config, options, package, package_dir, run_dir, conda_dir)
+    return mode, run_dir, conda_dir
+
+
+def expose_assets(config, package, package_dir, run_dir):
+    # type: (COEXBootstrapConfig, str, str, str) -> None
+    """Expose config.assets to the entrypoint, without extraction.
+
+    Sets COEX_ASSETS, the asset byte ranges in the coex archive or, if run
+    unpacked, the asset files, and installs the coex_assets helper module on
+    PYTHONPATH, see coex_bootstrap.assets.
+    """
+    import json
+    import pkgutil
+
+    from coex_bootstrap.layers import makedirs
+
+    archive = main_archive(package)
+    ranges = {}
+    for name, asset in config.assets.items():
+        if archive:
+            ranges[name] = [archive, asset["offset"], asset["size"]]
+        else:
+            path = os.path.join(package_dir, *asset["member"].split("/"))
+            ranges[name] = [path, 0, asset["size"]]
+    os.environ["COEX_ASSETS"] = json.dumps(ranges, sort_keys=True)
+
+    # Written once per run dir, persistent installs are shared by launches
+    python_dir = os.path.join(run_dir, "python")
+    helper = os.path.join(python_dir, "coex_assets.py")
+    if not os.path.exists(helper):
+        makedirs(python_dir)
+        tmp_helper = "%s.%i" % (helper, os.getpid())
+        with open(tmp_helper, "wb") as helper_out:
+            helper_out.write(pkgutil.get_data("coex_bootstrap", "assets.py") or b"")
+        os.rename(tmp_helper, helper)
+
+    pythonpath = os.environ.get("PYTHONPATH")
+    os.environ["PYTHONPATH"] = (
+        pythonpath + os.pathsep + python_dir if pythonpath else python_dir
+    )
+
+
+def write_metrics(
+    options,  # type: COEXOptions
+    package,  # type: str
+    package_dir,  # type: str
+    mode,  # type: str
+    setup_times,  # type: typing.Dict[str, float]
+    cleanup_times,  # type: typing.Dict[str, float]
+    returncode=None,  # type: typing.Optional[int]
+):
+    # type: (...) -> None
+    """Append launch record to options.metrics_log."""
+    import multiprocessing
+
+    from coex_bootstrap.metrics import append_record, launch_record
+
+    assert options.metrics_log
+    record = launch_record(
+        main_archive(package),
+        install_id(package, package_dir),
+        mode,
+        options.work_dir,
+        options.concurrency or multiprocessing.cpu_count(),
+        setup_times,
+        cleanup_times,
+        returncode,
+    )
+    append_record(options.metrics_log, record)
+
+
+def main(__name__, __file__, options, stream=None):
+    # type: (str, str, COEXOptions, typing.Optional[StreamInstall]) -> None
+    """Main bootstrap entrypoint.
+
+    Main bootstrap, unpacks coex and executes entrypoint program. Runs from a
+    persistent install if options.prefix_dir is installed from this coex, or
+    only installs the coex if options.install_dir is set. Launch metrics are
+    appended to options.metrics_log, if set.
+
+    Args:
+        __name__: __name__ of main module.
+        __file__: __file__ of main module.
+        options: Initialized COEXOptions.
+        stream: Install of a coex read from a stream, by the stream loader,
+            see coex_bootstrap.stream.
+
+    """
+    package_dir = os.path.dirname(__file__)
+
+    with SectionTimer("total"):
+        if options.log_level:
+            logging.basicConfig(level=logging.getLevelName(options.log_level))
+
+        logging.info("options=%s", options)
+
+        if stream:
+            from coex_bootstrap.stream import StreamError
+
+            if options.install_dir or options.prefix_dir:
+                sys.exit("ERROR: persistent install of a stream is not supported\n")
+            try:
+                config = COEXBootstrapConfig.from_dict(
+                    stream.read_head(options.work_dir)
+                )
+            except StreamError as ex:
+                sys.exit("ERROR: %s\n" % ex)
+        else:
+            config = COEXBootstrapConfig.read_from(package=__name__)
+        logging.info("config=%s", config)
+
+        if options.install_dir:
+            install_persistent(config, options, __name__, package_dir)
+        else:
+            if stream:
+                mode, run_dir = "stream", stream.run_dir
+                conda_dir = stream.install(config, options)
+            else:
+                mode, run_dir, conda_dir = run_install(
+                    config, options, __name__, package_dir, __file__
+                )
+            logging.info("run_dir=%s", run_dir)
+            logging.info("conda_dir=%s", conda_dir)
+            usr_dir = os.path.join(run_dir, "usr")
+
+            ### Activate the target environment
+            with SectionTimer("activate"):
+                activate_env(conda_dir, config.activate)
+                os.environ["COEX_USR_PREFIX"] = usr_dir
+                os.environ["COEX_ROOT_PREFIX"] = run_dir
+                if config.assets:
+                    expose_assets(config, __name__, package_dir, run_dir)
+
+    setup_times = dict(SectionTimer.sections)
+    logging.info("setup_times %r", setup_times)
     SectionTimer.sections.clear()
 
-    cmd = [
-        resolve_entrypoint(config.entrypoint, os.path.join(run_dir, "usr"))
-    ] + options.program_args
+    if options.install_dir:
+        if options.metrics_log:
+            write_metrics(options, __name__, package_dir, "install", setup_times, {})
+        return
+
+    cmd = [resolve_entrypoint(config.entrypoint, usr_dir)] + options.program_args
     logging.info("call %s", cmd)
+    returncode = None
     try:
-        subprocess.call(cmd)
+        returncode = subprocess.call(cmd)
     except KeyboardInterrupt:
         pass
     finally:
-        if options.cleanup:
+        if options.cleanup and mode != "prefix":
             with SectionTimer("cleanup"):
                 logging.info("cleanup run_dir=%s", run_dir)
                 shutil.rmtree(run_dir)
 
-        logging.info("cleanup_times %r", dict(SectionTimer.sections))
+        cleanup_times = dict(SectionTimer.sections)
+        logging.info("cleanup_times %r", cleanup_times)
         SectionTimer.sections.clear()
+
+        if options.metrics_log:
+            write_metrics(
+                options,
+                __name__,
+                package_dir,
+                mode,
+                setup_times,
+                cleanup_times,
+                returncode,
+            )
@@ -1,19 +1,65 @@
 import logging
 import os
 
+from coex_bootstrap.install import prefix_placeholder
+
+MYPY = False
+if MYPY:
+    import typing
+
 logger = logging.getLogger(__name__)
 
+# Placeholder for a variable's value before activation, in activation updates
+current_placeholder = "@COEX_CURRENT_VALUE@"
+
+
+def activate_vars(
+    environ,  # type: typing.MutableMapping[str, str]
+    prefix,  # type: str
+    activate=None,  # type: typing.Optional[typing.List[dict]]
+):
+    # type: (...) -> None
+    """Apply env activation at prefix to environ.
+
+    Prepends the env bin to PATH, and applies the activation delta of the
+    env's activate.d scripts, as evaluated at build time.
+
+    Args:
+        environ: Environment variables, updated in place.
+        prefix: Conda environment prefix.
+        activate: Activation delta, [{"name", "value", "update"}], setting each
+            variable to "value" if unset or "update", with the current value
+            substituted, if set. A None value or update unsets the variable.
+
+    """
+    environ["PATH"] = ":".join([prefix + "/bin", environ.get("PATH", "")])
+    environ["CONDA_PREFIX"] = prefix
+
+    for var in activate or []:
+        name = var["name"]
+        if name in environ:
+            value = var["update"]
+            if value is not None:
+                value = value.replace(current_placeholder, environ[name])
+        else:
+            value = var["value"]
+
+        if value is None:
+            environ.pop(name, None)
+        else:
+            environ[name] = value.replace(prefix_placeholder, prefix)
+
 
-def activate_env(prefix):
-    # type: (str) -> None
+def activate_env(prefix, activate=None):
+    # type: (str, typing.Optional[typing.List[dict]]) -> None
     """Activate unpacked conda env at prefix.
 
     Updates os.environ for env activation.
 
     Args:
         prefix: Conda environment prefix.
+        activate: Activation delta of the env's activate.d scripts.
 
     """
     logger.info("activate_env %s", locals())
-    os.environ["PATH"] = ":".join([prefix + "/bin", os.environ.get("PATH", "")])
-    os.environ["CONDA_PREFIX"] = prefix
+    activate_vars(os.environ, prefix, activate)
@@ -0,0 +1,68 @@
+"""Zero-extraction access to coex assets.
+
+Assets, marked by `coex create --asset`, are stored uncompressed and
+page-aligned in the archive. The bootstrap exposes them to the app in
+COEX_ASSETS, a json object of asset name to [path, offset, size], the file
+containing the asset data and its byte range, and installs this module as
+`coex_assets` on the app's PYTHONPATH.
+
+Example:
+    import coex_assets
+
+    weights = coex_assets.open_asset("models/weights.bin")
+
+This module is standalone, it is imported by the app's python.
+"""
+
+import json
+import mmap
+import os
+
+MYPY = False
+if MYPY:
+    import typing
+
+ASSETS_ENV = "COEX_ASSETS"
+
+
+def assets():
+    # type: () -> typing.Dict[str, typing.Tuple[str, int, int]]
+    """Assets of the running coex, by name, their (path, offset, size)."""
+    return {
+        name: (path, offset, size)
+        for name, (path, offset, size) in json.loads(
+            os.environ.get(ASSETS_ENV) or "{}"
+        ).items()
+    }
+
+
+def asset(name):
+    # type: (str) -> typing.Tuple[str, int, int]
+    """Path, offset and size of asset name.
+
+    Raises:
+        KeyError: Unknown asset.
+
+    """
+    return assets()[name]
+
+
+def open_asset(name):
+    # type: (str) -> typing.Union[mmap.mmap, bytes]
+    """Read-only mmap of asset name, mapping the asset data in place.
+
+    Empty assets, which can not be mapped, are returned as b"".
+
+    Raises:
+        KeyError: Unknown asset.
+
+    """
+    path, offset, size = asset(name)
+    if not size:
+        return b""
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return mmap.mmap(fd, size, access=mmap.ACCESS_READ, offset=offset)
+    finally:
+        os.close(fd)
@@ -1,8 +1,3 @@
-try:
-    import typing
-except ImportError:
-    pass
-
 import logging
 import os
 import os.path
@@ -11,6 +6,10 @@ import shutil
 import stat
 import sys
 
+MYPY = False
+if MYPY:
+    import typing
+
 logger = logging.getLogger(__name__)
 
 S_IXALL = stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
@@ -107,6 +106,26 @@ class COEXBootstrapBinaries(object):
             ")".format(self=self)
         )
 
+    @classmethod
+    def resolve(cls):
+        # type: () -> typing.Dict[str, str]
+        """Resolve binary paths in current environment.
+
+        Returns:
+            Mapping of {binary name : path}.
+
+        Raises:
+            ValueError: Unable to resolve binary.
+
+        """
+        paths = {}
+        for b in cls.required:
+            bin_path = shutil.which(b)
+            if bin_path is None:
+                raise ValueError("Unable to resolve binary: %s" % b)
+            paths[b] = bin_path
+        return paths
+
     @classmethod
     def copy_to(cls, prefix):
         # type: (str) -> None
@@ -117,10 +136,7 @@ class COEXBootstrapBinaries(object):
         if not os.path.exists(bindir):
             os.makedirs(bindir)
 
-        for b in cls.required:
-            bin_path = shutil.which(b)
-            if bin_path is None:
-                raise ValueError("Unable to resolve binary: %s" % b)
+        for bin_path in cls.resolve().values():
             shutil.copy(bin_path, bindir)
 
     @classmethod
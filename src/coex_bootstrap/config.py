@@ -1,29 +1,71 @@
-import json
+import contextlib
 import os.path
 import pkgutil
 
+MYPY = False
+if MYPY:
+    import typing
+
 
 class COEXBootstrapConfig(object):
     """Coex package bootstrap configuration, packed under 'coex_bootstrap.json'."""
 
-    def __init__(self, entrypoint):
-        # type: (str) -> None
+    def __init__(
+        self,
+        entrypoint,  # type: str
+        base=None,  # type: typing.Optional[typing.Dict[str, str]]
+        prefix=None,  # type: typing.Optional[str]
+        members=None,  # type: typing.Optional[typing.Dict[str, dict]]
+        activate=None,  # type: typing.Optional[typing.List[dict]]
+        assets=None,  # type: typing.Optional[typing.Dict[str, dict]]
+    ):
+        # type: (...) -> None
         """Init bootstrap config.
 
         Args:
             entrypoint: coex executable entrypoint.
+            base: Base layer reference, {"archive_id": ..., "name": ...}, for
+                layered coex packages.
+            prefix: Fixed conda prefix, packages are relocated to prefix at
+                build time.
+            members: Per-member metadata, by archive member name, eg.
+                {"pkgs/...": {"compression": {"codec": "zstd", "long": 30}}},
+                members split into chunks list the chunk members under
+                "chunks", [{"name": "chunks/...", "compression": ...}].
+            activate: Activation delta of the env's activate.d scripts,
+                evaluated at build time, [{"name": ..., "value": ...,
+                "update": ...}], see activate.activate_vars.
+            assets: Uncompressed, page-aligned asset members, by asset name,
+                {"member": "assets/...", "offset": ..., "size": ...}, offset
+                of the member data in the archive file.
 
         """
         self.entrypoint = entrypoint
+        self.base = base
+        self.prefix = prefix
+        self.members = members or {}
+        self.activate = activate or []
+        self.assets = assets or {}
 
     def __repr__(self):  # noqa: D
         # type: () -> str
-        return "COEXBootstrapConfig(entrypoint={self.entrypoint!r}".format(self=self)
+        return (
+            "COEXBootstrapConfig(entrypoint={self.entrypoint!r}, "
+            "base={self.base!r}, prefix={self.prefix!r}, members={self.members!r}, "
+            "activate={self.activate!r}, assets={self.assets!r})"
+        ).format(self=self)
 
     def as_dict(self):
         # type: () -> dict
         """As json-compatible object."""
-        return {"entrypoint": self.entrypoint}
+        return {
+            "entrypoint": self.entrypoint,
+            "base": self.base,
+            "prefix": self.prefix,
+            "members": self.members,
+            "activate": self.activate,
+            "assets": self.assets,
+        }
 
     @classmethod
     def from_dict(cls, obj):
@@ -39,6 +81,7 @@ class COEXBootstrapConfig(object):
             prefix: Coex package build root.
 
         """
+        import json
 
         with open(os.path.join(prefix, "coex_bootstrap.json"), "w") as config_out:
             json.dump(self.as_dict(), config_out, indent=2)
@@ -61,6 +104,8 @@ class COEXBootstrapConfig(object):
             ValueError: Invalid prefix/package.
 
         """
+        import json
+
         if prefix and not package:
             config = open(os.path.join(prefix, "coex_bootstrap.json"), "rb").read()
         elif package and not prefix:
@@ -81,3 +126,15 @@ class COEXBootstrapConfig(object):
             )
 
         return cls.from_dict(json.loads(config.decode("utf-8")))
+
+    @classmethod
+    def read_archive(cls, path):
+        # type: (str) -> COEXBootstrapConfig
+        """Read coex_bootstrap.json of coex archive at path."""
+        import json
+        import zipfile
+
+        with contextlib.closing(zipfile.ZipFile(path)) as zf:
+            config = zf.read("coex_bootstrap.json")
+
+        return cls.from_dict(json.loads(config.decode("utf-8")))
@@ -0,0 +1,153 @@
+"""Reuse of host conda package caches at launch.
+
+Packages repacked without changes to their files record their origin, the
+conda package name, version, build and sha256, in their member metadata. With
+COEX_PKGS_DIRS set, each such package found extracted in a host package cache,
+with a matching sha256, is hard linked, or copied across devices, into the env
+rather than extracted from the archive. Prefix updates replace, rather than
+modify, files so the host cache is left unchanged.
+
+Host caches are trusted as conda trusts them, by the sha256 of the extracted
+package's repodata record, if owned by root or the user and not writable by
+others. Linked packages are not covered by COEX_VERIFY.
+"""
+
+import json
+import logging
+import os
+import os.path
+
+from coex_bootstrap.install import package_info_dir
+from coex_bootstrap.layers import link_file, link_tree, makedirs
+from coex_bootstrap.unpack import PkgHandle
+
+MYPY = False
+if MYPY:
+    import typing
+
+    from coex_bootstrap.binaries import COEXBootstrapBinaries
+
+logger = logging.getLogger(__name__)
+
+# COEX_PKGS_DIRS value of the host conda's package caches
+CONDA_PKGS_DIRS = "conda"
+
+
+def conda_pkgs_dirs():
+    # type: () -> typing.List[str]
+    """Package caches of the host conda, as conda's default pkgs_dirs.
+
+    CONDA_PKGS_DIRS if set, else the pkgs dir of the conda install running
+    CONDA_EXE, and the user's ~/.conda/pkgs.
+    """
+    if os.environ.get("CONDA_PKGS_DIRS"):
+        return [
+            os.path.expanduser(d) for d in os.environ["CONDA_PKGS_DIRS"].split(",") if d
+        ]
+
+    pkgs_dirs = []
+    if os.environ.get("CONDA_EXE"):
+        conda_root = os.path.dirname(os.path.dirname(os.environ["CONDA_EXE"]))
+        pkgs_dirs.append(os.path.join(conda_root, "pkgs"))
+    pkgs_dirs.append(os.path.expanduser(os.path.join("~", ".conda", "pkgs")))
+    return pkgs_dirs
+
+
+def resolve_pkgs_dirs(value):
+    # type: (str) -> typing.List[str]
+    """Host package caches of COEX_PKGS_DIRS value.
+
+    Args:
+        value: os.pathsep separated package cache dirs, or CONDA_PKGS_DIRS for
+            the host conda's caches.
+
+    """
+    if value == CONDA_PKGS_DIRS:
+        return conda_pkgs_dirs()
+    return [d for d in value.split(os.pathsep) if d]
+
+
+def _trusted(path):
+    # type: (str) -> bool
+    st = os.stat(path)
+    return st.st_uid in (0, os.getuid()) and not st.st_mode & 0o022
+
+
+def find_extracted(pkgs_dirs, origin):
+    # type: (typing.List[str], typing.Dict[str, str]) -> typing.Optional[str]
+    """Extracted package dir of package origin in pkgs_dirs, None if not found.
+
+    Conda writes the repodata record of an extracted package once extraction
+    completes, matching packages have a record of the origin's sha256.
+    """
+    dist = "%s-%s-%s" % (origin["name"], origin["version"], origin["build"])
+    for pkgs_dir in pkgs_dirs:
+        extracted_dir = os.path.join(pkgs_dir, dist)
+        try:
+            with open(
+                os.path.join(extracted_dir, "info", "repodata_record.json")
+            ) as record_file:
+                record = json.load(record_file)
+            trusted = _trusted(pkgs_dir) and _trusted(extracted_dir)
+        except (IOError, OSError, ValueError):
+            continue
+
+        if trusted and all(record.get(k) == v for k, v in origin.items()):
+            return extracted_dir
+        logger.debug("mismatch extracted_dir=%s trusted=%s", extracted_dir, trusted)
+    return None
+
+
+class HostPkgHandle(PkgHandle):
+    """Handle to a package extracted in a host package cache.
+
+    target is the extracted package dir, and name the member name of the
+    package it replaces.
+    """
+
+    def extract_member(self, coex_binaries, prefix_dir):
+        # type: (COEXBootstrapBinaries, str) -> None
+        """Link the extracted package into prefix_dir, as laid out by repack.
+
+        Args:
+            coex_binaries: Unused, no extraction is required.
+            prefix_dir: Directory prefix for linked files.
+
+        """
+        logging.debug("link pkg=%s extracted_dir=%s", self.name, self.target)
+        for name in os.listdir(self.target):
+            source = os.path.join(self.target, name)
+            if name == "info":
+                # Isolated to its package specific dir, see package_info_dir
+                link_tree(source, package_info_dir(prefix_dir, self.dist))
+            elif os.path.isdir(source) and not os.path.islink(source):
+                link_tree(source, os.path.join(prefix_dir, name))
+            else:
+                makedirs(prefix_dir)
+                link_file(source, os.path.join(prefix_dir, name))
+
+
+def host_pkgs(
+    pkgs,  # type: typing.List[PkgHandle]
+    pkgs_dirs,  # type: typing.List[str]
+):
+    # type: (...) -> typing.Tuple[typing.List[PkgHandle], typing.List[PkgHandle]]
+    """Split pkgs into those extracted from the archive, and from host caches.
+
+    Returns:
+        Handles of pkgs to extract from the archive, and of the packages found
+        in pkgs_dirs, replacing their archive handles.
+
+    """
+    extract = []  # type: typing.List[PkgHandle]
+    linked = []  # type: typing.List[PkgHandle]
+    for p in pkgs:
+        origin = p.member.get("origin")
+        extracted_dir = find_extracted(pkgs_dirs, origin) if origin else None
+        if extracted_dir:
+            linked.append(HostPkgHandle(extracted_dir, p.name))
+        else:
+            extract.append(p)
+
+    logger.info("host_pkgs linked=%i extract=%i", len(linked), len(extract))
+    return extract, linked
@@ -7,20 +7,17 @@
 # Extensions (c) 2019 coex authors
 """Conda package install, cribbed from miniconda installer."""
 
-try:
-    import typing
-except ImportError:
-    pass
-import glob
-import json
 import logging
 import os
 import re
-import shlex
 import shutil
 import stat
 import sys
 
+MYPY = False
+if MYPY:
+    import typing
+
 logger = logging.getLogger(__name__)
 
 on_win = bool(sys.platform == "win32")
@@ -56,6 +53,8 @@ def read_has_prefix(path):
 
     """
 
+    import shlex
+
     res = {}
     try:
         for line in yield_lines(path):
@@ -77,14 +76,26 @@ class PaddingError(Exception):
     pass
 
 
-def binary_replace(data, a, b):
-    # type: (bytes, bytes, bytes) -> bytes
+def _binary_pattern(a, slack=0):
+    # type: (bytes, int) -> typing.Pattern[bytes]
+    if slack:
+        # Capture trailing null padding, which may be consumed by replacement
+        return re.compile(re.escape(a) + b"[^\0]*?\0(\0*)")
+    return re.compile(re.escape(a) + b"([^\0]*?)\0")
+
+
+def binary_replace(data, a, b, slack=0):
+    # type: (bytes, bytes, bytes, int) -> bytes
     """Perform binary prefix replacement.
 
     Perform a binary replacement of `data`, where the placeholder `a` is
     replaced with `b` and the remaining string is padded with null characters.
     All input arguments are expected to be bytes objects.
 
+    Strings previously relocated from a longer placeholder are followed by
+    null padding, up to `slack` bytes of padding per occurrence of `a` may be
+    consumed by a replacement longer than `a`.
+
     Raises:
         PaddingError: Insufficient padding available for replacement.
 
@@ -93,20 +104,75 @@ def binary_replace(data, a, b):
     """
 
     def replace(match):
-        occurances = match.group().count(a)
-        padding = (len(a) - len(b)) * occurances
+        extra = match.group(1) if slack else b""
+        string = match.group()[: len(match.group()) - len(extra)]
+        occurances = string.count(a)
+        usable = min(len(extra), slack * occurances)
+        padding = (len(a) - len(b)) * occurances + usable
         if padding < 0:
             raise PaddingError(a, b, padding)
-        return match.group().replace(a, b) + b"\0" * padding
+        return string.replace(a, b) + b"\0" * (padding + len(extra) - usable)
 
-    pat = re.compile(re.escape(a) + b"([^\0]*?)\0")
+    pat = _binary_pattern(a, slack)
     res = pat.sub(replace, data)
     assert len(res) == len(data)
     return res
 
 
-def update_prefix(path, new_prefix, placeholder, mode):
-    """Peform in-place prefix update on file."""
+def _split_complete(data, pattern, a):
+    # type: (bytes, typing.Pattern[bytes], bytes) -> typing.Tuple[bytes, bytes]
+    """Split data into (head, tail), where head only contains complete matches.
+
+    The tail holds any trailing partial placeholder, or a binary placeholder
+    string whose null terminator, or trailing padding, has not yet been read,
+    to be prepended to the next block of a streamed file.
+    """
+    start = end = 0
+    for match in pattern.finditer(data):
+        start, end = match.start(), match.end()
+
+    if end and end == len(data):
+        # Match may continue into the next block
+        return data[:start], data[start:]
+
+    pending = data.find(a, end)
+    if pending != -1:
+        cut = pending
+    else:
+        cut = max(end, len(data) - len(a) + 1)
+
+    return data[:cut], data[cut:]
+
+
+CHUNK_SIZE = 1 << 22
+
+
+def update_prefix(
+    path,  # type: str
+    new_prefix,  # type: str
+    placeholder,  # type: str
+    mode,  # type: str
+    slack=0,  # type: int
+    chunk_size=CHUNK_SIZE,  # type: int
+):
+    # type: (...) -> None
+    """Peform in-place prefix update on file.
+
+    Streams the file in bounded blocks, files are only rewritten, by replacing
+    the file with an updated copy, if the placeholder is present.
+
+    Args:
+        path: Target file.
+        new_prefix: Replacement prefix.
+        placeholder: Prefix placeholder.
+        mode: "text" or "binary" replacement mode.
+        slack: Null padding per placeholder available to binary replacement.
+        chunk_size: Streamed block size.
+
+    Raises:
+        PaddingError: Insufficient padding for binary replacement.
+
+    """
     logging.debug("update_prefix: %s", path)
 
     if on_win:
@@ -114,69 +180,228 @@ def update_prefix(path, new_prefix, placeholder, mode):
         # to escape backslashes - replace with unix-style path separators
         new_prefix = new_prefix.replace("\\", "/")
 
-    path = os.path.realpath(path)
-    with open(path, "rb") as fi:
-        data = fi.read()
+    a = placeholder.encode("utf-8")
+    b = new_prefix.encode("utf-8")
+
     if mode == "text":
-        new_data = data.replace(placeholder.encode("utf-8"), new_prefix.encode("utf-8"))
+        pattern = re.compile(re.escape(a))
+
+        def replace(data):
+            return data.replace(a, b)
+
     elif mode == "binary":
         if on_win:
             # anaconda-verify will not allow binary placeholder on Windows.
             # However, since some packages might be created wrong (and a
             # binary placeholder would break the package, we just skip here.
             return
-        new_data = binary_replace(
-            data, placeholder.encode("utf-8"), new_prefix.encode("utf-8")
-        )
+        pattern = _binary_pattern(a, slack)
+
+        def replace(data):
+            return binary_replace(data, a, b, slack)
+
     else:
-        sys.exit("Invalid mode:" % mode)
+        sys.exit("Invalid mode: %s" % mode)
+
+    path = os.path.realpath(path)
+    tmp_path = None
+    out = None  # type: typing.Optional[typing.BinaryIO]
+    try:
+        with open(path, "rb") as fi:
+            offset = 0
+            pending = b""
+            while True:
+                block = fi.read(chunk_size)
+                if block:
+                    head, pending = _split_complete(pending + block, pattern, a)
+                else:
+                    head, pending = pending, b""
+
+                if out is None and a in head:
+                    # First placeholder, copy preceding data to updated file
+                    import tempfile
+
+                    fd, tmp_path = tempfile.mkstemp(
+                        prefix=".coex_", dir=os.path.dirname(path)
+                    )
+                    out = os.fdopen(fd, "wb")
+                    with open(path, "rb") as prev:
+                        remaining = offset
+                        while remaining:
+                            data = prev.read(min(chunk_size, remaining))
+                            out.write(data)
+                            remaining -= len(data)
+
+                if out is not None:
+                    out.write(replace(head))
+                offset += len(head)
+
+                if not block:
+                    break
+
+        if out is None:
+            return
+
+        out.close()
+        st = os.lstat(path)
+        os.chmod(tmp_path, stat.S_IMODE(st.st_mode))
+        # replace, rather than rewrite, in case the file is memory mapped
+        os.rename(tmp_path, path)
+    finally:
+        if out is not None:
+            out.close()
+        if tmp_path and os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+def update_prefixes(
+    prefix,  # type: str
+    prefix_files,  # type: typing.Dict[str, typing.Tuple[typing.Any, ...]]
+    threads=None,  # type: typing.Optional[int]
+):
+    # type: (...) -> None
+    """Perform in-place prefix updates of files across a thread pool.
+
+    Args:
+        prefix: Conda env prefix, files are updated to this prefix.
+        prefix_files: Mapping of {filename : (placeholder, mode[, slack])}
+        threads: Thread pool size, defaults to cpu count.
+
+    Raises:
+        PaddingError: Insufficient padding, with args (filename, placeholder).
+
+    """
+
+    def update(f):
+        placeholder = prefix_files[f][0]
+        try:
+            update_prefix(os.path.join(prefix, f), prefix, *prefix_files[f])
+        except PaddingError:
+            raise PaddingError(f, placeholder)
+
+    def size(f):
+        try:
+            return os.lstat(os.path.join(prefix, f)).st_size
+        except OSError:
+            return 0
 
-    if new_data == data:
+    # Largest files first, so the slowest updates don't trail the pool
+    files = sorted(prefix_files, key=size, reverse=True)
+    if not files:
         return
-    st = os.lstat(path)
-    # unlink in case the file is memory mapped
-    os.unlink(path)
-    with open(path, "wb") as fo:
-        fo.write(new_data)
-    os.chmod(path, stat.S_IMODE(st.st_mode))
 
+    if threads is None:
+        import multiprocessing
+
+        threads = multiprocessing.cpu_count()
+    threads = min(threads, len(files))
+
+    if threads <= 1:
+        for f in files:
+            update(f)
+        return
+
+    from multiprocessing.pool import ThreadPool
+
+    pool = ThreadPool(threads)
+    try:
+        for _ in pool.imap_unordered(update, files):
+            pass
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def read_paths_json(path):
+    # type: (str) -> typing.Dict[str, typing.Tuple[str, str]]
+    """Read prefix files from info/paths.json file.
+
+    Args:
+        path: paths.json file path.
+
+    Returns:
+        Mapping of {filename : (placeholder, mode)}
+
+    """
+    import json
+
+    with open(path, "rb") as paths_file:
+        paths = json.loads(paths_file.read().decode("utf-8"))
+
+    return {
+        p["_path"]: (p["prefix_placeholder"], p.get("file_mode", "text"))
+        for p in paths.get("paths", [])
+        if p.get("prefix_placeholder")
+    }
 
-def post_extract(prefix):
-    # type: (str) -> None
+
+def read_coex_prefix(path, prefix):
+    # type: (str, str) -> typing.Dict[str, typing.Tuple[str, str, int]]
+    """Read prefix files from info/coex_prefix.json of a pre-relocated package.
+
+    Args:
+        path: coex_prefix.json file path.
+        prefix: Install prefix.
+
+    Returns:
+        Mapping of {filename : (placeholder, mode, slack)}, empty if the
+        package was relocated to prefix at build time.
+
+    """
+    import json
+
+    with open(path, "rb") as coex_prefix_file:
+        relocated = json.loads(coex_prefix_file.read().decode("utf-8"))
+
+    if relocated["prefix"] == prefix:
+        return {}
+
+    return {
+        f: (relocated["prefix"], mode, slack)
+        for f, (mode, slack) in relocated["files"].items()
+    }
+
+
+def package_info_dir(prefix, dist):
+    # type: (str, str) -> str
+    """Info dir of package dist, extracted into prefix.
+
+    Package info is moved to a package specific dir at build time, so that
+    packages extracted concurrently into a prefix do not overwrite info.
+    """
+    return os.path.join(prefix, "info", dist)
+
+
+def post_extract(prefix, info_dir, threads=None):
+    # type: (str, str, typing.Optional[int]) -> None
     """Update package files post-extract.
 
-    Package has been extracted into `prefix`, leaving `info/` and the package files.
-    Update prefix files, detect 'post-link', and remove `info/` directory.
+    Package has been extracted into `prefix`, with the package info in
+    `info_dir`. Update prefix files, detect 'post-link', and remove `info_dir`.
+    Packages are laid out for install at build time, noarch python package
+    files are already at their site-packages paths.
 
     Args:
         prefix: Conda env prefix post package extraction.
+        info_dir: Package info dir, see package_info_dir.
+        threads: Prefix update threads, see update_prefixes.
+
+    Raises:
+        PaddingError: Insufficient padding, with args (filename, placeholder).
 
     """
-    info_dir = os.path.join(prefix, "info")
+    coex_prefix = os.path.join(info_dir, "coex_prefix.json")
+    paths_json = os.path.join(info_dir, "paths.json")
+    if os.path.exists(coex_prefix):
+        prefix_files = read_coex_prefix(coex_prefix, prefix)
+    elif os.path.exists(paths_json):
+        prefix_files = read_paths_json(paths_json)
+    else:
+        prefix_files = read_has_prefix(os.path.join(info_dir, "has_prefix"))
 
-    # with open(join(info_dir, 'index.json')) as fi:
-    #     meta = json.load(fi)
-    # dist = '%(name)s-%(version)s-%(build)s' % meta
+    update_prefixes(prefix, prefix_files, threads)
 
-    # TODO: Use paths.json, if available or fall back to this method
-    has_prefix_files = read_has_prefix(os.path.join(info_dir, "has_prefix"))
-    for f in sorted(has_prefix_files):
-        placeholder, mode = has_prefix_files[f]
-        try:
-            update_prefix(os.path.join(prefix, f), prefix, placeholder, mode)
-        except PaddingError:
-            sys.exit("ERROR: placeholder '%s' too short in: %s\n" % (placeholder, f))
-
-    repodata_record = os.path.join(info_dir, "repodata_record.json")
-    if os.path.exists(repodata_record):
-        repodata = json.loads(open(repodata_record, "rb").read().decode("utf-8"))
-        if repodata.get("noarch", None) == "python":
-            logging.info("unpacking noarch")
-            target = glob.glob(os.path.join(prefix, "lib/python*/site-packages"))[0]
-            for f in glob.glob(os.path.join(prefix, "site-packages/*")):
-                shutil.move(f, target)
-
-    post_link = os.path.join(prefix, "info/recipe/post-link.sh")
+    post_link = os.path.join(info_dir, "recipe/post-link.sh")
     if os.path.exists(post_link):
         # TODO: Enable post-link behaviors?
         logging.warning("skiping post-link script %s", post_link)
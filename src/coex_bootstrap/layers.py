@@ -0,0 +1,169 @@
+"""Shared base layers for layered coex packages.
+
+A layered coex references a base coex by archive id. The base packages are
+unpacked once per work directory into a shared, persistent prefix which is
+reused by all coex packages built on the base.
+"""
+
+import contextlib
+import errno
+import fcntl
+import glob
+import hashlib
+import logging
+import os
+import os.path
+import shutil
+import zipfile
+
+MYPY = False
+if MYPY:
+    import typing
+
+logger = logging.getLogger(__name__)
+
+
+def archive_id(path):
+    # type: (str) -> str
+    """Content id of a coex archive.
+
+    Derived from the member names, sizes and crcs recorded in the zip central
+    directory, avoiding a full read of the archive.
+
+    Args:
+        path: coex archive path.
+
+    Returns:
+        Hex digest archive id.
+
+    """
+    digest = hashlib.sha256()
+    with contextlib.closing(zipfile.ZipFile(path)) as zf:
+        for info in sorted(zf.infolist(), key=lambda i: i.filename):
+            entry = "%s %i %08x\n" % (info.filename, info.file_size, info.CRC)
+            digest.update(entry.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def find_base(base, search_path):
+    # type: (typing.Dict[str, str], typing.List[str]) -> typing.Optional[str]
+    """Find base archive by archive id.
+
+    Searches for base by file name, then for any matching *.coex file, in each
+    search path directory.
+
+    Args:
+        base: Base layer reference from COEXBootstrapConfig.
+        search_path: Directories searched for base archive.
+
+    Returns:
+        Base archive path, or None if not found.
+
+    """
+    for search_dir in search_path:
+        named = os.path.join(search_dir, base["name"])
+        candidates = [named] + sorted(
+            set(glob.glob(os.path.join(search_dir, "*.coex"))) - {named}
+        )
+
+        for candidate in candidates:
+            if not os.path.isfile(candidate):
+                continue
+            try:
+                candidate_id = archive_id(candidate)
+            except zipfile.BadZipfile:
+                continue
+            logger.debug("find_base candidate=%s id=%s", candidate, candidate_id)
+            if candidate_id == base["archive_id"]:
+                return candidate
+
+    return None
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    # type: (str) -> typing.Iterator[None]
+    """Hold exclusive advisory lock on path, blocking until available."""
+    with open(path, "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def base_dirs(base, work_dir):
+    # type: (typing.Dict[str, str], str) -> typing.Tuple[str, str]
+    """Shared (base_dir, conda_dir) for base layer in work_dir."""
+    base_dir = os.path.join(work_dir, "coex_base_%s" % base["archive_id"][:16])
+    return base_dir, os.path.join(base_dir, "conda")
+
+
+def read_stamp(base_dir):
+    # type: (str) -> typing.Optional[str]
+    """Read archive id stamp of a completely unpacked base dir."""
+    try:
+        with open(os.path.join(base_dir, "coex.stamp")) as stamp:
+            return stamp.read().strip()
+    except IOError:
+        return None
+
+
+def write_stamp(base_dir, base_id):
+    # type: (str, str) -> None
+    """Mark base dir as completely unpacked."""
+    with open(os.path.join(base_dir, "coex.stamp"), "w") as stamp:
+        stamp.write(base_id)
+
+
+def makedirs(path):
+    # type: (str) -> None
+    """os.makedirs, ignoring existing directories."""
+    try:
+        os.makedirs(path)
+    except OSError as ex:
+        if ex.errno != errno.EEXIST:
+            raise
+
+
+def link_file(source, target):
+    # type: (str, str) -> None
+    """Hard link file source to target, copying across devices.
+
+    Symlinks are recreated, rather than followed.
+    """
+    if os.path.islink(source):
+        os.symlink(os.readlink(source), target)
+        return
+
+    try:
+        os.link(source, target)
+    except OSError as ex:
+        if ex.errno != errno.EXDEV:
+            raise
+        shutil.copy2(source, target)
+
+
+def link_tree(src, dst):
+    # type: (str, str) -> None
+    """Replicate src directory tree into dst via hardlinks.
+
+    Files are hard linked, falling back to copies across devices, and symlinks
+    are recreated. Prefix updates replace, rather than modify, files so the
+    linked tree may be updated without modifying the source tree.
+
+    Args:
+        src: Source directory.
+        dst: Destination directory.
+
+    """
+    logger.info("link_tree src=%s dst=%s", src, dst)
+    for dirpath, dirnames, filenames in os.walk(src):
+        target_dir = os.path.join(dst, os.path.relpath(dirpath, src))
+        makedirs(target_dir)
+
+        for name in dirnames + filenames:
+            source = os.path.join(dirpath, name)
+            if os.path.isdir(source) and not os.path.islink(source):
+                continue
+            link_file(source, os.path.join(target_dir, name))
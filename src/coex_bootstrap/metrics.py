@@ -0,0 +1,115 @@
+"""Opt-in local log of launch metrics.
+
+With COEX_METRICS_LOG set, each launch appends a json line record of its
+setup and cleanup section times, bytes extracted, work dir filesystem and
+install concurrency. The log is size-capped, rotating to a single ".1"
+backup, and is summarized by `coex stats`.
+"""
+
+import json
+import logging
+import os
+import socket
+import time
+from collections import defaultdict
+
+MYPY = False
+if MYPY:
+    import typing
+
+logger = logging.getLogger(__name__)
+
+# Log size rotated to the ".1" backup, bounding the log to twice the size
+METRICS_LOG_MAX_SIZE = 16 << 20
+
+# Counters of the launch, eg. extracted member bytes
+counters = defaultdict(int)  # type: typing.Dict[str, int]
+
+
+def filesystem_type(path):
+    # type: (str) -> typing.Optional[str]
+    """Filesystem type of the mount containing path, from /proc/mounts."""
+    path = os.path.realpath(path)
+    try:
+        with open("/proc/mounts") as mounts:
+            entries = [line.split() for line in mounts]
+    except (IOError, OSError):
+        return None
+
+    best = None  # type: typing.Optional[typing.Tuple[str, str]]
+    for entry in entries:
+        if len(entry) < 3:
+            continue
+        mount_point = entry[1].replace("\\040", " ")
+        if path != mount_point and not path.startswith(mount_point.rstrip("/") + "/"):
+            continue
+        # Longest, and for stacked mounts last, matching mount point
+        if best is None or len(mount_point) >= len(best[0]):
+            best = (mount_point, entry[2])
+    return best[1] if best else None
+
+
+def launch_record(
+    archive,  # type: typing.Optional[str]
+    archive_id,  # type: str
+    mode,  # type: str
+    work_dir,  # type: str
+    concurrency,  # type: int
+    setup_times,  # type: typing.Dict[str, float]
+    cleanup_times,  # type: typing.Dict[str, float]
+    returncode=None,  # type: typing.Optional[int]
+):
+    # type: (...) -> dict
+    """Metrics record of a launch.
+
+    Args:
+        archive: coex archive path, None if run unpacked.
+        archive_id: Content id of the coex.
+        mode: Install mode, unpack, fixed_prefix, prefix or install.
+        work_dir: coex work directory.
+        concurrency: Packages installed concurrently.
+        setup_times: Setup section times, seconds.
+        cleanup_times: Cleanup section times, seconds.
+        returncode: Entrypoint exit code.
+
+    """
+    return {
+        "time": time.time(),
+        "host": socket.gethostname(),
+        "archive": os.path.basename(archive) if archive else None,
+        "archive_id": archive_id,
+        "mode": mode,
+        "work_dir": work_dir,
+        "work_dir_fs": filesystem_type(work_dir),
+        "concurrency": concurrency,
+        "extracted_bytes": counters["extracted_bytes"],
+        "sections": setup_times,
+        "cleanup_sections": cleanup_times,
+        "returncode": returncode,
+    }
+
+
+def append_record(path, record, max_size=METRICS_LOG_MAX_SIZE):
+    # type: (str, dict, int) -> None
+    """Append record to the metrics log at path, rotating it past max_size.
+
+    Records are appended as single writes, so concurrent launches do not
+    interleave, and rotation is serialized by a lock file. Errors are logged
+    rather than raised, metrics never fail a launch.
+    """
+    from coex_bootstrap.layers import file_lock, makedirs
+
+    line = (json.dumps(record, sort_keys=True) + "\n").encode("utf-8")
+    try:
+        makedirs(os.path.dirname(os.path.abspath(path)))
+        with file_lock(path + ".lock"):
+            if os.path.exists(path) and os.path.getsize(path) + len(line) > max_size:
+                os.rename(path, path + ".1")
+
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+    except (IOError, OSError) as ex:
+        logger.warning("unable to write metrics log %s: %s", path, ex)
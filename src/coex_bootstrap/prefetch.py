@@ -0,0 +1,227 @@
+"""Prefetch of archive members ahead of extraction.
+
+On network filesystems, eg. NFS or Lustre, extraction of a member stalls on
+cold reads of the archive. A background thread prefetches the byte ranges of
+upcoming members into the page cache, in install order, staying at most a
+bounded number of bytes ahead of extraction so that prefetched data is not
+evicted before use.
+
+Modes:
+    willneed: posix_fadvise(POSIX_FADV_WILLNEED) on each range, queueing
+        asynchronous readahead, the default where available.
+    read: Read each range, for filesystems or pythons without fadvise.
+    off: No prefetch.
+"""
+
+import contextlib
+import logging
+import os
+import threading
+import time
+import zipfile
+
+MYPY = False
+if MYPY:
+    import typing
+
+    from coex_bootstrap.unpack import PkgHandle
+
+    # Member name, file path, offset and length
+    Range = typing.Tuple[str, str, int, int]
+
+logger = logging.getLogger(__name__)
+
+MODES = ("auto", "willneed", "read", "off")
+
+# Bytes prefetched ahead of the members being extracted
+PREFETCH_AHEAD = 256 << 20
+
+READ_BLOCK = 1 << 20
+
+
+def resolve_mode(mode):
+    # type: (str) -> str
+    """Prefetch mode, resolving auto and boolean values.
+
+    Raises:
+        ValueError: Invalid mode.
+
+    """
+    mode = mode.lower()
+    if mode in ("1", "true", "on", "yes", "auto"):
+        return "willneed" if hasattr(os, "posix_fadvise") else "off"
+    if mode in ("0", "false", "no"):
+        return "off"
+    if mode not in MODES:
+        raise ValueError("invalid prefetch mode %r" % (mode,))
+    if mode == "willneed" and not hasattr(os, "posix_fadvise"):
+        return "read"
+    return mode
+
+
+def member_ranges(handles):
+    # type: (typing.List[PkgHandle]) -> typing.List[Range]
+    """Byte ranges of handles and their chunks, as (name, path, offset, length).
+
+    Zip member ranges span the member's local header and data, up to the next
+    member. Members of unpacked archives are whole files.
+    """
+    ranges = []  # type: typing.List[Range]
+    zip_offsets = {}  # type: typing.Dict[str, typing.Dict[str, typing.Tuple[int, int]]]
+    for handle in handles:
+        for h in [handle] + handle.chunks():
+            if os.path.isdir(h.target):
+                path = os.path.join(h.target, h.name)
+                ranges.append((h.name, path, 0, os.path.getsize(path)))
+                continue
+
+            if h.target not in zip_offsets:
+                zip_offsets[h.target] = _zip_offsets(h.target)
+            if h.name in zip_offsets[h.target]:
+                offset, length = zip_offsets[h.target][h.name]
+                ranges.append((h.name, h.target, offset, length))
+    return ranges
+
+
+def _zip_offsets(path):
+    # type: (str) -> typing.Dict[str, typing.Tuple[int, int]]
+    with contextlib.closing(zipfile.ZipFile(path)) as zf:
+        infos = sorted(zf.infolist(), key=lambda i: i.header_offset)
+        end = getattr(zf, "start_dir", None) or os.path.getsize(path)
+    offsets = [i.header_offset for i in infos[1:]] + [end]
+    return {
+        info.filename: (info.header_offset, next_offset - info.header_offset)
+        for info, next_offset in zip(infos, offsets)
+    }
+
+
+class Prefetcher(object):
+    """Background prefetch of member ranges, ahead of extraction."""
+
+    def __init__(self, handles, mode, ahead=PREFETCH_AHEAD):
+        # type: (typing.List[PkgHandle], str, int) -> None
+        """Init prefetch of handles, in extraction order.
+
+        Args:
+            handles: Package handles, in the order extraction starts.
+            mode: Resolved prefetch mode, willneed or read.
+            ahead: Maximum bytes prefetched ahead of extraction.
+
+        """
+        self.ranges = member_ranges(handles)
+        self.mode = mode
+        self.ahead = ahead
+        self.lengths = dict((r[0], r[3]) for r in self.ranges)
+        self.started = set()  # type: typing.Set[str]
+        self.consumed = 0
+        self.prefetched = 0
+        self.elapsed = 0.0
+        self.stopped = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name="coex-prefetch")
+        self.thread.daemon = True
+
+    def start(self):
+        # type: () -> Prefetcher
+        """Start background prefetch."""
+        logger.debug("prefetch mode=%s members=%i", self.mode, len(self.ranges))
+        self.thread.start()
+        return self
+
+    def extracting(self, handle):
+        # type: (PkgHandle) -> None
+        """Mark handle, and its chunks, as extracting, advancing the prefetch."""
+        with self.cond:
+            for h in [handle] + handle.chunks():
+                if h.name in self.lengths and h.name not in self.started:
+                    self.started.add(h.name)
+                    self.consumed += self.lengths[h.name]
+            self.cond.notify()
+
+    def stop(self):
+        # type: () -> None
+        """Stop prefetch, and log the prefetched bytes and time spent."""
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        self.thread.join()
+        logger.info(
+            "prefetch mode=%s bytes=%i elapsed=%.3f",
+            self.mode,
+            self.prefetched,
+            self.elapsed,
+        )
+
+    def _run(self):
+        # type: () -> None
+        try:
+            for name, path, offset, length in self.ranges:
+                with self.cond:
+                    while (
+                        not self.stopped
+                        and name not in self.started
+                        and self.prefetched - self.consumed > self.ahead
+                    ):
+                        self.cond.wait()
+                    if self.stopped:
+                        return
+                    if name in self.started:
+                        # Extraction caught up with prefetch
+                        continue
+
+                start = time.time()
+                self._prefetch(path, offset, length)
+                self.elapsed += time.time() - start
+                self.prefetched += length
+        except (IOError, OSError) as ex:
+            logger.debug("prefetch failed: %s", ex)
+
+    def _prefetch(self, path, offset, length):
+        # type: (str, int, int) -> None
+        with open(path, "rb") as f:
+            if self.mode == "willneed":
+                os.posix_fadvise(  # type: ignore
+                    f.fileno(), offset, length, os.POSIX_FADV_WILLNEED  # type: ignore
+                )
+                return
+
+            f.seek(offset)
+            buf = bytearray(READ_BLOCK)
+            remaining = length
+            while remaining > 0 and not self.stopped:
+                read = f.readinto(buf)  # type: ignore
+                if not read:
+                    break
+                remaining -= read
+
+
+@contextlib.contextmanager
+def prefetch(
+    handles,  # type: typing.List[PkgHandle]
+    mode,  # type: str
+    timings=None,  # type: typing.Optional[typing.Dict[str, float]]
+):
+    # type: (...) -> typing.Iterator[typing.Optional[Prefetcher]]
+    """Prefetch handles in background while in context, None if mode is off.
+
+    Args:
+        handles: Package handles, in the order extraction starts.
+        mode: Prefetch mode, or boolean string.
+        timings: Section timings, adding the time spent prefetching.
+
+    Raises:
+        ValueError: Invalid mode.
+
+    """
+    mode = resolve_mode(mode)
+    if mode == "off" or not handles:
+        yield None
+        return
+
+    prefetcher = Prefetcher(handles, mode).start()
+    try:
+        yield prefetcher
+    finally:
+        prefetcher.stop()
+        if timings is not None:
+            timings["prefetch"] += prefetcher.elapsed
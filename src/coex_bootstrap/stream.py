@@ -0,0 +1,373 @@
+"""Streamed launch of coex archives, extracted as the archive is read.
+
+Archives built with `coex create --layout stream` are laid out to be read
+front to back: the bootstrap modules and binaries, then the bootstrap config,
+the upfront manifest of all following members, and sources, then packages and
+their chunks. Members are stored with sizes in their local headers, so the
+archive is read from a pipe without its central directory, and each package
+is extracted as its bytes arrive, overlapping download and install.
+
+This module is also the stream loader, run with the archive on stdin:
+
+    curl -sf https://example.com/app.coex | python coex_stream.py [args]
+
+where coex_stream.py is this module, eg. from `unzip -p app.coex
+coex_bootstrap/stream.py`. The loader only depends on the standard library,
+the bootstrap itself is loaded from the head of the stream. Stdin is consumed
+by the archive, the entrypoint is run with stdin at end of file.
+"""
+
+import logging
+import os
+import os.path
+import struct
+import sys
+
+MYPY = False
+if MYPY:
+    import typing
+
+    from coex_bootstrap import COEXOptions
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 1 << 20
+
+LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+ZIP64_EXTRA_ID = 0x0001
+
+CONFIG_MEMBER = "coex_bootstrap.json"
+
+
+class StreamError(Exception):
+    """Stream is not a readable stream layout coex archive."""
+
+    pass
+
+
+def _read_exact(source, size):
+    # type: (typing.Any, int) -> bytes
+    data = source.read(size)
+    if len(data) != size:
+        raise StreamError("stream ended within a member header")
+    return data
+
+
+def _zip64_sizes(extra, size, compress_size):
+    # type: (bytes, int, int) -> typing.Tuple[int, int]
+    # Zip64 sizes replace the 0xFFFFFFFF header sizes, in header order
+    while len(extra) >= 4:
+        extra_id, extra_size = struct.unpack("<HH", extra[:4])
+        if extra_id == ZIP64_EXTRA_ID:
+            values = list(
+                struct.unpack("<%iQ" % (extra_size // 8), extra[4:][:extra_size])
+            )
+            if size == 0xFFFFFFFF:
+                size = values.pop(0)
+            if compress_size == 0xFFFFFFFF:
+                compress_size = values.pop(0)
+            break
+        extra = extra[4 + extra_size :]
+    return size, compress_size
+
+
+class StreamMember(object):
+    """Stored archive member, read from the stream."""
+
+    def __init__(self, source, name, size):
+        # type: (typing.Any, str, int) -> None
+        """Init over source stream, positioned at the member data."""
+        self.source = source
+        self.name = name
+        self.size = size
+        self.remaining = size
+
+    def __repr__(self):  # noqa: D
+        return "StreamMember(name=%r, size=%i)" % (self.name, self.size)
+
+    def read(self, size=-1):
+        # type: (int) -> bytes
+        """Read up to size bytes of member data, all remaining if negative.
+
+        Raises:
+            StreamError: Stream ended within the member.
+
+        """
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        if not size:
+            return b""
+        data = self.source.read(size)
+        if not data:
+            raise StreamError("stream ended within member %s" % self.name)
+        self.remaining -= len(data)
+        return data
+
+    def drain(self):
+        # type: () -> None
+        """Skip remaining member data."""
+        while self.read(BLOCK_SIZE):
+            pass
+
+
+def read_members(source):
+    # type: (typing.Any) -> typing.Iterator[StreamMember]
+    """Iterate the stored members of a coex archive read from source.
+
+    Members are read from their local headers, in archive order, ending at the
+    central directory, which is left unread. Each member's data is skipped, if
+    not read, when the next member is read.
+
+    Raises:
+        StreamError: Member is compressed, or sized after its data.
+
+    """
+    signature = source.read(2)
+    if signature == b"#!":
+        # Skip the archive's shebang line
+        while signature[-1:] != b"\n":
+            signature = source.read(1)
+            if not signature:
+                return
+        signature = b""
+    signature += source.read(4 - len(signature))
+
+    while signature == LOCAL_HEADER_SIGNATURE:
+        header = LOCAL_HEADER.unpack(
+            signature + _read_exact(source, LOCAL_HEADER.size - 4)
+        )
+        _, _, flags, method, _, _, _, compress_size, size, name_size, extra_size = (
+            header
+        )
+        name = _read_exact(source, name_size).decode("utf-8")
+        extra = _read_exact(source, extra_size)
+        size, compress_size = _zip64_sizes(extra, size, compress_size)
+
+        if method != 0 or flags & 0x08:
+            raise StreamError(
+                "member %s is not readable from a stream, build the coex with "
+                "--layout stream" % name
+            )
+
+        member = StreamMember(source, name, compress_size)
+        yield member
+        member.drain()
+        signature = source.read(4)
+
+
+class StreamInstall(object):
+    """Install of a stream layout coex, from its member stream.
+
+    The bootstrap modules are loaded into package_dir by the stream loader,
+    read_head reads the binaries into the run dir and the config into
+    package_dir, as of an unpacked coex, and install extracts the following
+    members as they are read.
+    """
+
+    def __init__(self, source, members, package_dir):
+        # type: (typing.Any, typing.Iterator[StreamMember], str) -> None
+        """Init over source stream and its members, after the bootstrap modules.
+
+        Args:
+            source: Archive stream.
+            members: Unread members of source, see read_members.
+            package_dir: Directory of the loaded bootstrap modules.
+
+        """
+        self.source = source
+        self.members = members
+        self.package_dir = package_dir
+        self.run_dir = ""
+        self.binaries = {}  # type: typing.Dict[str, str]
+
+    def read_head(self, work_dir):
+        # type: (str) -> typing.Dict[str, typing.Any]
+        """Read binaries into a new run dir under work_dir, and the config.
+
+        Returns:
+            coex bootstrap config json, also written to package_dir.
+
+        Raises:
+            StreamError: Payload member before the config, eg. of a zip layout
+                coex.
+
+        """
+        import json
+
+        from coex_bootstrap.binaries import S_IXALL
+
+        self.run_dir = os.path.join(work_dir, "coex_stream_%i" % os.getpid())
+        os.makedirs(os.path.join(self.run_dir, "bin"))
+
+        for member in self.members:
+            if member.name == "__main__.py" or member.name.startswith(
+                "coex_bootstrap/"
+            ):
+                continue
+            elif member.name.startswith("bin/"):
+                path = os.path.join(self.run_dir, "bin", os.path.basename(member.name))
+                with open(path, "wb") as out:
+                    out.write(member.read())
+                os.chmod(path, os.stat(path).st_mode | S_IXALL)
+                self.binaries[os.path.basename(member.name)] = path
+            elif member.name == CONFIG_MEMBER:
+                data = member.read()
+                with open(os.path.join(self.package_dir, CONFIG_MEMBER), "wb") as out:
+                    out.write(data)
+                return json.loads(data.decode("utf-8"))
+            else:
+                raise StreamError(
+                    "member %s precedes the coex config, build the coex with "
+                    "--layout stream" % member.name
+                )
+
+        raise StreamError("stream ended before the coex config")
+
+    def install(self, config, options):
+        # type: (COEXBootstrapConfig, COEXOptions) -> str
+        """Extract sources and packages into the run dir, as they are read.
+
+        Packages are installed once the package and its chunks are extracted,
+        concurrently with the extraction of the following members.
+
+        Returns:
+            Installed conda env prefix.
+
+        """
+        from multiprocessing.pool import ThreadPool
+
+        from coex_bootstrap import SectionTimer, split_threads
+        from coex_bootstrap.binaries import COEXBootstrapBinaries
+        from coex_bootstrap.install import PaddingError, package_info_dir, post_extract
+        from coex_bootstrap.unpack import PkgHandle
+        from coex_bootstrap.verify import IntegrityError
+
+        if config.base:
+            sys.exit("ERROR: layered coex can not be run from a stream\n")
+
+        coex_binaries = COEXBootstrapBinaries(
+            **dict((b, self.binaries.get(b, b)) for b in COEXBootstrapBinaries.required)
+        )
+        conda_dir = os.path.join(self.run_dir, "conda")
+        usr_dir = os.path.join(self.run_dir, "usr")
+        os.makedirs(conda_dir)
+        os.makedirs(usr_dir)
+
+        # Package or sources and metadata by member name, of the extracted
+        # members, and unextracted member counts
+        extracted = {}  # type: typing.Dict[str, typing.Tuple[str, dict]]
+        unextracted = {}  # type: typing.Dict[str, int]
+        for name, member in config.members.items():
+            if not name.startswith(("pkgs/", "srcs/")):
+                continue
+            extracted[name] = (name, member)
+            for chunk in member.get("chunks", []):
+                extracted[chunk["name"]] = (name, chunk)
+            unextracted[name] = 1 + len(member.get("chunks", []))
+
+        workers, threads = split_threads(
+            options.concurrency, sum(1 for n in unextracted if n.startswith("pkgs/"))
+        )
+
+        def install(name):
+            # type: (str) -> None
+            with SectionTimer("post_extract_threads"):
+                dist = PkgHandle("-", name).dist
+                post_extract(conda_dir, package_info_dir(conda_dir, dist), threads)
+
+        # Threads only post_extract packages, while members are read
+        pool = ThreadPool(workers)
+        installs = []
+        try:
+            with SectionTimer("install_pkgs"):
+                for member in self.members:
+                    if member.name not in extracted:
+                        logging.debug("skip member=%s", member.name)
+                        continue
+
+                    name, metadata = extracted[member.name]
+
+                    handle = PkgHandle("-", member.name, metadata, options.verify)
+                    prefix_dir = usr_dir if name.startswith("srcs/") else conda_dir
+                    with SectionTimer("extract"):
+                        handle.extract_stream(coex_binaries, prefix_dir, member)
+
+                    unextracted[name] -= 1
+                    if name.startswith("pkgs/") and not unextracted[name]:
+                        installs.append(pool.apply_async(install, (name,)))
+
+                for result in installs:
+                    result.get()
+        except PaddingError as ex:
+            f, placeholder = ex.args
+            sys.exit("ERROR: placeholder '%s' too short in: %s\n" % (placeholder, f))
+        except (IntegrityError, StreamError) as ex:
+            sys.exit("ERROR: %s\n" % ex)
+        finally:
+            pool.terminate()
+            pool.join()
+
+        missing = sorted(n for n, count in unextracted.items() if count)
+        if missing:
+            sys.exit("ERROR: stream ended before members: %s\n" % ", ".join(missing))
+
+        if os.path.isdir(os.path.join(conda_dir, "info")):
+            os.rmdir(os.path.join(conda_dir, "info"))
+
+        # Read to the end of the stream, so the writer is not interrupted
+        while self.source.read(BLOCK_SIZE):
+            pass
+
+        return conda_dir
+
+
+def load_bootstrap(members, bootstrap_dir):
+    # type: (typing.Iterator[StreamMember], str) -> typing.Iterator[StreamMember]
+    """Write the bootstrap modules at the head of members into bootstrap_dir.
+
+    Returns:
+        The following members.
+
+    """
+    for member in members:
+        if member.name != "__main__.py" and not member.name.startswith(
+            "coex_bootstrap/"
+        ):
+            import itertools
+
+            return itertools.chain([member], members)
+
+        path = os.path.join(bootstrap_dir, *member.name.split("/"))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as out:
+            out.write(member.read())
+
+    raise StreamError("stream ended after the coex bootstrap")
+
+
+if __name__ == "__main__":
+    import shutil
+    import tempfile
+
+    source = getattr(sys.stdin, "buffer", sys.stdin)
+    bootstrap_dir = tempfile.mkdtemp(prefix="coex_stream_")
+    try:
+        try:
+            members = load_bootstrap(read_members(source), bootstrap_dir)
+        except StreamError as ex:
+            sys.exit("ERROR: %s\n" % ex)
+        sys.path.insert(0, bootstrap_dir)
+
+        import coex_bootstrap
+
+        # Run as the __main__.py of the loaded bootstrap, holding the config
+        coex_bootstrap.main(
+            __name__,
+            os.path.join(bootstrap_dir, "__main__.py"),
+            coex_bootstrap.COEXOptions(),
+            stream=StreamInstall(source, members, bootstrap_dir),
+        )
+    finally:
+        shutil.rmtree(bootstrap_dir)
@@ -1,53 +1,100 @@
-try:
-    import typing
-except ImportError:
-    pass
-
 import fnmatch
-import glob
 import logging
 import os
 import os.path
 import subprocess
-import zipfile
 
-from .binaries import COEXBootstrapBinaries
+MYPY = False
+if MYPY:
+    import typing
 
-logger = logging.getLogger(__name__)
+    from .binaries import COEXBootstrapBinaries
 
+logger = logging.getLogger(__name__)
 
-def zip_pkgs(target, fnmatch_pattern):
-    # type: (str, str) -> typing.List[PkgHandle]
+BLOCK_SIZE = 1 << 20
+
+
+def copy_to(source, sink, digest=None):
+    # type: (typing.Any, typing.IO[bytes], typing.Any) -> None
+    """Copy source, a readable file-like, into sink, updating digest if given.
+
+    The sink is closed once source is exhausted, or early if the sink is closed
+    by its reader, eg. a failed extraction, which the caller reports.
+    """
+    try:
+        for block in iter(lambda: source.read(BLOCK_SIZE), b""):
+            if digest is not None:
+                digest.update(block)
+            sink.write(block)
+    except (IOError, OSError) as ex:
+        logger.debug("copy_to interrupted: %s", ex)
+    finally:
+        try:
+            sink.close()
+        except (IOError, OSError):
+            pass
+
+
+def zip_pkgs(
+    target,  # type: str
+    fnmatch_pattern,  # type: str
+    members=None,  # type: typing.Optional[typing.Dict[str, dict]]
+    verify=False,  # type: bool
+):
+    # type: (...) -> typing.List[PkgHandle]
     """Get ZipPkgHandles matching given fnmatch_pattern."""
 
+    import zipfile
+
     logger.debug("zip_pkgs target=%s fnmatch_pattern=%s")
+    members = members or {}
     _zipfile = zipfile.ZipFile(target)
     return [
-        ZipPkgHandle(target, name)
+        ZipPkgHandle(target, name, members.get(name), verify)
         for name in fnmatch.filter(_zipfile.namelist(), fnmatch_pattern)
     ]
 
 
-def file_pkgs(target, glob_pattern):
-    # type: (str, str) -> typing.List[PkgHandle]
+def file_pkgs(
+    target,  # type: str
+    glob_pattern,  # type: str
+    members=None,  # type: typing.Optional[typing.Dict[str, dict]]
+    verify=False,  # type: bool
+):
+    # type: (...) -> typing.List[PkgHandle]
     """Get FilePkgHandles matching given glob pattern."""
 
     _full_glob = os.path.join(target, glob_pattern)
     logger.debug("file_pkgs target=%s glob_pattern=%s _full_glob=%s")
 
+    import glob
+
+    members = members or {}
     names = [os.path.relpath(p, target) for p in glob.glob(_full_glob)]
 
-    return [FilePkgHandle(target, name) for name in names]
+    return [FilePkgHandle(target, name, members.get(name), verify) for name in names]
 
 
 class PkgHandle(object):
     """Abstract, handle to compressed data within an archive."""
 
-    def __init__(self, target, name):
-        # type: (str, str) -> None
-        """Init over target zip archive and member name."""
+    def __init__(self, target, name, member=None, verify=False):
+        # type: (str, str, typing.Optional[dict], bool) -> None
+        """Init over target zip archive and member name.
+
+        Args:
+            target: Archive path.
+            name: Member name.
+            member: Member metadata from COEXBootstrapConfig.
+            verify: Verify member data against its recorded hash on extraction,
+                see coex_bootstrap.verify.
+
+        """
         self.target = target
         self.name = name
+        self.member = member or {}
+        self.verify = verify
 
     def __repr__(self):  # noqa: D
 
@@ -55,9 +102,68 @@ class PkgHandle(object):
             "{self.__class__.__name__}" "(target={self.target!r}, name={self.name!r})"
         ).format(self=self)
 
-    def extract(self, coex_binaries, prefix_dir):
+    @property
+    def dist(self):
+        # type: () -> str
+        """Package name-version-build of the member, its info dir name."""
+        name = os.path.basename(self.name)
+        return name[: -len(".tar.zst")] if name.endswith(".tar.zst") else name
+
+    def chunks(self):
+        # type: () -> typing.List[PkgHandle]
+        """Handles to the member's additional chunks, within the same archive."""
+        return [
+            type(self)(self.target, chunk["name"], chunk, self.verify)
+            for chunk in self.member.get("chunks", [])
+        ]
+
+    def extract(self, coex_binaries, prefix_dir, threads=None):
+        # type: (COEXBootstrapBinaries, str, typing.Optional[int]) -> None
+        """Extract compressed pkg from archive.
+
+        Chunked packages are split along file boundaries, chunks are
+        extracted concurrently into prefix_dir.
+
+        Args:
+            coex_binaries: Unpacked coex bootstrap binaries.
+            prefix_dir: Directory prefix for unpacked files.
+            threads: Chunks extracted concurrently, defaults to cpu count.
+
+        Raises:
+            CalledProcessError: Error in extraction subprocess.
+
+        """
+        handles = [self] + self.chunks()
+        if threads is None:
+            import multiprocessing
+
+            threads = multiprocessing.cpu_count()
+        threads = min(threads, len(handles))
+
+        if threads <= 1:
+            for handle in handles:
+                handle.extract_member(coex_binaries, prefix_dir)
+            return
+
+        from multiprocessing.pool import ThreadPool
+
+        def extract(handle):
+            handle.extract_member(coex_binaries, prefix_dir)
+
+        logger.debug("extract pkg=%s chunks=%i", self.name, len(handles))
+
+        # Threads only wait on the extraction subprocess pipelines
+        pool = ThreadPool(threads)
+        try:
+            for _ in pool.imap_unordered(extract, handles):
+                pass
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def extract_member(self, coex_binaries, prefix_dir):
         # type: (COEXBootstrapBinaries, str) -> None
-        """Abstract method, extract compressed pkg from archive.
+        """Abstract method, extract compressed member from archive.
 
         Args:
             coex_binaries: Unpacked coex bootstrap binaries.
@@ -66,17 +172,86 @@ class PkgHandle(object):
         Raises:
             NotImplementedError
             CalledProcessError: Error in extraction subprocess.
+            IntegrityError: Member does not match its recorded hash.
+
+        """
+        raise NotImplementedError("PkgHandle.extract_member")
+
+    def extract_stream(self, coex_binaries, prefix_dir, source):
+        # type: (COEXBootstrapBinaries, str, typing.Any) -> None
+        """Extract compressed member data read from source, eg. a pipe.
+
+        Args:
+            coex_binaries: Unpacked coex bootstrap binaries.
+            prefix_dir: Directory prefix for unpacked files.
+            source: Member data, a readable file-like.
+
+        Raises:
+            CalledProcessError: Error in extraction subprocess.
+            IntegrityError: Member does not match its recorded hash.
 
         """
-        raise NotImplementedError("PkgHandle.extract")
+        expected = None
+        if self.verify:
+            from coex_bootstrap.verify import check_hash, copy_hashed, expected_hash
+
+            expected = expected_hash(self.name, self.member)
+
+        decompress_cmd = self.decompress_cmd(coex_binaries)
+        untar_cmd = [coex_binaries.tar, "-x", "-C", prefix_dir]
+        logging.debug(
+            "extract_stream pkg=%s decompress=%r untar=%r",
+            self.name,
+            decompress_cmd,
+            untar_cmd,
+        )
+
+        # close_fds, the python 2 default is False, so that the zstd input pipe
+        # is only held by this process, and closing it ends the input
+        decompress = subprocess.Popen(
+            decompress_cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            bufsize=-1,
+            close_fds=True,
+        )
+        untar = subprocess.Popen(
+            untar_cmd, stdin=decompress.stdout, bufsize=-1, close_fds=True
+        )
+        decompress.stdout.close()  # type: ignore
+
+        if expected:
+            actual = copy_hashed(source, decompress.stdin)  # type: ignore
+        else:
+            copy_to(source, decompress.stdin)  # type: ignore
+
+        for proc, cmd in ((decompress, decompress_cmd), (untar, untar_cmd)):
+            proc.wait()
+            if proc.returncode:
+                raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+        if expected:
+            check_hash(self.name, expected, actual)
+
+    def decompress_cmd(self, coex_binaries):
+        # type: (COEXBootstrapBinaries) -> typing.List[str]
+        """Decompression command, with the member's recorded zstd parameters."""
+        cmd = [coex_binaries.zstd, "-d", "-c", "-q"]
+
+        compression = self.member.get("compression") or {}
+        if compression.get("long"):
+            # Windows over the default decompression memory limit require --long
+            cmd.append("--long=%i" % compression["long"])
+
+        return cmd
 
 
 class ZipPkgHandle(PkgHandle):
     """Handle to compressed package data in a zip archive."""
 
-    def extract(self, coex_binaries, prefix_dir):
+    def extract_member(self, coex_binaries, prefix_dir):
         # type: (COEXBootstrapBinaries, str) -> None
-        """Extract compressed pkg from archive.
+        """Extract compressed member from archive.
 
         Args:
             coex_binaries: Unpacked coex bootstrap binaries.
@@ -84,43 +259,71 @@ class ZipPkgHandle(PkgHandle):
 
         Raises:
             CalledProcessError: Error in extraction subprocess.
+            IntegrityError: Member does not match its recorded hash.
 
         """
 
         extract_cmd = [coex_binaries.unzip, "-p", self.target, self.name]
+        decompress_cmd = self.decompress_cmd(coex_binaries)
+        untar_cmd = [coex_binaries.tar, "-x", "-C", prefix_dir]
 
-        untar_cmd = (
-            [coex_binaries.tar]
-            # tar filtered through zstd
-            # Seeing errors on macos 10.13 image when using --use-compress-program
-            # with arguments, consider using a wrapper script if zstd arguments
-            # are needed.
-            + ["--use-compress-program", coex_binaries.zstd]
-            + ["-x", "-C", prefix_dir]
+        logging.debug(
+            "extract pkg=%s extract=%r decompress=%r untar=%r",
+            self.name,
+            extract_cmd,
+            decompress_cmd,
+            untar_cmd,
         )
 
-        logging.debug(
-            "extract pkg=%s extract=%r untar=%r", self.name, extract_cmd, untar_cmd
+        expected = None
+        if self.verify:
+            from coex_bootstrap.verify import check_hash, copy_hashed, expected_hash
+
+            expected = expected_hash(self.name, self.member)
+
+        # unzip | zstd | tar, rather than tar --use-compress-program, as zstd
+        # arguments are not supported by --use-compress-program on macos tar.
+        # close_fds, the python 2 default is False, so that the zstd input pipe
+        # is only held by this process, and closing it ends the input
+        extract = subprocess.Popen(
+            extract_cmd, stdout=subprocess.PIPE, bufsize=-1, close_fds=True
+        )
+        decompress = subprocess.Popen(
+            decompress_cmd,
+            stdin=subprocess.PIPE if expected else extract.stdout,
+            stdout=subprocess.PIPE,
+            bufsize=-1,
+            close_fds=True,
         )
+        untar = subprocess.Popen(
+            untar_cmd, stdin=decompress.stdout, bufsize=-1, close_fds=True
+        )
+        decompress.stdout.close()  # type: ignore
 
-        extract = subprocess.Popen(extract_cmd, stdout=subprocess.PIPE, bufsize=-1)
-        untar = subprocess.Popen(untar_cmd, stdin=extract.stdout, bufsize=-1)
+        if expected:
+            # Hash the member data in flight, between unzip and zstd
+            actual = copy_hashed(extract.stdout, decompress.stdin)  # type: ignore
+        extract.stdout.close()  # type: ignore
 
-        extract.wait()
-        if extract.returncode:
-            raise subprocess.CalledProcessError(extract.returncode, extract_cmd)
+        for proc, cmd in (
+            (extract, extract_cmd),
+            (decompress, decompress_cmd),
+            (untar, untar_cmd),
+        ):
+            proc.wait()
+            if proc.returncode:
+                raise subprocess.CalledProcessError(proc.returncode, cmd)
 
-        untar.wait()
-        if untar.returncode:
-            raise subprocess.CalledProcessError(untar.returncode, untar_cmd)
+        if expected:
+            check_hash(self.name, expected, actual)
 
 
 class FilePkgHandle(PkgHandle):
     """Handle to compressed package data in an unpacked archive."""
 
-    def extract(self, coex_binaries, prefix_dir):
+    def extract_member(self, coex_binaries, prefix_dir):
         # type: (COEXBootstrapBinaries, str) -> None
-        """Extract compressed pkg from archive.
+        """Extract compressed member from archive.
 
         Args:
             coex_binaries: Unpacked coex bootstrap binaries.
@@ -128,22 +331,33 @@ class FilePkgHandle(PkgHandle):
 
         Raises:
             CalledProcessError: Error in extraction subprocess.
+            IntegrityError: Member does not match its recorded hash.
 
         """
-        untar_cmd = (
-            [coex_binaries.tar]
-            # tar filtered through zstd
-            # Seeing errors on macos 10.13 image when using --use-compress-program
-            # with arguments, consider using a wrapper script if zstd arguments
-            # are needed.
-            + ["--use-compress-program", coex_binaries.zstd]
-            + ["-x", "-C", prefix_dir]
+        path = os.path.join(self.target, self.name)
+        if self.verify:
+            # Verified members are read, and hashed, in process
+            with open(path, "rb") as source:
+                self.extract_stream(coex_binaries, prefix_dir, source)
+            return
+
+        decompress_cmd = self.decompress_cmd(coex_binaries) + [path]
+        untar_cmd = [coex_binaries.tar, "-x", "-C", prefix_dir]
+
+        logging.debug(
+            "extract pkg=%s decompress=%r untar=%r",
+            self.name,
+            decompress_cmd,
+            untar_cmd,
         )
 
-        logging.debug("extract pkg=%s untar=%r", self.name, untar_cmd)
+        decompress = subprocess.Popen(
+            decompress_cmd, stdout=subprocess.PIPE, bufsize=-1
+        )
+        untar = subprocess.Popen(untar_cmd, stdin=decompress.stdout, bufsize=-1)
+        decompress.stdout.close()  # type: ignore
 
-        with open(os.path.join(self.target, self.name), "rb") as inf:
-            untar = subprocess.Popen(untar_cmd, stdin=inf, bufsize=-1)
-            untar.wait()
-            if untar.returncode:
-                raise subprocess.CalledProcessError(untar.returncode, untar_cmd)
+        for proc, cmd in ((decompress, decompress_cmd), (untar, untar_cmd)):
+            proc.wait()
+            if proc.returncode:
+                raise subprocess.CalledProcessError(proc.returncode, cmd)
@@ -0,0 +1,127 @@
+"""Integrity verification of archive members.
+
+`coex create` records a blake2b hash of each archive member in the bootstrap
+config. With COEX_VERIFY set, members are hashed as they are streamed into
+extraction, without a second read of the archive, and the launch fails on a
+mismatch. Verified archives are recorded under the work dir by device, inode,
+size and mtime, so an unchanged archive is verified once per host and user.
+
+Bootstrap modules and binaries run before verification, and are not covered.
+"""
+
+import errno
+import logging
+import os
+
+MYPY = False
+if MYPY:
+    import typing
+
+logger = logging.getLogger(__name__)
+
+HASH_NAME = "blake2b"
+HASH_SIZE = 32
+BLOCK_SIZE = 1 << 20
+
+
+class IntegrityError(Exception):
+    """Archive member does not match its recorded hash."""
+
+    pass
+
+
+def member_hash():
+    # type: () -> typing.Any
+    """New hash of member data, as recorded in member metadata under HASH_NAME.
+
+    Raises:
+        IntegrityError: blake2b is not available, before python 3.6.
+
+    """
+    # Imported where used, verify is imported on every launch
+    import hashlib
+
+    if not hasattr(hashlib, HASH_NAME):
+        raise IntegrityError("verification requires %s, python 3.6+" % HASH_NAME)
+    return hashlib.blake2b(digest_size=HASH_SIZE)  # type: ignore
+
+
+def file_hash(path):
+    # type: (str) -> str
+    """Hex member hash of file at path."""
+    digest = member_hash()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def expected_hash(name, member):
+    # type: (str, dict) -> str
+    """Recorded hex hash of member name, from its member metadata.
+
+    Raises:
+        IntegrityError: Member has no recorded hash, eg. of an older coex, or
+            the hash is not available.
+
+    """
+    expected = member.get(HASH_NAME)
+    if not expected:
+        raise IntegrityError("no recorded %s hash of member %s" % (HASH_NAME, name))
+    # Fail before extraction starts, if the hash is unavailable
+    member_hash()
+    return expected
+
+
+def copy_hashed(source, sink):
+    # type: (typing.Any, typing.IO[bytes]) -> str
+    """Copy source into sink, returning the hex member hash of the copied data.
+
+    See unpack.copy_to, the sink is closed once copied.
+    """
+    from coex_bootstrap.unpack import copy_to
+
+    digest = member_hash()
+    copy_to(source, sink, digest)
+    return digest.hexdigest()
+
+
+def check_hash(name, expected, actual):
+    # type: (str, str, str) -> None
+    """Raise IntegrityError if member name's actual hash is not expected."""
+    if actual != expected:
+        raise IntegrityError("member %s does not match its recorded hash" % name)
+
+
+def _stamp_path(work_dir, archive):
+    # type: (str, str) -> str
+    st = os.stat(archive)
+    key = "%i-%i-%i-%r" % (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+    return os.path.join(work_dir, "coex_verified", key)
+
+
+def _trusted(stamp_dir):
+    # type: (str) -> bool
+    # Stamps in a shared work dir are only trusted if written by this user
+    st = os.stat(stamp_dir)
+    return st.st_uid == os.getuid() and not st.st_mode & 0o022
+
+
+def is_verified(work_dir, archive):
+    # type: (str, str) -> bool
+    """If archive was verified, and is unchanged since."""
+    stamp = _stamp_path(work_dir, archive)
+    return os.path.exists(stamp) and _trusted(os.path.dirname(stamp))
+
+
+def mark_verified(work_dir, archive):
+    # type: (str, str) -> None
+    """Record archive as verified, keyed by its device, inode, size and mtime."""
+    stamp = _stamp_path(work_dir, archive)
+    try:
+        os.makedirs(os.path.dirname(stamp), 0o700)
+    except OSError as ex:
+        if ex.errno != errno.EEXIST:
+            raise
+    if _trusted(os.path.dirname(stamp)):
+        open(stamp, "a").close()
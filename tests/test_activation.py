@@ -0,0 +1,77 @@
+import pathlib
+
+from coex.activation import activation
+from coex_bootstrap.activate import activate_vars
+
+SCRIPTS = {
+    "mkl.sh": """\
+export MKL_NUM_THREADS=1
+export LD_LIBRARY_PATH="$CONDA_PREFIX/lib${LD_LIBRARY_PATH:+:$LD_LIBRARY_PATH}"
+export PATH="$CONDA_PREFIX/libexec:$PATH"
+unset MKL_CBWR
+""",
+    "gdal.sh": """\
+if [ -d "$CONDA_PREFIX/share/gdal" ]; then
+    export GDAL_DATA="$CONDA_PREFIX/share/gdal"
+fi
+if [ -d "$CONDA_PREFIX/share/missing" ]; then
+    export MISSING_DATA="$CONDA_PREFIX/share/missing"
+fi
+""",
+}
+
+
+def _package(root: pathlib.Path, name: str, files: dict) -> pathlib.Path:
+    package_dir = root / f"{name}-1.0-0"
+    for path, data in files.items():
+        (package_dir / path).parent.mkdir(parents=True, exist_ok=True)
+        (package_dir / path).write_text(data)
+    return package_dir
+
+
+def test_activation(tmp_path: pathlib.Path, monkeypatch):
+    """activate.d scripts are evaluated at build time, and applied at launch."""
+    monkeypatch.delenv("LD_LIBRARY_PATH", raising=False)
+    monkeypatch.setenv("MKL_CBWR", "AUTO")
+    package_dirs = [
+        _package(
+            tmp_path,
+            "mkl",
+            {f"etc/conda/activate.d/{k}": v for k, v in SCRIPTS.items()},
+        ),
+        _package(tmp_path, "gdal", {"share/gdal/header.dxf": ""}),
+        _package(tmp_path, "empty", {"info/index.json": "{}"}),
+    ]
+    assert activation(package_dirs[2:], tmp_path) == []
+
+    delta = activation(package_dirs, tmp_path)
+    assert [v["name"] for v in delta] == [
+        "GDAL_DATA",
+        "LD_LIBRARY_PATH",
+        "MKL_CBWR",
+        "MKL_NUM_THREADS",
+        "PATH",
+    ]
+    assert sorted(tmp_path.iterdir()) == sorted(package_dirs)
+
+    env = {"PATH": "/usr/bin", "MKL_CBWR": "AUTO"}
+    activate_vars(env, "/opt/env", delta)
+    assert env == {
+        "PATH": "/opt/env/libexec:/opt/env/bin:/usr/bin",
+        "CONDA_PREFIX": "/opt/env",
+        "GDAL_DATA": "/opt/env/share/gdal",
+        "LD_LIBRARY_PATH": "/opt/env/lib",
+        "MKL_NUM_THREADS": "1",
+    }
+
+    env = {"PATH": "/usr/bin", "LD_LIBRARY_PATH": "/usr/lib"}
+    activate_vars(env, "/opt/env", delta)
+    assert env["LD_LIBRARY_PATH"] == "/opt/env/lib:/usr/lib"
+
+
+def test_activation_failure(tmp_path: pathlib.Path):
+    """Failing activate.d scripts are skipped."""
+    package_dir = _package(
+        tmp_path, "broken", {"etc/conda/activate.d/broken.sh": "export A=1\nexit 1\n"}
+    )
+    assert activation([package_dir], tmp_path) == []
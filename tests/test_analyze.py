@@ -0,0 +1,79 @@
+import json
+import pathlib
+import subprocess
+import zipfile
+
+import attr
+
+from coex.analyze import (
+    analyze,
+    archive_stats,
+    calibrate,
+    concurrent_s,
+    format_table,
+)
+from coex_bootstrap.binaries import COEXBootstrapBinaries
+from coex_bootstrap.install import prefix_placeholder
+
+
+def _write_pkg(tmp_path: pathlib.Path, name: str, files: dict) -> pathlib.Path:
+    pkg_dir = tmp_path / name
+    for path, data in files.items():
+        (pkg_dir / path).parent.mkdir(parents=True, exist_ok=True)
+        (pkg_dir / path).write_bytes(data)
+
+    pkg = tmp_path / f"{name}.tar.zst"
+    subprocess.check_call(
+        ["tar", "--use-compress-program", "zstd", "-f", str(pkg)]
+        + ["-C", str(pkg_dir), "-c", "."]
+    )
+    return pkg
+
+
+def test_inspect(tmp_path: pathlib.Path):
+    """Package stats are read from the archive, and startup cost predicted."""
+    placeholder = prefix_placeholder.encode()
+    files = {
+        "bin/tool": b"#!" + placeholder + b"/bin/python\n" + b"x" * 1000,
+        "lib/libtool.so": b"\0" + placeholder + b"/lib\0" + b"\0" * 2000,
+        "lib/data": b"data" * 100,
+        "info/has_prefix": (
+            f"{prefix_placeholder} text bin/tool\n"
+            f"{prefix_placeholder} binary lib/libtool.so\n"
+        ).encode(),
+        "info/index.json": json.dumps({"noarch": "generic"}).encode(),
+    }
+    pkg = _write_pkg(tmp_path, "tool-1.0-0", files)
+
+    archive = tmp_path / "app.coex"
+    with archive.open("wb") as out:
+        out.write(b"#!/usr/bin/env python\n")
+        with zipfile.ZipFile(out, "w") as zf:
+            zf.writestr("coex_bootstrap.json", json.dumps({"entrypoint": "tool"}))
+            zf.write(str(pkg), f"pkgs/{pkg.name}")
+
+    binaries = COEXBootstrapBinaries(**COEXBootstrapBinaries.resolve())
+    (stats,) = archive_stats(archive, binaries)
+    assert stats.name == "pkgs/tool-1.0-0.tar.zst"
+    assert stats.file_count == 5
+    assert stats.prefix_files == 2
+    assert stats.prefix_bytes == len(files["bin/tool"]) + len(files["lib/libtool.so"])
+    assert stats.noarch == "generic"
+    assert stats.fixed_prefix is None
+    assert stats.compressed_size == pkg.stat().st_size
+
+    calibration = calibrate(tmp_path, binaries, sample_size=1 << 20, sample_files=20)
+    assert calibration.extract_bytes_per_s > 0
+    assert calibration.relocate_bytes_per_s > 0
+    chunked = attr.evolve(stats, chunks=4)
+    assert calibration.extract_s(chunked, 2) == calibration.extract_s(stats) / 2
+
+    # Concurrent installs are bound by the largest member, and the thread budget
+    assert concurrent_s([1.0, 1.0, 1.0, 1.0], 2) == 2.0
+    assert concurrent_s([3.0, 1.0, 1.0], 4) == 3.0
+    assert concurrent_s([], 4) == 0.0
+
+    analysis = analyze(archive, tmp_path, calibrated=False)
+    assert analysis["predicted"] is None
+    assert "pkgs/tool-1.0-0.tar.zst" in format_table(analysis)
+    json.dumps(analysis)
@@ -0,0 +1,91 @@
+import os
+import pathlib
+import subprocess
+import zipfile
+
+import pytest
+
+from coex.archive import ArchiveWriter, read_ahead
+from coex.pkg_src import pkg_src
+
+
+def _write(output: pathlib.Path, members: dict, replace_from=None) -> dict:
+    names = list(members)
+    if replace_from in names:
+        names = names[names.index(replace_from) :]
+    with ArchiveWriter(output, replace_from=replace_from) as archive:
+        return {n: archive.add(members[n], n, align=1 << 12) for n in names}
+
+
+def _check(output: pathlib.Path, members: dict, offsets: dict) -> None:
+    with zipfile.ZipFile(str(output)) as zf:
+        assert zf.testzip() is None
+        assert zf.namelist() == list(members)
+        for name, path in members.items():
+            assert zf.read(name) == path.read_bytes()
+    subprocess.check_call(["unzip", "-tq", str(output)], stdout=subprocess.DEVNULL)
+
+    data = output.read_bytes()
+    for name, offset in offsets.items():
+        size = members[name].stat().st_size
+        assert offset % (1 << 12) == 0
+        assert data[offset : offset + size] == members[name].read_bytes()
+
+
+def test_read_ahead(tmp_path: pathlib.Path):
+    """Blocks are read in order by the background reader, errors are raised."""
+    path = tmp_path / "data"
+    path.write_bytes(os.urandom(1 << 16))
+    assert b"".join(read_ahead(path, chunk_size=1000)) == path.read_bytes()
+
+    with pytest.raises(FileNotFoundError):
+        list(read_ahead(tmp_path / "missing"))
+
+
+def test_archive_writer(tmp_path: pathlib.Path):
+    """Streamed archives are valid zips, updated in place as a full rebuild."""
+    members = {}
+    for name, size in (("first", 100), ("second", 1 << 16), ("third", 5000)):
+        members[name] = tmp_path / name
+        members[name].write_bytes(os.urandom(size))
+    members["first"].chmod(0o755)
+
+    output = tmp_path / "app.coex"
+    _check(output, members, _write(output, members))
+    assert output.read_bytes().startswith(b"#!/usr/bin/env python\n")
+    assert os.access(str(output), os.X_OK)
+    assert [p.name for p in tmp_path.iterdir() if p.name.startswith(".")] == []
+
+    members["second"].write_bytes(os.urandom(1 << 15))
+    offsets = _write(output, members, replace_from="second")
+    assert list(offsets) == ["second", "third"]
+    _check(output, members, offsets)
+
+    rebuilt = tmp_path / "rebuilt.coex"
+    _write(rebuilt, members)
+    assert output.read_bytes() == rebuilt.read_bytes()
+
+    with pytest.raises(ValueError):
+        _write(output, members, replace_from="missing")
+
+
+def test_pkg_src_reuse(tmp_path: pathlib.Path, monkeypatch):
+    """Unchanged sources reuse the cached archive, modified sources rebuild it."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv("SOURCE_DATE_EPOCH", raising=False)
+    (tmp_path / "app" / "lib").mkdir(parents=True)
+    (tmp_path / "app" / "run.sh").write_text("echo hello\n")
+    (tmp_path / "app" / "lib" / "data").write_bytes(os.urandom(1 << 10))
+
+    srcs = pkg_src(["app"], tmp_path / "cache")
+    assert srcs
+    st = srcs.stat()
+    assert pkg_src(["app"], tmp_path / "cache") == srcs
+    assert (srcs.stat().st_ino, srcs.stat().st_mtime_ns) == (st.st_ino, st.st_mtime_ns)
+
+    os.utime(str(tmp_path / "app" / "lib" / "data"), (1_700_000_000,) * 2)
+    rebuilt = pkg_src(["app"], tmp_path / "cache")
+    assert rebuilt and rebuilt != srcs
+    assert sorted(p.name for p in (tmp_path / "cache").glob("*.tar.zst")) == sorted(
+        [srcs.name, rebuilt.name]
+    )
@@ -0,0 +1,67 @@
+import os
+import pathlib
+import subprocess
+import sys
+import zipfile
+
+from coex.cli import write_coex
+from coex.compress import CompressionPolicy
+from coex.pkg_env import PkgEnv
+from coex.pkg_src import ASSET_ALIGN, asset_files, pkg_src
+from coex_bootstrap.config import COEXBootstrapConfig
+
+CHECK_ASSETS = """
+import coex_assets
+data = coex_assets.open_asset("app/data/weights.bin")
+empty = coex_assets.open_asset("app/data/empty")
+print("%d %s %d" % (len(data), data[:5].decode(), len(empty)))
+"""
+
+
+def test_assets(tmp_path: pathlib.Path, monkeypatch):
+    """Assets are stored aligned, and mapped by the app without extraction."""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "app" / "data").mkdir(parents=True)
+    (tmp_path / "app" / "run.sh").write_text(
+        '#!/bin/sh\nexec "$TEST_PYTHON" -c "$TEST_CHECK"\n'
+    )
+    (tmp_path / "app" / "run.sh").chmod(0o755)
+    weights = b"model" + os.urandom(100000)
+    (tmp_path / "app" / "data" / "weights.bin").write_bytes(weights)
+    (tmp_path / "app" / "data" / "empty").write_bytes(b"")
+
+    assets = asset_files(["app/data"])
+    assert sorted(assets) == ["app/data/empty", "app/data/weights.bin"]
+
+    # Assets under sources are not duplicated in the sources archive
+    srcs = pkg_src(["app"], tmp_path / "cache", exclude=list(map(str, assets.values())))
+    assert srcs
+    listing = subprocess.check_output(["tar", "-I", "zstd", "-tf", str(srcs)])
+    assert b"weights.bin" not in listing
+
+    output = tmp_path / "app.coex"
+    write_coex(
+        output,
+        "app/run.sh",
+        PkgEnv(packages={}),
+        srcs,
+        CompressionPolicy(),
+        assets=assets,
+    )
+
+    config = COEXBootstrapConfig.read_archive(str(output))
+    asset = config.assets["app/data/weights.bin"]
+    assert asset["offset"] % ASSET_ALIGN == 0
+    assert asset["size"] == len(weights)
+    with output.open("rb") as archive:
+        archive.seek(asset["offset"])
+        assert archive.read(asset["size"]) == weights
+    with zipfile.ZipFile(str(output)) as zf:
+        assert zf.testzip() is None
+        assert zf.read(asset["member"]) == weights
+
+    result = subprocess.check_output(
+        [sys.executable, str(output)],
+        env=dict(os.environ, TEST_PYTHON=sys.executable, TEST_CHECK=CHECK_ASSETS),
+    )
+    assert result.split() == [str(len(weights)).encode(), b"model", b"0"]
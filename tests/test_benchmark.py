@@ -0,0 +1,60 @@
+import hashlib
+import json
+import pathlib
+import tarfile
+
+from coex.benchmark import ChannelSpec, summarize_runs, write_channel
+from coex_bootstrap.install import prefix_placeholder
+
+
+def test_write_channel(tmp_path: pathlib.Path):
+    """Synthetic channels are deterministic conda channels of spec."""
+    spec = ChannelSpec(packages=2, package_size=10000, small_file_ratio=0.5)
+    channel = tmp_path / "channel"
+    write_channel(channel, spec)
+
+    repodata = json.loads((channel / "noarch" / "repodata.json").read_text())
+    assert sorted(r["name"] for r in repodata["packages"].values()) == [
+        "coex-bench-0000",
+        "coex-bench-0001",
+    ]
+    for fn, record in repodata["packages"].items():
+        data = (channel / "noarch" / fn).read_bytes()
+        assert record["md5"] == hashlib.md5(data).hexdigest()
+        assert record["size"] == len(data)
+
+        with tarfile.open(str(channel / "noarch" / fn)) as tar:
+            names = tar.getnames()
+            paths = json.load(tar.extractfile("info/paths.json"))["paths"]
+        assert len([n for n in names if "/small/" in n]) == 4
+        prefix_paths = [p for p in paths if p.get("prefix_placeholder")]
+        assert len(prefix_paths) == spec.prefix_files
+        assert prefix_paths[0]["prefix_placeholder"] == prefix_placeholder
+        payload = sum(p["size_in_bytes"] for p in paths if p not in prefix_paths)
+        assert payload == spec.package_size
+
+    # Rewritten only if the spec changed
+    fn = sorted(repodata["packages"])[0]
+    data = (channel / "noarch" / fn).read_bytes()
+    (channel / "noarch" / fn).write_bytes(b"")
+    write_channel(channel, spec)
+    assert (channel / "noarch" / fn).read_bytes() == b""
+    write_channel(channel, ChannelSpec(packages=2, package_size=10000, seed=1))
+    assert (channel / "noarch" / fn).read_bytes() not in (b"", data)
+
+
+def test_summarize_runs():
+    """Runs are summarized by cache state."""
+    runs = [
+        dict(cache="cold", sections=dict(total=3.0, solve=1.0)),
+        dict(cache="cold", sections=dict(total=1.0, solve=1.0)),
+        dict(cache="cold", sections=dict(total=2.0, solve=1.0)),
+        dict(cache="warm", sections=dict(total=0.5)),
+    ]
+    assert summarize_runs(runs) == {
+        "cold": {
+            "solve": dict(min=1.0, median=1.0),
+            "total": dict(min=1.0, median=2.0),
+        },
+        "warm": {"total": dict(min=0.5, median=0.5)},
+    }
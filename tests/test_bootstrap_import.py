@@ -0,0 +1,78 @@
+import os
+import pathlib
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+import coex_bootstrap
+
+# Modules off the common launch path, imported only where used
+LAZY_MODULES = [
+    "argparse",
+    "distutils",
+    "glob",
+    "json",
+    "multiprocessing",
+    "shlex",
+    "tempfile",
+    "zipfile",
+    "coex_bootstrap.layers",
+]
+
+# Prints the modules newly imported by the bootstrap, one per line
+_IMPORT_SCRIPT = """
+import sys
+before = set(sys.modules)
+import coex_bootstrap
+coex_bootstrap.COEXOptions([])
+sys.stdout.write("\\n".join(sorted(set(sys.modules) - before)))
+"""
+
+
+def _python2():
+    for name in ("python2.7", "python2"):
+        path = shutil.which(name)
+        if (
+            path
+            and subprocess.call([path, "-c", "pass"], stderr=subprocess.DEVNULL) == 0
+        ):
+            return path
+    return None
+
+
+def _import_bootstrap(interpreter):
+    env = dict(os.environ)
+    env.pop("COEX_ARGS", None)
+    env["PYTHONPATH"] = str(pathlib.Path(coex_bootstrap.__file__).parent.parent)
+    output = subprocess.check_output(
+        [interpreter, "-c", _IMPORT_SCRIPT], env=env, cwd="/"
+    )
+    return output.decode("utf-8").split()
+
+
+@pytest.mark.parametrize("python2", [False, True], ids=["python3", "python2.7"])
+def test_lean_imports(python2):
+    """The no-argument launch path does not import modules used off the path."""
+    interpreter = _python2() if python2 else sys.executable
+    if not interpreter:
+        pytest.skip("python2.7 not installed, bootstrap 2.7 compatibility untested")
+
+    modules = _import_bootstrap(interpreter)
+    assert "coex_bootstrap" in modules
+    assert [m for m in LAZY_MODULES if m in modules] == []
+
+
+def test_options_env(monkeypatch):
+    """Options are loaded from env, control args are parsed if COEX_ARGS."""
+    monkeypatch.setenv("COEX_CLEANUP", "false")
+    monkeypatch.delenv("COEX_ARGS", raising=False)
+    options = coex_bootstrap.COEXOptions(["--cleanup", "true"])
+    assert options.cleanup is False
+    assert options.program_args == ["--cleanup", "true"]
+
+    monkeypatch.setenv("COEX_ARGS", "1")
+    options = coex_bootstrap.COEXOptions(["--cleanup", "true", "--", "-v"])
+    assert options.cleanup is True
+    assert options.program_args == ["-v"]
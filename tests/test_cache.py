@@ -0,0 +1,118 @@
+import multiprocessing
+import os
+import pathlib
+import shutil
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+from coex import cache
+from coex.pkg_env import repack
+
+
+def _entry(cache_dir: pathlib.Path, name: str, size: int, accessed: float):
+    path = cache_dir / "pkgs" / name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(os.urandom(size))
+    cache.record(path)
+    os.utime(str(cache.meta_path(path)), (accessed, accessed))
+    return path
+
+
+def test_gc_lru(tmp_path: pathlib.Path):
+    """gc evicts least recently used entries, skipping entries pinned by builds."""
+    now = time.time()
+    old = _entry(tmp_path, "old-1.0-0.tar.zst", 1000, now - 300)
+    pinned = _entry(tmp_path, "pinned-1.0-0.tar.zst", 1000, now - 200)
+    used = _entry(tmp_path, "used-1.0-0.tar.zst", 1000, now - 100)
+
+    # Access updates lru order
+    cache.touch(old)
+
+    with cache.BuildLease(tmp_path) as lease:
+        lease.pin(pinned)
+
+        evicted = cache.gc(tmp_path, max_size=1500)
+        assert [e.path for e in evicted] == [used, old]
+        assert pinned.exists() and cache.meta_path(pinned).exists()
+        assert not used.exists() and not cache.meta_path(used).exists()
+        assert lease.build_dir and lease.build_dir.exists()
+
+    assert not lease.build_dir.exists()
+    assert cache.gc(tmp_path, max_age=250) == []
+    assert [e.path for e in cache.gc(tmp_path, max_age=0)] == [pinned]
+
+
+def test_gc_stale_build(tmp_path: pathlib.Path):
+    """Build directories of finished builds are evicted."""
+    with cache.BuildLease(tmp_path, cleanup=False) as lease:
+        assert lease.build_dir
+        (lease.build_dir / "scratch").write_bytes(b"data")
+        assert cache.gc(tmp_path, max_age=0) == []
+
+    assert [e.path for e in cache.gc(tmp_path, max_age=0)] == [lease.build_dir]
+    assert not lease.build_dir.exists()
+
+
+def test_verify(tmp_path: pathlib.Path):
+    """verify detects modified entries."""
+    good = _entry(tmp_path, "good-1.0-0.tar.zst", 1000, time.time())
+    bad = _entry(tmp_path, "bad-1.0-0.tar.zst", 1000, time.time())
+    with bad.open("r+b") as f:
+        f.write(b"corrupt")
+
+    assert [e.path for e in cache.verify(tmp_path)] == [bad]
+    assert good.exists()
+
+
+def test_check(tmp_path: pathlib.Path):
+    """Entries are checked against their metadata, rehashed if not as recorded."""
+    entry = _entry(tmp_path, "entry-1.0-0.tar.zst", 1000, time.time())
+    assert cache.check(entry)
+
+    copy = tmp_path / "pkgs" / "copy-1.0-0.tar.zst"
+    shutil.copy(str(entry), str(copy))
+    shutil.copy(str(cache.meta_path(entry)), str(cache.meta_path(copy)))
+    assert cache.check(copy)
+
+    with entry.open("r+b") as f:
+        f.write(b"corrupt")
+    assert not cache.check(entry)
+    entry.write_bytes(b"truncated")
+    assert not cache.check(entry)
+
+
+def _repack(package_dir: pathlib.Path, cache_dir: pathlib.Path):
+    extracted = types.SimpleNamespace(
+        name="tool", extracted_package_dir=str(package_dir), sha256="a" * 64
+    )
+    with ThreadPoolExecutor(2) as pool:
+        results = list(
+            pool.map(lambda _: repack(extracted, cache_dir, chunk_size=1 << 14), "ab")
+        )
+    return [[p.name for p in paths] for paths in results]
+
+
+def test_concurrent_repack(tmp_path: pathlib.Path):
+    """Concurrent builds sharing a cache write each entry once, and reuse it."""
+    package_dir = tmp_path / "tool-1.0-0"
+    (package_dir / "info").mkdir(parents=True)
+    (package_dir / "info" / "index.json").write_text('{"name": "tool"}')
+    for i in range(4):
+        (package_dir / f"part{i}").write_bytes(os.urandom(1 << 13))
+    cache_dir = tmp_path / "cache" / "pkgs"
+
+    with multiprocessing.get_context("fork").Pool(2) as pool:
+        results = sum(pool.starmap(_repack, [(package_dir, cache_dir)] * 2), [])
+    assert len(results[0]) > 1 and all(r == results[0] for r in results)
+
+    paths = [cache_dir / name for name in results[0]]
+    created = [cache.read_meta(p)["created"] for p in paths]
+    assert all(cache.check(p) for p in paths)
+    assert not list(cache_dir.glob(".tmp_*"))
+
+    # Invalid entries are repacked
+    paths[-1].write_bytes(b"truncated")
+    assert _repack(package_dir, cache_dir) == [results[0]] * 2
+    assert cache.read_meta(paths[0])["created"] > created[0]
+    assert all(cache.check(p) for p in paths)
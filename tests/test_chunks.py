@@ -0,0 +1,80 @@
+import filecmp
+import os
+import pathlib
+import types
+import zipfile
+
+from coex import cache
+from coex.compress import entry_compression
+from coex.pkg_env import plan_chunks, repack
+from coex_bootstrap.binaries import COEXBootstrapBinaries
+from coex_bootstrap.unpack import ZipPkgHandle
+
+
+def _package(path: pathlib.Path) -> pathlib.Path:
+    (path / "info").mkdir(parents=True)
+    (path / "info" / "index.json").write_text('{"name": "big"}')
+    (path / "lib").mkdir()
+    for i in range(4):
+        (path / "lib" / f"part{i}").write_bytes(os.urandom(1 << 14))
+    os.link(str(path / "lib" / "part0"), str(path / "lib" / "part0.link"))
+    (path / "share" / "empty").mkdir(parents=True)
+    os.symlink("part1", str(path / "lib" / "part1.link"))
+    return path
+
+
+def test_plan_chunks(tmp_path: pathlib.Path):
+    """Chunks split along file boundaries, hard links are kept together."""
+    chunks = plan_chunks(_package(tmp_path / "big-1.0-0"), 1 << 15)
+
+    assert chunks[0][:4] == ["info", "lib", "share", "share/empty"]
+    assert "info/index.json" in chunks[0]
+    assert [c for c in chunks if "lib/part0" in c] == [
+        c for c in chunks if "lib/part0.link" in c
+    ]
+    assert sorted(sum(chunks, [])) == sorted(
+        os.path.relpath(os.path.join(d, f), str(tmp_path / "big-1.0-0"))
+        for d, dirnames, filenames in os.walk(str(tmp_path / "big-1.0-0"))
+        for f in dirnames + filenames
+    )
+    assert len(chunks) == 3
+
+
+def test_chunked_roundtrip(tmp_path: pathlib.Path):
+    """Chunked packages are reused from the cache and extracted concurrently."""
+    package_dir = _package(tmp_path / "big-1.0-0")
+    extracted = types.SimpleNamespace(
+        name="big", extracted_package_dir=str(package_dir)
+    )
+
+    paths = repack(extracted, tmp_path / "cache", chunk_size=1 << 15)
+    assert len(paths) == 3
+    assert cache.read_meta(paths[0])["chunks"] == [p.name for p in paths[1:]]
+    assert repack(extracted, tmp_path / "cache", chunk_size=1 << 15) == paths
+    assert len(repack(extracted, tmp_path / "cache")) == 1
+
+    archive = tmp_path / "app.coex"
+    member = dict(compression=entry_compression(paths[0], "default").as_dict())
+    member["chunks"] = []
+    with zipfile.ZipFile(str(archive), "w") as zf:
+        zf.write(str(paths[0]), "pkgs/big-1.0-0.tar.zst")
+        for i, path in enumerate(paths[1:], 1):
+            zf.write(str(path), f"chunks/big-1.0-0.c{i:04d}.tar.zst")
+            member["chunks"].append(
+                dict(
+                    name=f"chunks/big-1.0-0.c{i:04d}.tar.zst",
+                    compression=entry_compression(path, "default").as_dict(),
+                )
+            )
+
+    prefix_dir = tmp_path / "prefix"
+    prefix_dir.mkdir()
+    ZipPkgHandle(str(archive), "pkgs/big-1.0-0.tar.zst", member).extract(
+        COEXBootstrapBinaries(**COEXBootstrapBinaries.resolve()), str(prefix_dir)
+    )
+
+    comparison = filecmp.dircmp(str(package_dir / "lib"), str(prefix_dir / "lib"))
+    assert sorted(comparison.same_files) == sorted(os.listdir(str(package_dir / "lib")))
+    assert (prefix_dir / "share" / "empty").is_dir()
+    assert os.readlink(str(prefix_dir / "lib" / "part1.link")) == "part1"
+    assert (prefix_dir / "lib" / "part0.link").stat().st_nlink == 2
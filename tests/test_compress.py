@@ -0,0 +1,86 @@
+import os
+import pathlib
+import zipfile
+
+import pytest
+
+from coex import cache
+from coex.compress import (
+    AUTO_CANDIDATES,
+    POLICIES,
+    CompressionPolicy,
+    compress_tar,
+    entry_compression,
+)
+from coex_bootstrap.binaries import COEXBootstrapBinaries
+from coex_bootstrap.unpack import ZipPkgHandle
+
+
+def _source_tree(path: pathlib.Path) -> pathlib.Path:
+    (path / "lib").mkdir(parents=True)
+    block = os.urandom(1 << 12)
+    (path / "lib" / "data").write_bytes(block * 64 + os.urandom(1 << 14) + block * 64)
+    (path / "bin").mkdir()
+    (path / "bin" / "tool").write_bytes(b"#!/bin/sh\necho tool\n")
+    return path
+
+
+@pytest.mark.parametrize("policy", sorted(POLICIES) + ["auto"])
+def test_compress_roundtrip(tmp_path: pathlib.Path, policy):
+    """Policy archives are extracted by the bootstrap with recorded parameters."""
+    src = _source_tree(tmp_path / "src")
+    output = tmp_path / "pkg.tar.zst"
+
+    compression = compress_tar(["-C", str(src), "bin", "lib"], output, policy)
+    if policy == "auto":
+        assert compression in AUTO_CANDIDATES
+    else:
+        assert compression == POLICIES[policy]
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted(["src", "pkg.tar.zst"])
+
+    archive = tmp_path / "app.coex"
+    with zipfile.ZipFile(str(archive), "w") as zf:
+        zf.write(str(output), "pkgs/pkg.tar.zst")
+
+    member = dict(compression=compression.as_dict())
+    ZipPkgHandle(str(archive), "pkgs/pkg.tar.zst", member).extract(
+        COEXBootstrapBinaries(**COEXBootstrapBinaries.resolve()), str(tmp_path)
+    )
+    assert (tmp_path / "lib" / "data").read_bytes() == (src / "lib/data").read_bytes()
+
+
+def test_auto_budget(tmp_path: pathlib.Path):
+    """auto selects the smallest candidate within budget, or the fastest."""
+    src = _source_tree(tmp_path / "src")
+
+    tar_args = ["-C", str(src), "."]
+    compress_tar(tar_args, tmp_path / "default.tar.zst", "default")
+    compress_tar(tar_args, tmp_path / "max-ratio.tar.zst", "max-ratio")
+    compress_tar(tar_args, tmp_path / "auto.tar.zst", "auto", 1e6)
+    assert (tmp_path / "auto.tar.zst").stat().st_size <= min(
+        (tmp_path / f"{p}.tar.zst").stat().st_size for p in ("default", "max-ratio")
+    )
+
+    fastest = compress_tar(tar_args, tmp_path / "fastest.tar.zst", "auto", 0)
+    assert fastest in AUTO_CANDIDATES
+
+
+def test_policy(tmp_path: pathlib.Path):
+    """Package overrides, cache tags and recorded entry compression."""
+    policy = CompressionPolicy("max-ratio", {"python": "max-decompress-speed"})
+    assert policy.for_package("python") == "max-decompress-speed"
+    assert policy.for_package("numpy") == "max-ratio"
+    assert policy.tag("default") == ""
+    assert policy.tag("max-ratio") == ".z19w30"
+    assert policy.tag("auto") == ".auto200ms"
+
+    with pytest.raises(ValueError):
+        CompressionPolicy("fastest")
+
+    entry = tmp_path / "pkg.tar.zst"
+    entry.write_bytes(b"data")
+    assert entry_compression(entry, "auto") is None
+    assert entry_compression(entry, "max-ratio") == POLICIES["max-ratio"]
+
+    cache.record(entry, compression=POLICIES["max-ratio"].as_dict())
+    assert entry_compression(entry, "auto") == POLICIES["max-ratio"]
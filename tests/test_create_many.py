@@ -0,0 +1,111 @@
+import json
+import pathlib
+import threading
+import types
+
+import pytest
+
+from coex import pkg_env
+from coex.cli import read_manifest
+
+
+def _record(root: pathlib.Path, name: str):
+    package_dir = root / f"{name}-1.0-0"
+    (package_dir / "info").mkdir(parents=True)
+    (package_dir / "info" / "index.json").write_text(json.dumps(dict(name=name)))
+    (package_dir / "lib").mkdir()
+    (package_dir / "lib" / name).write_text(name)
+    return types.SimpleNamespace(
+        name=name, version="1.0", build="0", extracted_package_dir=str(package_dir)
+    )
+
+
+def test_pkg_envs_shared(tmp_path: pathlib.Path, monkeypatch):
+    """Envs are solved in turn, packages shared by envs fetched and repacked once."""
+    a, b, c = (_record(tmp_path, name) for name in "abc")
+    envs = {"one.yml": [a, b], "two.yml": [b, c], "three.yml": [a]}
+    solved = []
+    fetched = []
+    repacked = []
+
+    def solve(path):
+        solved.append((path.name, threading.current_thread()))
+        return envs[path.name]
+
+    def fetch(records):
+        records = list(records)
+        fetched.append([r.name for r in records])
+        return records
+
+    def repack(extracted, *args, **kwargs):
+        repacked.append(extracted.name)
+        return [tmp_path / f"{extracted.name}.tar.zst"]
+
+    monkeypatch.setattr(pkg_env, "solve", solve)
+    monkeypatch.setattr(pkg_env, "fetch", fetch)
+    monkeypatch.setattr(pkg_env, "repack", repack)
+    monkeypatch.setattr(pkg_env, "entry_compression", lambda *args: "zstd")
+
+    result = pkg_env.pkg_envs(
+        [pathlib.Path(f) for f in envs], tmp_path / "cache", jobs=2
+    )
+
+    # Conda solves are not thread safe
+    assert solved == [(name, threading.main_thread()) for name in envs]
+    assert fetched == [["a", "b", "c"]]
+    assert sorted(repacked) == ["a", "b", "c"]
+    assert [sorted(e.packages) for e in result] == [
+        ["a-1.0-0.tar.zst", "b-1.0-0.tar.zst"],
+        ["b-1.0-0.tar.zst", "c-1.0-0.tar.zst"],
+        ["a-1.0-0.tar.zst"],
+    ]
+
+
+def test_fixed_prefixes(tmp_path: pathlib.Path, monkeypatch):
+    """Outputs of the same env are relocated to distinct prefixes under the root."""
+    a, b = (_record(tmp_path, name) for name in "ab")
+    repacked = []
+
+    def repack(extracted, cache_dir, prefix, *args, **kwargs):
+        repacked.append((extracted.name, prefix))
+        return [tmp_path / f"{extracted.name}.tar.zst"]
+
+    monkeypatch.setattr(pkg_env, "solve", lambda path: [a, b])
+    monkeypatch.setattr(pkg_env, "fetch", lambda records: list(records))
+    monkeypatch.setattr(pkg_env, "repack", repack)
+    monkeypatch.setattr(pkg_env, "entry_compression", lambda *args: "zstd")
+
+    envs = [pathlib.Path("one.yml"), pathlib.Path("two.yml")]
+    result = pkg_env.pkg_envs(
+        envs, tmp_path / "cache", relocate_fixed=True, prefix_keys=["1", "2"]
+    )
+    prefixes = [e.prefix for e in result]
+    assert len(set(prefixes)) == 2
+    assert all(p.startswith("/tmp/coex-") and len(p) <= 32 for p in prefixes)
+    assert len(repacked) == 4
+
+    (shared,) = {
+        e.prefix
+        for e in pkg_env.pkg_envs(
+            envs, tmp_path / "cache", relocate_fixed=True, fixed_prefix_root="/scratch/"
+        )
+    }
+    assert shared == pkg_env.fixed_prefix([b, a], "/scratch")
+    assert shared.startswith("/scratch/coex-") and shared.endswith("/conda")
+
+
+def test_read_manifest(tmp_path: pathlib.Path):
+    """Manifest entries require an env file, entrypoint and unique output."""
+    manifest = tmp_path / "manifest.json"
+    app = dict(file="env.yml", entrypoint="run.sh", output="app.coex")
+
+    manifest.write_text(json.dumps([app]))
+    assert read_manifest(manifest) == [dict(app, sources=[], assets=[])]
+
+    manifest.write_text(json.dumps([app, app]))
+    with pytest.raises(ValueError, match="duplicate"):
+        read_manifest(manifest)
+
+    manifest.write_text(json.dumps([dict(app, base="base.coex")]))
+    with pytest.raises(ValueError, match="unknown"):
+        read_manifest(manifest)
@@ -0,0 +1,62 @@
+import os
+import pathlib
+import zipfile
+
+import pytest
+
+from coex.delta import DeltaError, apply_delta, create_delta, file_sha256
+
+_pkg_data = os.urandom(1 << 18)
+
+
+def _write_coex(path: pathlib.Path, members: dict):
+    with path.open("wb") as out:
+        out.write(b"#!/usr/bin/env python\n")
+        with zipfile.ZipFile(out, "w") as zf:
+            for name, data in members.items():
+                zf.writestr(name, data)
+
+
+def test_delta_roundtrip(tmp_path: pathlib.Path):
+    """Delta rebuilds byte-identical archive, copying unchanged members."""
+    old = tmp_path / "old.coex"
+    new = tmp_path / "new.coex"
+    _write_coex(
+        old,
+        {
+            "__main__.py": b"main",
+            "pkgs/numpy-1.16.3-py_0.tar.zst": _pkg_data + b"1.16.3",
+            "pkgs/python-3.6.3-0.tar.zst": _pkg_data[::-1],
+            "coex_bootstrap.json": b'{"entrypoint": "python"}',
+        },
+    )
+    _write_coex(
+        new,
+        {
+            "__main__.py": b"main",
+            "pkgs/numpy-1.16.4-py_0.tar.zst": _pkg_data + b"1.16.4",
+            "pkgs/python-3.6.3-0.tar.zst": _pkg_data[::-1],
+            "coex_bootstrap.json": b'{"entrypoint": "app/main.py"}',
+            "srcs/src.tar.zst": os.urandom(1024),
+        },
+    )
+
+    manifest = create_delta(old, new, tmp_path / "patch", tmp_path)
+    ops = {s.get("name"): s["op"] for s in manifest["segments"]}
+    assert ops["pkgs/python-3.6.3-0.tar.zst"] == "copy"
+    assert ops["pkgs/numpy-1.16.4-py_0.tar.zst"] == "patch"
+    assert ops["srcs/src.tar.zst"] == "data"
+    assert (tmp_path / "patch").stat().st_size < new.stat().st_size / 4
+
+    apply_delta(old, tmp_path / "patch", tmp_path / "rebuilt.coex", tmp_path)
+    assert file_sha256(tmp_path / "rebuilt.coex") == file_sha256(new)
+
+    # Delta is rejected for the wrong base archive
+    with pytest.raises(DeltaError):
+        apply_delta(new, tmp_path / "patch", tmp_path / "bad.coex", tmp_path)
+    assert not (tmp_path / "bad.coex").exists()
+
+    # Scratch directories are removed, also on failure
+    with pytest.raises(FileNotFoundError):
+        create_delta(old, new, tmp_path / "missing" / "patch", tmp_path)
+    assert not list(tmp_path.glob("delta_*")) and not list(tmp_path.glob("apply_*"))
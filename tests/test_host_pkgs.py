@@ -0,0 +1,81 @@
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import types
+
+from coex.cli import write_coex
+from coex.compress import CompressionPolicy
+from coex.pkg_env import PkgEnv, repack
+from coex.pkg_src import pkg_src
+from coex_bootstrap.config import COEXBootstrapConfig
+from coex_bootstrap.install import prefix_placeholder
+
+ORIGIN = dict(name="tool", version="1.0", build="0", sha256="a" * 64)
+
+
+def _extracted(pkgs_dir: pathlib.Path, **record) -> pathlib.Path:
+    package_dir = pkgs_dir / "tool-1.0-0"
+    (package_dir / "bin").mkdir(parents=True)
+    (package_dir / "bin" / "tool").write_text(f"#!/bin/sh\necho {prefix_placeholder}\n")
+    (package_dir / "bin" / "tool").chmod(0o755)
+    (package_dir / "lib").mkdir()
+    (package_dir / "lib" / "data").write_bytes(os.urandom(1 << 12))
+    (package_dir / "info").mkdir()
+    (package_dir / "info" / "has_prefix").write_text(
+        f"{prefix_placeholder} text bin/tool\n"
+    )
+    (package_dir / "info" / "repodata_record.json").write_text(
+        json.dumps(dict(ORIGIN, **record))
+    )
+    for path in (pkgs_dir, package_dir):
+        path.chmod(0o755)
+    return package_dir
+
+
+def test_host_pkgs(tmp_path: pathlib.Path, monkeypatch):
+    """Packages in a host cache, matching their origin, are linked not extracted."""
+    monkeypatch.chdir(tmp_path)
+    package_dir = _extracted(tmp_path / "build_pkgs")
+    (tmp_path / "app").mkdir()
+    (tmp_path / "app" / "run.sh").write_text("#!/bin/sh\ntool\n")
+    (tmp_path / "app" / "run.sh").chmod(0o755)
+
+    extracted = types.SimpleNamespace(extracted_package_dir=package_dir, **ORIGIN)
+    env = PkgEnv(packages={})
+    env.add(extracted, repack(extracted, tmp_path / "cache"), CompressionPolicy())
+    output = tmp_path / "app.coex"
+    write_coex(
+        output,
+        "app/run.sh",
+        env,
+        pkg_src(["app"], tmp_path / "cache"),
+        CompressionPolicy(),
+    )
+    config = COEXBootstrapConfig.read_archive(str(output))
+    assert config.members["pkgs/tool-1.0-0.tar.zst"]["origin"] == ORIGIN
+
+    host = _extracted(tmp_path / "host_pkgs")
+    other = _extracted(tmp_path / "other_pkgs", sha256="b" * 64)
+    for pkgs_dirs, linked in ((host.parent, True), (other.parent, False)):
+        work_dir = tmp_path / "work" / pkgs_dirs.name
+        work_dir.mkdir(parents=True)
+        result = subprocess.check_output(
+            [sys.executable, str(output)],
+            env=dict(
+                os.environ,
+                COEX_WORK_DIR=str(work_dir),
+                COEX_CLEANUP="0",
+                COEX_PKGS_DIRS=str(pkgs_dirs),
+            ),
+        )
+        (run_dir,) = work_dir.iterdir()
+        assert result == f"{run_dir}/conda\n".encode()
+
+        data = run_dir / "conda" / "lib" / "data"
+        host_data = pkgs_dirs / "tool-1.0-0" / "lib" / "data"
+        source = host_data if linked else package_dir / "lib" / "data"
+        assert data.read_bytes() == source.read_bytes()
+        assert os.path.samefile(str(data), str(host_data)) == linked
+        assert prefix_placeholder in (host / "bin" / "tool").read_text()
@@ -0,0 +1,166 @@
+import json
+import os
+import pathlib
+import random
+
+import pytest
+
+from coex_bootstrap import SectionTimer, split_threads
+from coex_bootstrap.install import (
+    PaddingError,
+    binary_replace,
+    read_paths_json,
+    update_prefix,
+)
+
+_placeholder = "/opt/anaconda1anaconda2" "anaconda3"
+
+
+def _random_data(rng, size):
+    return bytes(bytearray(rng.getrandbits(8) for _ in range(size)))
+
+
+def _with_placeholders(rng, count):
+    """Random data with null terminated, binary placeholder strings."""
+    data = b""
+    for _ in range(count):
+        data += _random_data(rng, rng.randint(0, 300))
+        data += _placeholder.encode() + b"/lib" * rng.randint(0, 3) + b"\0"
+        data += b"\0" * rng.randint(0, 3)
+    return data + _random_data(rng, rng.randint(0, 300))
+
+
+@pytest.mark.parametrize("chunk_size", [7, 32, 33, 101, 1 << 22])
+@pytest.mark.parametrize("mode", ["text", "binary"])
+def test_update_prefix_streaming(tmp_path: pathlib.Path, chunk_size, mode):
+    """Streamed prefix update matches whole-file replacement at any chunk size."""
+    rng = random.Random(chunk_size)
+    new_prefix = "/tmp/coex/conda"
+
+    for i in range(20):
+        data = _with_placeholders(rng, rng.randint(0, 5))
+        target = tmp_path / f"{mode}.{i}"
+        target.write_bytes(data)
+        target.chmod(0o751)
+
+        update_prefix(
+            str(target), new_prefix, _placeholder, mode, chunk_size=chunk_size
+        )
+
+        if mode == "text":
+            expected = data.replace(_placeholder.encode(), new_prefix.encode())
+        else:
+            expected = binary_replace(data, _placeholder.encode(), new_prefix.encode())
+
+        assert target.read_bytes() == expected
+        assert target.stat().st_mode & 0o777 == 0o751
+
+    assert sorted(os.listdir(tmp_path)) == sorted(f"{mode}.{i}" for i in range(20))
+
+
+def test_update_prefix_untouched(tmp_path: pathlib.Path):
+    """Files without placeholder are not rewritten."""
+    target = tmp_path / "no_placeholder"
+    target.write_bytes(b"/opt/anaconda1anaconda2" * 1000)
+    inode = target.stat().st_ino
+
+    update_prefix(str(target), "/tmp/coex/conda", _placeholder, "binary", chunk_size=32)
+    assert target.stat().st_ino == inode
+
+
+def test_update_prefix_padding(tmp_path: pathlib.Path):
+    """Binary replacement fails if the new prefix is longer than the placeholder."""
+    target = tmp_path / "binary"
+    target.write_bytes(b"\0" + _placeholder.encode() + b"/bin\0")
+
+    with pytest.raises(PaddingError):
+        update_prefix(str(target), "/tmp" * 20, _placeholder, "binary")
+
+
+@pytest.mark.parametrize("chunk_size", [7, 33, 1 << 22])
+def test_update_prefix_slack(tmp_path: pathlib.Path, chunk_size):
+    """Pre-relocated binaries may be relocated again into the retained padding."""
+    rng = random.Random(chunk_size)
+    fixed_prefix = "/tmp/coex-0123/conda"
+    slack = len(_placeholder) - len(fixed_prefix)
+    run_prefix = "/tmp/coex/conda_1234/conda"
+    assert len(fixed_prefix) < len(run_prefix) <= len(_placeholder)
+
+    for i in range(20):
+        data = _with_placeholders(rng, rng.randint(1, 5))
+        target = tmp_path / f"binary.{i}"
+        target.write_bytes(data)
+
+        update_prefix(str(target), fixed_prefix, _placeholder, "binary")
+        with pytest.raises(PaddingError):
+            binary_replace(
+                target.read_bytes(), fixed_prefix.encode(), run_prefix.encode()
+            )
+
+        update_prefix(
+            str(target), run_prefix, fixed_prefix, "binary", slack, chunk_size
+        )
+        assert target.read_bytes() == binary_replace(
+            data, _placeholder.encode(), run_prefix.encode()
+        )
+
+
+def test_read_paths_json(tmp_path: pathlib.Path):
+    """paths.json prefix files are read with file modes."""
+    paths = tmp_path / "paths.json"
+    paths.write_text(
+        json.dumps(
+            {
+                "paths": [
+                    {"_path": "bin/python", "path_type": "hardlink"},
+                    {
+                        "_path": "bin/pip",
+                        "path_type": "hardlink",
+                        "prefix_placeholder": _placeholder,
+                    },
+                    {
+                        "_path": "lib/libpython3.6m.so",
+                        "path_type": "hardlink",
+                        "prefix_placeholder": _placeholder,
+                        "file_mode": "binary",
+                    },
+                ],
+                "paths_version": 1,
+            }
+        )
+    )
+
+    assert read_paths_json(str(paths)) == {
+        "bin/pip": (_placeholder, "text"),
+        "lib/libpython3.6m.so": (_placeholder, "binary"),
+    }
+
+
+def test_split_threads():
+    """Package and per-package pools share one thread budget."""
+    assert split_threads(8, 100) == (8, 1)
+    assert split_threads(8, 3) == (3, 2)
+    assert split_threads(8, 1) == (1, 8)
+    assert split_threads(2, 0) == (1, 2)
+    workers, threads = split_threads(None, 1)
+    assert workers == 1 and threads == os.cpu_count()
+
+
+def test_section_timer_threads():
+    """Sections timed concurrently by many threads are summed, not lost."""
+    from multiprocessing.pool import ThreadPool
+
+    SectionTimer.sections.pop("test_threads", None)
+
+    def timed(_):
+        for _ in range(1000):
+            with SectionTimer("test_threads") as timer:
+                timer.start -= 0.001
+
+    pool = ThreadPool(8)
+    try:
+        pool.map(timed, range(8))
+    finally:
+        pool.terminate()
+        pool.join()
+    assert SectionTimer.sections.pop("test_threads") >= 8 * 1000 * 0.001
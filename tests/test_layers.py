@@ -0,0 +1,178 @@
+import os
+import pathlib
+import shutil
+import subprocess
+import sys
+import types
+import zipfile
+
+import pytest
+from click.testing import CliRunner
+
+from coex import pkg_env
+from coex.cli import cli, read_archive_config, write_coex
+from coex.compress import CompressionPolicy
+from coex.pkg_env import PkgEnv, repack
+from coex.pkg_src import pkg_src
+from coex_bootstrap.install import prefix_placeholder, update_prefix
+from coex_bootstrap.layers import archive_id, base_dirs, find_base, link_tree
+
+
+def _package(root: pathlib.Path, name: str) -> types.SimpleNamespace:
+    package_dir = root / f"{name}-1.0-0"
+    (package_dir / "bin").mkdir(parents=True)
+    (package_dir / "bin" / name).write_text(f"#!/bin/sh\necho {prefix_placeholder}\n")
+    (package_dir / "bin" / name).chmod(0o755)
+    (package_dir / "info").mkdir()
+    (package_dir / "info" / "has_prefix").write_text(
+        f"{prefix_placeholder} text bin/{name}\n"
+    )
+    return types.SimpleNamespace(name=name, extracted_package_dir=str(package_dir))
+
+
+def _env(tmp_path: pathlib.Path, name: str) -> PkgEnv:
+    extracted = _package(tmp_path / "extracted", name)
+    env = PkgEnv(packages={})
+    env.add(extracted, repack(extracted, tmp_path / "cache"), CompressionPolicy())
+    return env
+
+
+def test_layered_launch(tmp_path: pathlib.Path, monkeypatch):
+    """A thin coex installs over its base, found by id and installed once."""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "bases").mkdir()
+    base = tmp_path / "bases" / "base.coex"
+    write_coex(base, "bin/tool", _env(tmp_path, "tool"), None, CompressionPolicy())
+
+    (tmp_path / "app").mkdir()
+    (tmp_path / "app" / "run.sh").write_text("#!/bin/sh\ntool\napp\n")
+    (tmp_path / "app" / "run.sh").chmod(0o755)
+    thin = tmp_path / "app.coex"
+    base_ref = dict(archive_id=archive_id(str(base)), name=base.name)
+    write_coex(
+        thin,
+        "app/run.sh",
+        _env(tmp_path, "app"),
+        pkg_src(["app"], tmp_path / "cache"),
+        CompressionPolicy(),
+        base_ref=base_ref,
+    )
+    with zipfile.ZipFile(str(thin)) as zf:
+        assert [n for n in zf.namelist() if n.startswith("pkgs/")] == [
+            "pkgs/app-1.0-0.tar.zst"
+        ]
+
+    # Base archives are found by id, also when renamed
+    base = base.rename(base.with_name("renamed.coex"))
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+    env = dict(os.environ, COEX_WORK_DIR=str(work_dir), COEX_BASE_PATH=str(base.parent))
+
+    output = subprocess.check_output([sys.executable, str(thin)], env=env).decode()
+    base_dir, base_conda_dir = base_dirs(base_ref, str(work_dir))
+    tool, app = output.splitlines()
+    assert tool == base_conda_dir
+    assert app.startswith(str(work_dir)) and app != base_conda_dir
+    # The run dir is cleaned up, the base dir persists
+    assert all(n.startswith("coex_base_") for n in os.listdir(str(work_dir)))
+    assert os.path.isdir(base_dir)
+
+    # Later launches reuse the installed base, without the base archive
+    sentinel = pathlib.Path(base_conda_dir) / "sentinel"
+    sentinel.write_text("installed")
+    base.unlink()
+    assert subprocess.check_output([sys.executable, str(thin)], env=env).decode()
+    assert sentinel.exists()
+
+
+def test_find_base(tmp_path: pathlib.Path):
+    """Bases are matched by archive id, renamed bases found and modified rejected."""
+    base = tmp_path / "base.coex"
+    with zipfile.ZipFile(str(base), "w") as zf:
+        zf.writestr("pkgs/tool-1.0-0.tar.zst", b"tool")
+    ref = dict(archive_id=archive_id(str(base)), name=base.name)
+    assert find_base(ref, [str(tmp_path)]) == str(base)
+
+    renamed = base.rename(tmp_path / "other.coex")
+    assert find_base(ref, [str(tmp_path / "missing"), str(tmp_path)]) == str(renamed)
+
+    with zipfile.ZipFile(str(renamed), "a") as zf:
+        zf.writestr("pkgs/extra-1.0-0.tar.zst", b"extra")
+    assert find_base(ref, [str(tmp_path)]) is None
+
+
+def test_link_tree(tmp_path: pathlib.Path):
+    """Linked trees keep symlinks, and prefix updates leave the source unchanged."""
+    src = tmp_path / "base"
+    (src / "bin").mkdir(parents=True)
+    script = src / "bin" / "tool"
+    script.write_text(f"#!{prefix_placeholder}/bin/sh\n")
+    os.symlink("tool", str(src / "bin" / "tool-link"))
+    (src / "empty").mkdir()
+
+    dst = tmp_path / "layer"
+    link_tree(str(src), str(dst))
+    assert os.path.samefile(str(script), str(dst / "bin" / "tool"))
+    assert os.readlink(str(dst / "bin" / "tool-link")) == "tool"
+    assert (dst / "empty").is_dir()
+
+    update_prefix(str(dst / "bin" / "tool"), str(dst), prefix_placeholder, "text")
+    assert (dst / "bin" / "tool").read_text() == f"#!{dst}/bin/sh\n"
+    assert script.read_text() == f"#!{prefix_placeholder}/bin/sh\n"
+    shutil.rmtree(str(dst))
+    assert script.exists()
+
+
+def test_create_base(tmp_path: pathlib.Path, monkeypatch):
+    """create --base references the base by id, and rejects layered bases."""
+    monkeypatch.chdir(tmp_path)
+    base = tmp_path / "base.coex"
+    write_coex(base, "bin/tool", _env(tmp_path, "tool"), None, CompressionPolicy())
+    (tmp_path / "app").mkdir()
+    (tmp_path / "app" / "run.sh").write_text("#!/bin/sh\ntool\n")
+
+    args = ["--cache", str(tmp_path / "cache"), "create", "--entrypoint", "app/run.sh"]
+    result = CliRunner().invoke(
+        cli, args + ["--base", "base.coex", "-o", "thin.coex", "app"]
+    )
+    assert result.exit_code == 0, result.output
+    config = read_archive_config(tmp_path / "thin.coex")
+    assert config.base == dict(archive_id=archive_id(str(base)), name="base.coex")
+
+    result = CliRunner().invoke(
+        cli, args + ["--base", "thin.coex", "-o", "x.coex", "app"]
+    )
+    assert result.exit_code != 0 and "layered" in result.output
+
+
+def test_solve_pinned_base(tmp_path: pathlib.Path, monkeypatch):
+    """Base packages are pinned in the solve, and excluded from the output."""
+    specs = []
+
+    class Solver:
+        def __init__(self, prefix, channels, subdirs, specs_to_add):
+            specs.extend(str(s) for s in specs_to_add)
+
+        def solve_final_state(self):
+            return [
+                types.SimpleNamespace(name="python", version="3.8.1", build="h0_1"),
+                types.SimpleNamespace(name="app", version="1.0", build="0"),
+            ]
+
+    environment = types.SimpleNamespace(
+        dependencies={"conda": ["app"]}, channels=["nodefaults"]
+    )
+    monkeypatch.setattr(
+        pkg_env,
+        "YamlFileSpec",
+        lambda filename: types.SimpleNamespace(environment=environment),
+    )
+    monkeypatch.setattr(pkg_env, "Solver", Solver)
+
+    base = ["python-3.8.1-h0_1"]
+    records = pkg_env.solve(tmp_path / "env.yml", base)
+    assert specs == ["app", "python==3.8.1=h0_1"]
+    assert [r.name for r in pkg_env.exclude_records(records, base)] == ["app"]
+
+    with pytest.raises(ValueError, match="conflicts with base"):
+        pkg_env.exclude_records(records, ["python-3.9.0-h0_0"])
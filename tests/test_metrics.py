@@ -0,0 +1,84 @@
+import json
+import os
+import pathlib
+import subprocess
+import sys
+
+from click.testing import CliRunner
+
+from coex.cli import cli, write_coex
+from coex.compress import CompressionPolicy
+from coex.metrics import percentile, read_records, summarize
+from coex.pkg_env import PkgEnv
+from coex.pkg_src import pkg_src
+from coex_bootstrap.metrics import append_record
+
+
+def test_metrics_log(tmp_path: pathlib.Path, monkeypatch):
+    """Launches append metrics records, summarized by coex stats."""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "app").mkdir()
+    (tmp_path / "app" / "run.sh").write_text("#!/bin/sh\nexit 3\n")
+    (tmp_path / "app" / "run.sh").chmod(0o755)
+    srcs = pkg_src(["app"], tmp_path / "cache")
+    write_coex(
+        tmp_path / "app.coex",
+        "app/run.sh",
+        PkgEnv(packages={}),
+        srcs,
+        CompressionPolicy(),
+    )
+
+    log = tmp_path / "metrics" / "coex.jsonl"
+    for _ in range(2):
+        subprocess.call(
+            [sys.executable, str(tmp_path / "app.coex")],
+            env=dict(os.environ, COEX_METRICS_LOG=str(log)),
+        )
+
+    records = [json.loads(line) for line in log.read_text().splitlines()]
+    assert len(records) == 2
+    assert records[0]["archive"] == "app.coex"
+    assert records[0]["mode"] == "unpack"
+    assert records[0]["returncode"] == 3
+    assert records[0]["extracted_bytes"] >= srcs.stat().st_size
+    assert {"total", "extract"} <= set(records[0]["sections"])
+    assert "cleanup" in records[0]["cleanup_sections"]
+
+    result = CliRunner().invoke(cli, ["stats", str(log), "--json"])
+    assert result.exit_code == 0, result.output
+    (summary,) = json.loads(result.output)
+    assert summary["launches"] == 2
+    assert summary["sections"]["total"]["count"] == 2
+
+    result = CliRunner().invoke(cli, ["stats", str(log), "--by", "host"])
+    assert result.exit_code == 0, result.output
+    assert "total" in result.output
+
+
+def test_metrics_rotate(tmp_path: pathlib.Path):
+    """The log rotates to a single backup past its size cap."""
+    log = str(tmp_path / "coex.jsonl")
+    for i in range(10):
+        append_record(log, {"archive": "a", "sections": {"total": i}}, max_size=100)
+
+    assert os.path.getsize(log) <= 100
+    assert sorted(os.listdir(str(tmp_path))) == [
+        "coex.jsonl",
+        "coex.jsonl.1",
+        "coex.jsonl.lock",
+    ]
+
+    records = read_records([pathlib.Path(log)])
+    assert records[-1]["sections"] == {"total": 9}
+    (summary,) = summarize(records)
+    assert summary["launches"] == len(records) < 10
+    assert summary["sections"]["total"]["max"] == 9
+
+
+def test_percentile():
+    """Nearest-rank percentiles."""
+    values = [float(v) for v in range(1, 101)]
+    assert percentile(values, 50) == 50.0
+    assert percentile(values, 99) == 99.0
+    assert percentile([1.0], 90) == 1.0
@@ -0,0 +1,91 @@
+import json
+import os
+import pathlib
+import subprocess
+import types
+
+from coex.pkg_env import repack
+from coex_bootstrap import install_pkgs
+from coex_bootstrap.binaries import COEXBootstrapBinaries
+from coex_bootstrap.install import prefix_placeholder
+from coex_bootstrap.unpack import file_pkgs
+
+SITE_PACKAGES = "lib/python3.9/site-packages"
+
+
+def _package(root: pathlib.Path, name: str, files: dict, **info) -> pathlib.Path:
+    package_dir = root / f"{name}-1.0-0"
+    for path, data in files.items():
+        (package_dir / path).parent.mkdir(parents=True, exist_ok=True)
+        (package_dir / path).write_text(data)
+    for path, data in dict(info, **{"index.json": dict(name=name)}).items():
+        (package_dir / "info" / path).parent.mkdir(parents=True, exist_ok=True)
+        (package_dir / "info" / path).write_text(json.dumps(data))
+    return package_dir
+
+
+def test_noarch_install(tmp_path: pathlib.Path):
+    """noarch python packages are laid out at build time, and installed in any order."""
+    tool = _package(
+        tmp_path / "extracted",
+        "tool",
+        {
+            "site-packages/tool/__init__.py": "def main():\n    print('tool')\n",
+            "python-scripts/tool-script": f"#!{prefix_placeholder}/bin/python\n",
+        },
+        **{
+            "repodata_record.json": dict(name="tool", noarch="python"),
+            "link.json": dict(
+                noarch=dict(type="python", entry_points=["tool = tool:main"])
+            ),
+            "paths.json": dict(
+                paths=[
+                    dict(_path="site-packages/tool/__init__.py"),
+                    dict(
+                        _path="python-scripts/tool-script",
+                        prefix_placeholder=prefix_placeholder,
+                    ),
+                ]
+            ),
+        },
+    )
+    python = _package(
+        tmp_path / "extracted",
+        "python",
+        {"bin/python": "#!/bin/sh\n", f"{SITE_PACKAGES}/README.txt": "site\n"},
+    )
+
+    archive_dir = tmp_path / "archive"
+    (archive_dir / "pkgs").mkdir(parents=True)
+    for package_dir in (tool, python):
+        extracted = types.SimpleNamespace(
+            name=package_dir.name.split("-")[0],
+            extracted_package_dir=str(package_dir),
+        )
+        (path,) = repack(extracted, tmp_path / "cache", site_packages=SITE_PACKAGES)
+        os.link(str(path), str(archive_dir / "pkgs" / f"{package_dir.name}.tar.zst"))
+
+    names = subprocess.check_output(
+        ["tar", "--use-compress-program", "zstd", "-t", "-f"]
+        + [str(archive_dir / "pkgs" / "tool-1.0-0.tar.zst")]
+    ).decode()
+    assert f"{SITE_PACKAGES}/tool/__init__.py" in names.splitlines()
+    assert "info/tool-1.0-0/paths.json" in names.splitlines()
+    assert not [n for n in names.splitlines() if n.startswith("site-packages")]
+
+    prefix = tmp_path / "prefix"
+    prefix.mkdir()
+    install_pkgs(
+        file_pkgs(str(archive_dir), "pkgs/*"),
+        COEXBootstrapBinaries(**COEXBootstrapBinaries.resolve()),
+        str(prefix),
+        concurrency=2,
+    )
+
+    assert sorted(os.listdir(str(prefix))) == ["bin", "lib"]
+    assert sorted(os.listdir(str(prefix / SITE_PACKAGES))) == ["README.txt", "tool"]
+    assert (prefix / "bin" / "tool-script").read_text() == f"#!{prefix}/bin/python\n"
+    entry_point = (prefix / "bin" / "tool").read_text()
+    assert entry_point.startswith(f"#!{prefix}/bin/python\n")
+    assert "from tool import main" in entry_point
+    assert os.access(str(prefix / "bin" / "tool"), os.X_OK)
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import pathlib
+import shutil
+import subprocess
+import tarfile
+import zipfile
+
+from coex.oci import OCI_ROOT, export_oci
+from coex.pkg_env import relocate
+from coex_bootstrap.install import prefix_placeholder
+
+
+def _write_tar(tmp_path: pathlib.Path, name: str, files: dict) -> pathlib.Path:
+    src_dir = tmp_path / name
+    for path, data in files.items():
+        (src_dir / path).parent.mkdir(parents=True, exist_ok=True)
+        (src_dir / path).write_bytes(data)
+
+    out = tmp_path / f"{name}.tar.zst"
+    subprocess.check_call(
+        ["tar", "--use-compress-program", "zstd", "-f", str(out)]
+        + ["-C", str(src_dir), "-c", "."]
+    )
+    return out
+
+
+def _blob(layout: tarfile.TarFile, digest: str) -> bytes:
+    data = layout.extractfile("blobs/sha256/" + digest.split(":")[1]).read()
+    assert "sha256:" + hashlib.sha256(data).hexdigest() == digest
+    return data
+
+
+def test_export_oci(tmp_path: pathlib.Path):
+    """Each package is a relocated layer, the image runs the entrypoint."""
+    info = "info/tool-1.0-0"
+    pkg = _write_tar(
+        tmp_path,
+        "tool-1.0-0",
+        {
+            "bin/tool": b"#!" + prefix_placeholder.encode() + b"/bin/sh\n",
+            f"{info}/has_prefix": f"{prefix_placeholder} text bin/tool\n".encode(),
+            f"{info}/index.json": json.dumps({"subdir": "linux-aarch64"}).encode(),
+        },
+    )
+    src = _write_tar(tmp_path, "app", {"app/run.sh": b"tool\n"})
+
+    archive = tmp_path / "app.coex"
+    with zipfile.ZipFile(str(archive), "w") as zf:
+        zf.writestr("coex_bootstrap.json", json.dumps({"entrypoint": "app/run.sh"}))
+        zf.write(str(pkg), f"pkgs/{pkg.name}")
+        zf.write(str(src), f"srcs/{src.name}")
+
+    outputs = []
+    for i in range(2):
+        work_dir = tmp_path / f"work{i}"
+        work_dir.mkdir()
+        outputs.append(tmp_path / f"image{i}.tar")
+        manifest = export_oci(archive, outputs[-1], work_dir)
+    assert outputs[0].read_bytes() == outputs[1].read_bytes()
+
+    with tarfile.open(str(outputs[0])) as layout:
+        (descriptor,) = json.loads(layout.extractfile("index.json").read())["manifests"]
+        assert json.loads(_blob(layout, descriptor["digest"])) == manifest
+        image_config = json.loads(_blob(layout, manifest["config"]["digest"]))
+        layers = [_blob(layout, layer["digest"]) for layer in manifest["layers"]]
+
+    assert image_config["architecture"] == "arm64"
+    assert image_config["config"]["Entrypoint"] == [f"{OCI_ROOT}/usr/app/run.sh"]
+    assert len(layers) == len(image_config["rootfs"]["diff_ids"]) == 2
+
+    (tmp_path / "layer.tar.gz").write_bytes(layers[0])
+    with tarfile.open(str(tmp_path / "layer.tar.gz")) as layer:
+        names = layer.getnames()
+        tool = layer.extractfile(f"{OCI_ROOT.strip('/')}/conda/bin/tool").read()
+    assert tool == f"#!{OCI_ROOT}/conda/bin/sh\n".encode()
+    assert not [n for n in names if "/info" in n]
+
+
+def test_export_oci_fixed_prefix(tmp_path: pathlib.Path):
+    """Packages at archive specific fixed prefixes export to identical layers."""
+    placeholder = prefix_placeholder.encode()
+    info = "info/tool-1.0-0"
+    extracted = tmp_path / "extracted"
+    for path, data in {
+        "bin/tool": b"#!" + placeholder + b"/bin/sh\n",
+        "lib/libtool.so": b"\0" + placeholder + b"/lib\0" + b"\0" * 100,
+        f"{info}/has_prefix": (
+            f"{prefix_placeholder} text bin/tool\n"
+            f"{prefix_placeholder} binary lib/libtool.so\n"
+        ).encode(),
+    }.items():
+        (extracted / path).parent.mkdir(parents=True, exist_ok=True)
+        (extracted / path).write_bytes(data)
+
+    digests = []
+    for i, prefix in enumerate(["/tmp/coex-one", "/var/tmp/coex-two"]):
+        package_dir = tmp_path / f"tool{i}"
+        shutil.copytree(str(extracted), str(package_dir))
+        relocate(package_dir, prefix, package_dir / info)
+        pkg = tmp_path / f"tool{i}.tar.zst"
+        subprocess.check_call(
+            ["tar", "--use-compress-program", "zstd", "-f", str(pkg)]
+            + ["-C", str(package_dir), "-c", "."]
+        )
+
+        archive = tmp_path / f"app{i}.coex"
+        with zipfile.ZipFile(str(archive), "w") as zf:
+            config = {"entrypoint": "tool", "prefix": prefix}
+            zf.writestr("coex_bootstrap.json", json.dumps(config))
+            zf.write(str(pkg), "pkgs/tool-1.0-0.tar.zst")
+
+        work_dir = tmp_path / f"work{i}"
+        work_dir.mkdir()
+        output = tmp_path / f"image{i}.tar"
+        (layer,) = export_oci(archive, output, work_dir)["layers"]
+        digests.append(layer["digest"])
+
+    assert digests[0] == digests[1]
+    with tarfile.open(str(output)) as layout:
+        (tmp_path / "layer.tar.gz").write_bytes(_blob(layout, digests[0]))
+    with tarfile.open(str(tmp_path / "layer.tar.gz")) as layer:
+        root = OCI_ROOT.strip("/")
+        tool = layer.extractfile(f"{root}/conda/bin/tool").read()
+        lib = layer.extractfile(f"{root}/conda/lib/libtool.so").read()
+    assert tool == f"#!{OCI_ROOT}/conda/bin/sh\n".encode()
+    assert lib.startswith(f"\0{OCI_ROOT}/conda/lib\0".encode())
+    assert len(lib) == len(b"\0" + placeholder + b"/lib\0" + b"\0" * 100)
@@ -0,0 +1,68 @@
+import os
+import pathlib
+import subprocess
+import sys
+import types
+
+from coex.cli import write_coex
+from coex.compress import CompressionPolicy
+from coex.pkg_env import PkgEnv, repack
+from coex.pkg_src import pkg_src
+from coex_bootstrap.install import prefix_placeholder
+
+
+def _coex(tmp_path: pathlib.Path) -> pathlib.Path:
+    package_dir = tmp_path / "tool-1.0-0"
+    (package_dir / "bin").mkdir(parents=True)
+    (package_dir / "bin" / "tool").write_text(
+        f"#!/bin/sh\necho tool {prefix_placeholder} $COEX_ROOT_PREFIX\n"
+    )
+    (package_dir / "bin" / "tool").chmod(0o755)
+    (package_dir / "info").mkdir()
+    (package_dir / "info" / "has_prefix").write_text(
+        f"{prefix_placeholder} text bin/tool\n"
+    )
+    (package_dir / "info" / "index.json").write_text('{"name": "tool"}')
+
+    (tmp_path / "app").mkdir()
+    (tmp_path / "app" / "run.sh").write_text("#!/bin/sh\ntool\n")
+    (tmp_path / "app" / "run.sh").chmod(0o755)
+
+    extracted = types.SimpleNamespace(name="tool", extracted_package_dir=package_dir)
+    env = PkgEnv(packages={})
+    env.add(extracted, repack(extracted, tmp_path / "cache"), CompressionPolicy())
+    srcs = pkg_src(["app"], tmp_path / "cache")
+
+    output = tmp_path / "app.coex"
+    write_coex(output, "app/run.sh", env, srcs, CompressionPolicy())
+    return output
+
+
+def _run(archive: pathlib.Path, work_dir: pathlib.Path, **env) -> str:
+    work_dir.mkdir(exist_ok=True)
+    return subprocess.check_output(
+        [sys.executable, str(archive)],
+        env=dict(os.environ, COEX_WORK_DIR=str(work_dir), COEX_CLEANUP="0", **env),
+    ).decode()
+
+
+def test_install_prefix(tmp_path: pathlib.Path, monkeypatch):
+    """Installed coex runs from the install, skipping unpack, if stamp matches."""
+    monkeypatch.chdir(tmp_path)
+    archive = _coex(tmp_path)
+    install_dir = tmp_path / "installed"
+
+    assert _run(archive, tmp_path / "work", COEX_INSTALL=str(install_dir)) == ""
+    assert (install_dir / "coex.stamp").exists()
+    assert os.listdir(str(tmp_path / "work")) == []
+
+    output = _run(archive, tmp_path / "work", COEX_PREFIX=str(install_dir))
+    assert output == f"tool {install_dir}/conda {install_dir}\n"
+    assert os.listdir(str(tmp_path / "work")) == []
+
+    # Reinstall is skipped, a stale install is unpacked as usual
+    _run(archive, tmp_path / "work", COEX_INSTALL=str(install_dir))
+    (install_dir / "coex.stamp").write_text("stale")
+    output = _run(archive, tmp_path / "work", COEX_PREFIX=str(install_dir))
+    (run_dir,) = os.listdir(str(tmp_path / "work"))
+    assert output == f"tool {tmp_path}/work/{run_dir}/conda {tmp_path}/work/{run_dir}\n"
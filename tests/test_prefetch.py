@@ -0,0 +1,69 @@
+import os
+import pathlib
+import zipfile
+from collections import defaultdict
+
+import pytest
+
+from coex_bootstrap.prefetch import member_ranges, prefetch, resolve_mode
+from coex_bootstrap.unpack import file_pkgs, zip_pkgs
+
+
+def _archive(tmp_path: pathlib.Path) -> pathlib.Path:
+    archive = tmp_path / "app.coex"
+    with zipfile.ZipFile(str(archive), "w") as zf:
+        zf.writestr("coex_bootstrap.json", "{}")
+        for name in ("pkgs/a.tar.zst", "chunks/a.c0001.tar.zst", "pkgs/b.tar.zst"):
+            zf.writestr(name, os.urandom(1 << 12))
+    return archive
+
+
+def test_member_ranges(tmp_path: pathlib.Path):
+    """Member ranges cover each member's header and data, chunks included."""
+    archive = _archive(tmp_path)
+    members = {"pkgs/a.tar.zst": {"chunks": [{"name": "chunks/a.c0001.tar.zst"}]}}
+    ranges = member_ranges(zip_pkgs(str(archive), "pkgs/?*", members))
+    assert [r[0] for r in ranges] == [
+        "pkgs/a.tar.zst",
+        "chunks/a.c0001.tar.zst",
+        "pkgs/b.tar.zst",
+    ]
+
+    data = archive.read_bytes()
+    with zipfile.ZipFile(str(archive)) as zf:
+        for name, path, offset, length in ranges:
+            assert path == str(archive)
+            assert zf.read(name) in data[offset : offset + length]
+
+    (tmp_path / "unpacked" / "pkgs").mkdir(parents=True)
+    (tmp_path / "unpacked" / "pkgs" / "c.tar.zst").write_bytes(b"c" * 10)
+    ((name, path, offset, length),) = member_ranges(
+        file_pkgs(str(tmp_path / "unpacked"), "pkgs/*")
+    )
+    assert (offset, length) == (0, 10)
+
+
+@pytest.mark.parametrize("mode", ["read", "willneed", "off"])
+def test_prefetch(tmp_path: pathlib.Path, mode):
+    """Prefetch runs ahead of extraction, stopping on exit."""
+    pkgs = zip_pkgs(str(_archive(tmp_path)), "pkgs/?*")
+    timings: dict = defaultdict(float)
+
+    with prefetch(pkgs, mode, timings) as prefetcher:
+        if mode == "off":
+            assert prefetcher is None
+            return
+        for p in pkgs:
+            prefetcher.extracting(p)
+
+    assert not prefetcher.thread.is_alive()
+    assert sorted(prefetcher.started) == ["pkgs/a.tar.zst", "pkgs/b.tar.zst"]
+    assert "prefetch" in timings
+
+
+def test_resolve_mode():
+    """Boolean values enable the default mode, invalid modes raise."""
+    assert resolve_mode("0") == resolve_mode("off") == "off"
+    assert resolve_mode("true") == resolve_mode("auto")
+    with pytest.raises(ValueError):
+        resolve_mode("sometimes")
@@ -0,0 +1,60 @@
+import os
+import pathlib
+import types
+
+from coex.archive import ArchiveWriter
+from coex.pkg_env import repack
+from coex.pkg_src import pkg_src
+from coex_bootstrap.install import prefix_placeholder
+
+
+def _package(path: pathlib.Path) -> pathlib.Path:
+    (path / "info").mkdir(parents=True)
+    (path / "info" / "has_prefix").write_text(f"{prefix_placeholder} text bin/tool\n")
+    (path / "bin").mkdir()
+    (path / "bin" / "tool").write_text(f"#!{prefix_placeholder}/bin/sh\n")
+    for name in ("b", "a", "c"):
+        (path / "lib" / name).mkdir(parents=True)
+        (path / "lib" / name / "data").write_bytes(os.urandom(1 << 10))
+
+    for p in [path] + list(path.rglob("*")):
+        os.utime(str(p), (1_600_000_000, 1_600_000_000))
+    return path
+
+
+def test_repack_reproducible(tmp_path: pathlib.Path):
+    """Relocated packages are byte-identical across builds and chunkings."""
+    extracted = types.SimpleNamespace(
+        name="tool", extracted_package_dir=str(_package(tmp_path / "tool-1.0-0"))
+    )
+
+    for chunk_size in (None, 1 << 11):
+        builds = [
+            repack(extracted, tmp_path / f"cache{i}", "/opt/env", chunk_size=chunk_size)
+            for i in range(2)
+        ]
+        assert [p.name for p in builds[0]] == [p.name for p in builds[1]]
+        assert [p.read_bytes() for p in builds[0]] == [
+            p.read_bytes() for p in builds[1]
+        ]
+
+
+def test_archive_reproducible(tmp_path: pathlib.Path, monkeypatch):
+    """Sources and archives are byte-identical, with mtimes clamped to the epoch."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("SOURCE_DATE_EPOCH", "1600000000")
+
+    outputs = []
+    for i in range(2):
+        (tmp_path / "app").mkdir(exist_ok=True)
+        (tmp_path / "app" / "run.sh").write_text("echo hello\n")
+        os.utime(str(tmp_path / "app" / "run.sh"), (1_700_000_000 + i,) * 2)
+
+        srcs = pkg_src(["app"], tmp_path / f"cache{i}")
+        assert srcs
+        outputs.append(tmp_path / f"app{i}.coex")
+        with ArchiveWriter(outputs[-1]) as archive:
+            archive.writestr("coex_bootstrap.json", b"{}")
+            archive.add(srcs, "srcs/src.tar.zst")
+
+    assert outputs[0].read_bytes() == outputs[1].read_bytes()
@@ -0,0 +1,125 @@
+import glob
+import http.server
+import os
+import pathlib
+import subprocess
+import sys
+import threading
+import time
+import types
+import urllib.request
+import zipfile
+
+from coex.cli import write_coex
+from coex.compress import CompressionPolicy
+from coex.pkg_env import PkgEnv, repack
+from coex.pkg_src import pkg_src
+from coex_bootstrap.install import prefix_placeholder
+from coex_bootstrap.stream import read_members
+
+
+def _coex(tmp_path: pathlib.Path) -> pathlib.Path:
+    package_dir = tmp_path / "tool-1.0-0"
+    (package_dir / "bin").mkdir(parents=True)
+    (package_dir / "bin" / "tool").write_text(
+        f"#!/bin/sh\necho tool {prefix_placeholder}\n"
+    )
+    (package_dir / "bin" / "tool").chmod(0o755)
+    (package_dir / "lib").mkdir()
+    for i in range(3):
+        (package_dir / "lib" / f"part{i}").write_bytes(os.urandom(1 << 14))
+    (package_dir / "info").mkdir()
+    (package_dir / "info" / "has_prefix").write_text(
+        f"{prefix_placeholder} text bin/tool\n"
+    )
+    (package_dir / "info" / "index.json").write_text('{"name": "tool"}')
+
+    (tmp_path / "app").mkdir()
+    (tmp_path / "app" / "run.sh").write_text("#!/bin/sh\ntool\n")
+    (tmp_path / "app" / "run.sh").chmod(0o755)
+
+    extracted = types.SimpleNamespace(name="tool", extracted_package_dir=package_dir)
+    env = PkgEnv(packages={})
+    paths = repack(extracted, tmp_path / "cache", chunk_size=1 << 15)
+    assert len(paths) > 1
+    env.add(extracted, paths, CompressionPolicy())
+    srcs = pkg_src(["app"], tmp_path / "cache")
+
+    output = tmp_path / "app.coex"
+    write_coex(output, "app/run.sh", env, srcs, CompressionPolicy(), layout="stream")
+    return output
+
+
+def test_stream_layout(tmp_path: pathlib.Path, monkeypatch):
+    """Stream layout members are readable front to back, config before pkgs."""
+    monkeypatch.chdir(tmp_path)
+    archive = _coex(tmp_path)
+
+    with archive.open("rb") as source:
+        names = [m.name for m in read_members(source)]
+    with zipfile.ZipFile(str(archive)) as zf:
+        assert zf.testzip() is None
+        assert names == zf.namelist()
+
+    config = names.index("coex_bootstrap.json")
+    assert names[config + 1] == "srcs/src.tar.zst"
+    assert all(n.startswith(("pkgs/", "chunks/")) for n in names[config + 2 :])
+
+
+def test_stream_launch(tmp_path: pathlib.Path, monkeypatch):
+    """Packages are extracted from a pipe before the download completes."""
+    monkeypatch.chdir(tmp_path)
+    archive = _coex(tmp_path)
+    data = archive.read_bytes()
+    with zipfile.ZipFile(str(archive)) as zf:
+        loader = zf.read("coex_bootstrap/stream.py")
+        central_directory = zf.start_dir  # type: ignore
+    (tmp_path / "coex_stream.py").write_bytes(loader)
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+
+    overlapped = threading.Event()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data[:central_directory])
+            self.wfile.flush()
+
+            # Hold back the archive tail until the package is extracted
+            deadline = time.time() + 30
+            while time.time() < deadline:
+                if glob.glob(str(work_dir / "coex_stream_*" / "conda" / "lib")):
+                    overlapped.set()
+                    break
+                time.sleep(0.05)
+            self.wfile.write(data[central_directory:])
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        proc = subprocess.Popen(
+            [sys.executable, str(tmp_path / "coex_stream.py")],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=dict(os.environ, COEX_WORK_DIR=str(work_dir), COEX_VERIFY="1"),
+        )
+        url = f"http://127.0.0.1:{server.server_address[1]}/app.coex"
+        with urllib.request.urlopen(url) as response:
+            for block in iter(lambda: response.read(1 << 12), b""):
+                proc.stdin.write(block)
+        proc.stdin.close()
+        output = proc.stdout.read().decode()
+        assert proc.wait() == 0
+    finally:
+        server.shutdown()
+
+    assert overlapped.is_set()
+    run_dir = work_dir / f"coex_stream_{proc.pid}"
+    assert output == f"tool {run_dir}/conda\n"
+    assert os.listdir(str(work_dir)) == []
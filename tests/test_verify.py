@@ -0,0 +1,76 @@
+import os
+import pathlib
+import subprocess
+import sys
+import zipfile
+
+import pytest
+
+from coex.cli import write_coex
+from coex.compress import CompressionPolicy
+from coex.pkg_env import PkgEnv
+from coex.pkg_src import pkg_src
+from coex.watch import SRCS_MEMBER
+from coex_bootstrap.binaries import COEXBootstrapBinaries
+from coex_bootstrap.config import COEXBootstrapConfig
+from coex_bootstrap.unpack import FilePkgHandle, ZipPkgHandle
+from coex_bootstrap.verify import HASH_NAME, IntegrityError, file_hash
+
+
+def test_verify_launch(tmp_path: pathlib.Path, monkeypatch):
+    """Members are verified on extraction, once per unchanged archive."""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "app").mkdir()
+    (tmp_path / "app" / "run.sh").write_text("#!/bin/sh\necho ok\n")
+    (tmp_path / "app" / "run.sh").chmod(0o755)
+    srcs = pkg_src(["app"], tmp_path / "cache")
+    assert srcs
+    output = tmp_path / "app.coex"
+    write_coex(output, "app/run.sh", PkgEnv(packages={}), srcs, CompressionPolicy())
+
+    config = COEXBootstrapConfig.read_archive(str(output))
+    assert config.members[SRCS_MEMBER][HASH_NAME] == file_hash(str(srcs))
+    with zipfile.ZipFile(str(output)) as zf:
+        hashed = {n for n in zf.namelist() if n != "coex_bootstrap.json"}
+    assert hashed == {n for n, m in config.members.items() if HASH_NAME in m}
+
+    env = dict(os.environ, COEX_VERIFY="1", COEX_WORK_DIR=str(tmp_path / "work"))
+    for _ in range(2):
+        assert subprocess.check_output([sys.executable, str(output)], env=env) == (
+            b"ok\n"
+        )
+        assert len(os.listdir(str(tmp_path / "work" / "coex_verified"))) == 1
+
+
+def test_verify_mismatch(tmp_path: pathlib.Path):
+    """Members not matching their recorded hash fail extraction."""
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "file").write_text("data\n")
+    member = tmp_path / "src.tar.zst"
+    subprocess.check_call(
+        ["tar", "--use-compress-program", "zstd", "-f", str(member)]
+        + ["-C", str(tmp_path / "src"), "-c", "file"]
+    )
+    archive = tmp_path / "archive.zip"
+    with zipfile.ZipFile(str(archive), "w") as zf:
+        zf.write(str(member), "srcs/src.tar.zst")
+    binaries = COEXBootstrapBinaries(**COEXBootstrapBinaries.resolve())
+
+    good = {HASH_NAME: file_hash(str(member))}
+    bad = {HASH_NAME: "0" * 64}
+    for handle in (
+        ZipPkgHandle(str(archive), "srcs/src.tar.zst", good, verify=True),
+        FilePkgHandle(str(tmp_path), "src.tar.zst", good, verify=True),
+    ):
+        out = tmp_path / "out" / type(handle).__name__
+        out.mkdir(parents=True)
+        handle.extract(binaries, str(out))
+        assert (out / "file").read_text() == "data\n"
+
+    for handle in (
+        ZipPkgHandle(str(archive), "srcs/src.tar.zst", bad, verify=True),
+        FilePkgHandle(str(tmp_path), "src.tar.zst", bad, verify=True),
+        FilePkgHandle(str(tmp_path), "src.tar.zst", {}, verify=True),
+    ):
+        with pytest.raises(IntegrityError):
+            handle.extract(binaries, str(tmp_path / "out"))
@@ -0,0 +1,61 @@
+import pathlib
+import subprocess
+import sys
+import zipfile
+
+from coex.cli import write_coex
+from coex.compress import Compression, CompressionPolicy
+from coex.pkg_env import PkgEnv
+from coex.pkg_src import pkg_src
+from coex.watch import SourceWatcher
+
+
+def _write_app(tmp_path: pathlib.Path, message: str) -> None:
+    (tmp_path / "app").mkdir(exist_ok=True)
+    (tmp_path / "app" / "run.sh").write_text(f"#!/bin/sh\necho {message}\n")
+    (tmp_path / "app" / "run.sh").chmod(0o755)
+
+
+def test_watch_rebuild(tmp_path: pathlib.Path, monkeypatch):
+    """Source changes rewrite the archive in place, as a full rebuild."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("SOURCE_DATE_EPOCH", "1600000000")
+    (tmp_path / "tool" / "bin").mkdir(parents=True)
+    (tmp_path / "tool" / "bin" / "tool").write_text("tool\n")
+    (tmp_path / "tool" / "info" / "tool-1.0-0").mkdir(parents=True)
+    (tmp_path / "tool" / "info" / "tool-1.0-0" / "index.json").write_text("{}")
+    package = tmp_path / "tool-1.0-0.tar.zst"
+    subprocess.check_call(
+        ["tar", "--use-compress-program", "zstd", "-f", str(package)]
+        + ["-C", str(tmp_path / "tool"), "-c", "bin", "info"]
+    )
+    env = PkgEnv(packages={package.name: package}, compression={package: Compression()})
+
+    _write_app(tmp_path, "v1")
+    output = tmp_path / "app.coex"
+    write_coex(
+        output,
+        "app/run.sh",
+        env,
+        pkg_src(["app"], tmp_path / "cache"),
+        CompressionPolicy(),
+    )
+    assert subprocess.check_output([sys.executable, str(output)]) == b"v1\n"
+    with zipfile.ZipFile(str(output)) as zf:
+        pkg_offset = zf.getinfo(f"pkgs/{package.name}").header_offset
+
+    watcher = SourceWatcher(output, ["app"], tmp_path / "cache")
+    assert not watcher.poll()
+
+    _write_app(tmp_path, "version 2")
+    assert watcher.poll()
+    assert not watcher.poll()
+    assert subprocess.check_output([sys.executable, str(output)]) == b"version 2\n"
+    with zipfile.ZipFile(str(output)) as zf:
+        assert zf.getinfo(f"pkgs/{package.name}").header_offset == pkg_offset
+        assert zf.testzip() is None
+
+    rebuilt = tmp_path / "rebuilt.coex"
+    srcs = pkg_src(["app"], tmp_path / "cache")
+    write_coex(rebuilt, "app/run.sh", env, srcs, CompressionPolicy())
+    assert output.read_bytes() == rebuilt.read_bytes()